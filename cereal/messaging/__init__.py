@@ -8,13 +8,14 @@ import os
 import capnp
 import time
 
-from typing import Optional, List, Union, Dict, Deque
+from typing import Optional, List, Union, Dict, Deque, Tuple
 from collections import deque
 
 from cereal import log
 from cereal.services import SERVICE_LIST
 
 NO_TRAVERSAL_LIMIT = 2**64-1
+RECV_LATENCY_WINDOW = 1000
 
 
 def log_from_bytes(dat: bytes) -> capnp.lib.capnp._DynamicStructReader:
@@ -87,6 +88,46 @@ def recv_one_retry(sock: SubSocket) -> capnp.lib.capnp._DynamicStructReader:
       return log_from_bytes(dat)
 
 
+class FrequencyTracker:
+  """Average inter-arrival time over a window and over its most recent tenth, kept as running sums in a ring
+  buffer so each message costs O(1). The sums are recomputed every lap to keep rounding from adding up."""
+  def __init__(self, window: int) -> None:
+    self.dts = [0.] * window
+    self.window = window
+    self.recent_window = window // 10
+    self.count = 0
+    self.sum = 0.
+    self.recent_sum = 0.
+
+  def add(self, dt: float) -> None:
+    i = self.count % self.window
+    if self.count >= self.window:
+      self.sum -= self.dts[i]
+    if self.count >= self.recent_window:
+      self.recent_sum -= self.dts[(self.count - self.recent_window) % self.window]
+
+    self.dts[i] = dt
+    self.sum += dt
+    self.recent_sum += dt
+    self.count += 1
+
+    if self.count % self.window == 0:
+      self.sum = sum(self.dts)
+      self.recent_sum = sum(self.dts[-self.recent_window:])
+
+  def avg_freq(self) -> float:
+    try:
+      return 1 / (self.sum / min(self.count, self.window))
+    except ZeroDivisionError:
+      return 0
+
+  def recent_avg_freq(self) -> float:
+    try:
+      return 1 / (self.recent_sum / min(self.count, self.recent_window))
+    except ZeroDivisionError:
+      return 0
+
+
 class SubMaster:
   def __init__(self, services: List[str], poll: Optional[str] = None,
                ignore_alive: Optional[List[str]] = None, ignore_avg_freq: Optional[List[str]] = None,
@@ -98,7 +139,8 @@ class SubMaster:
     self.recv_frame = {s: 0 for s in services}
     self.alive = {s: False for s in services}
     self.freq_ok = {s: False for s in services}
-    self.recv_dts: Dict[str, Deque[float]] = {}
+    self.freq_tracker: Dict[str, FrequencyTracker] = {}
+    self.recv_latency: Dict[str, Deque[float]] = {s: deque(maxlen=RECV_LATENCY_WINDOW) for s in services}
     self.sock = {}
     self.data = {}
     self.valid = {}
@@ -148,7 +190,15 @@ class SubMaster:
           min_freq = min(freq, freq / 2.)
       self.max_freq[s] = max_freq*1.2
       self.min_freq[s] = min_freq*0.8
-      self.recv_dts[s] = deque(maxlen=int(10*freq))
+      self.freq_tracker[s] = FrequencyTracker(int(10*freq))
+
+    # only services with a frequency are checked for being alive and their average frequency, the rest always pass
+    self.checked_services = [s for s in services if SERVICE_LIST[s].frequency > 1e-5 and not self.simulation]
+    self.alive_timeout = {s: 10. / SERVICE_LIST[s].frequency for s in self.checked_services}
+    for s in services:
+      if s not in self.alive_timeout:
+        self.freq_ok[s] = True
+        self.alive[s] = not self.simulation
 
   def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
     return self.data[s]
@@ -177,39 +227,41 @@ class SubMaster:
       self.seen[s] = True
       self.updated[s] = True
 
-      if self.recv_time[s] > 1e-5:
-        self.recv_dts[s].append(cur_time - self.recv_time[s])
+      if self.recv_time[s] > 1e-5 and s in self.alive_timeout:
+        tracker = self.freq_tracker[s]
+        tracker.add(cur_time - self.recv_time[s])
+
+        # check average frequency; slow to fall, quick to recover
+        avg_freq_ok = self.min_freq[s] <= tracker.avg_freq() <= self.max_freq[s]
+        recent_freq_ok = self.min_freq[s] <= tracker.recent_avg_freq() <= self.max_freq[s]
+        self.freq_ok[s] = avg_freq_ok or recent_freq_ok
       self.recv_time[s] = cur_time
       self.recv_frame[s] = self.frame
       self.data[s] = getattr(msg, s)
       self.logMonoTime[s] = msg.logMonoTime
       self.valid[s] = msg.valid
-
-    for s in self.data:
-      if SERVICE_LIST[s].frequency > 1e-5 and not self.simulation:
-        # alive if delay is within 10x the expected frequency
-        self.alive[s] = (cur_time - self.recv_time[s]) < (10. / SERVICE_LIST[s].frequency)
-
-        # check average frequency; slow to fall, quick to recover
-        dts = self.recv_dts[s]
-        assert dts.maxlen is not None
-        recent_dts = list(dts)[-int(dts.maxlen / 10):]
-        try:
-          avg_freq = 1 / (sum(dts) / len(dts))
-          avg_freq_recent = 1 / (sum(recent_dts) / len(recent_dts))
-        except ZeroDivisionError:
-          avg_freq = 0
-          avg_freq_recent = 0
-
-        avg_freq_ok = self.min_freq[s] <= avg_freq <= self.max_freq[s]
-        recent_freq_ok = self.min_freq[s] <= avg_freq_recent <= self.max_freq[s]
-        self.freq_ok[s] = avg_freq_ok or recent_freq_ok
-      else:
-        self.freq_ok[s] = True
-        if self.simulation:
-          self.alive[s] = self.seen[s] # alive is defined as seen when simulation flag set
-        else:
-          self.alive[s] = True
+      self.recv_latency[s].append(cur_time - msg.logMonoTime * 1e-9)
+
+      if self.simulation:
+        self.alive[s] = True  # alive is defined as seen when simulation flag set
+
+    # alive if delay is within 10x the expected frequency
+    for s in self.checked_services:
+      self.alive[s] = (cur_time - self.recv_time[s]) < self.alive_timeout[s]
+
+  def recv_latency_percentiles(self, s: str, percentiles: Tuple[float, ...] = (50., 90., 99.)) -> List[float]:
+    """Percentiles of the time from logMonoTime to being received, in seconds, over the last RECV_LATENCY_WINDOW messages"""
+    latencies = sorted(self.recv_latency[s])
+    if not latencies:
+      return [0. for _ in percentiles]
+
+    ret = []
+    for p in percentiles:
+      k = (len(latencies) - 1) * p / 100.
+      f = int(k)
+      c = min(f + 1, len(latencies) - 1)
+      ret.append(latencies[f] + (latencies[c] - latencies[f]) * (k - f))
+    return ret
 
   def all_alive(self, service_list: Optional[List[str]] = None) -> bool:
     if service_list is None:
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import subprocess
+import time
+import types
+
+import capnp
+
+from cereal.messaging import SubMaster, new_message
+from cereal.services import SERVICE_LIST
+
+
+def load_submaster_at(commit: str) -> type[SubMaster]:
+  # SubMaster as of commit, loaded from git next to the current one
+  source = subprocess.check_output(["git", "show", f"{commit}:./__init__.py"], cwd=os.path.dirname(os.path.abspath(__file__)), encoding="utf8")
+  module = types.ModuleType(f"cereal.messaging@{commit}")
+  exec(compile(source, f"cereal/messaging/__init__.py@{commit}", "exec"), module.__dict__)
+  return module.SubMaster
+
+
+def make_msg(s: str):
+  try:
+    return new_message(s).as_reader()
+  except capnp.lib.capnp.KjException:
+    return new_message(s, 0).as_reader()
+
+
+def benchmark(sm: SubMaster, services: list[str], frames: int) -> float:
+  # 100Hz frames where every service sends at its own rate, with the first few seconds filling the windows
+  msgs = {s: make_msg(s) for s in services}
+  elapsed = 0.
+  for frame in range(frames):
+    cur_time = frame / 100.
+    updated = [msgs[s] for s in services if frame % max(round(100 / SERVICE_LIST[s].frequency), 1) == 0]
+    t = time.perf_counter()
+    sm.update_msgs(cur_time, updated)
+    elapsed += time.perf_counter() - t
+  return elapsed / frames
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Per-call cost of SubMaster.update_msgs as services are added")
+  parser.add_argument("--frames", type=int, default=3000)
+  parser.add_argument("--baseline", help="commit to compare against, SubMaster is loaded as of that commit")
+  args = parser.parse_args()
+
+  runs = [("current", SubMaster)]
+  if args.baseline:
+    runs.insert(0, (args.baseline, load_submaster_at(args.baseline)))
+
+  candidates = sorted(s for s, service in SERVICE_LIST.items() if service.frequency >= 1.)
+  for count in (1, 5, 10, 20, 40):
+    services = candidates[:count]
+    times = [(name, benchmark(cls(services, poll=services[0]), services, args.frames)) for name, cls in runs]
+    print(f"{count:3d} services: " + ", ".join(f"{name} {t * 1e6:7.1f} us" for name, t in times) + " per update")
@@ -1,5 +1,8 @@
 from functools import cache
+import os
 import subprocess
+import types
+from openpilot.common.basedir import BASEDIR
 from openpilot.common.run import run_cmd, run_cmd_default
 
 
@@ -40,3 +43,12 @@ def get_normalized_origin(cwd: str = None) -> str:
     .replace(".git", "", 1) \
     .replace("https://", "", 1) \
     .replace(":", "/", 1)
+
+
+def load_module_at(path: str, commit: str, cwd: str = BASEDIR) -> types.ModuleType:
+  # a python file as of commit, loaded as a standalone module so benchmarks can run it next to the current code
+  source = run_cmd(["git", "show", f"{commit}:{path}"], cwd=cwd)
+  module = types.ModuleType(f"{os.path.splitext(os.path.basename(path))[0]}@{commit}")
+  module.__file__ = os.path.join(cwd, path)
+  exec(compile(source, f"{path}@{commit}", "exec"), module.__dict__)
+  return module
@@ -0,0 +1,92 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from typing import NamedTuple
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyEvent(NamedTuple):
+  wd: int
+  mask: int
+  name: str
+
+
+class Inotify:
+  """Minimal inotify(7) wrapper. Watch directories with add_watch, then read() the events, or select() on
+  fileno() to wait on several sources at once."""
+
+  def __init__(self):
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.watches: dict[int, str] = {}
+
+  def fileno(self) -> int:
+    return self.fd
+
+  def add_watch(self, path: str, mask: int) -> int:
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), path)
+    self.watches[wd] = path
+    return wd
+
+  def rm_watch(self, wd: int) -> None:
+    if self.watches.pop(wd, None) is not None:
+      self.libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self, timeout: float | None = 0) -> list[InotifyEvent]:
+    """Events queued so far, waiting up to timeout seconds (None blocks) for the first one"""
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+
+    try:
+      buf = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+
+    events = []
+    offset = 0
+    while offset < len(buf):
+      wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+      offset += EVENT_HEADER.size
+      name = os.fsdecode(buf[offset:offset + length].rstrip(b"\0"))
+      offset += length
+      if mask & IN_IGNORED:
+        self.watches.pop(wd, None)
+      events.append(InotifyEvent(wd, mask, name))
+    return events
+
+  def close(self) -> None:
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+      self.watches.clear()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -1,14 +1,14 @@
 import numpy as np
 from collections.abc import Callable
 
-from openpilot.common.transformations.transformations import (ecef_euler_from_ned_single,
-                                                    euler2quat_single,
-                                                    euler2rot_single,
-                                                    ned_euler_from_ecef_single,
-                                                    quat2euler_single,
-                                                    quat2rot_single,
-                                                    rot2euler_single,
-                                                    rot2quat_single)
+from openpilot.common.transformations.transformations import (ecef_euler_from_ned_batch,
+                                                    euler2quat_batch,
+                                                    euler2rot_batch,
+                                                    ned_euler_from_ecef_batch,
+                                                    quat2euler_batch,
+                                                    quat2rot_batch,
+                                                    rot2euler_batch,
+                                                    rot2quat_batch)
 
 
 def numpy_wrap(function, input_shape, output_shape) -> Callable[..., np.ndarray]:
@@ -33,14 +33,40 @@ def numpy_wrap(function, input_shape, output_shape) -> Callable[..., np.ndarray]
   return f
 
 
-euler2quat = numpy_wrap(euler2quat_single, (3,), (4,))
-quat2euler = numpy_wrap(quat2euler_single, (4,), (3,))
-quat2rot = numpy_wrap(quat2rot_single, (4,), (3, 3))
-rot2quat = numpy_wrap(rot2quat_single, (3, 3), (4,))
-euler2rot = numpy_wrap(euler2rot_single, (3,), (3, 3))
-rot2euler = numpy_wrap(rot2euler_single, (3, 3), (3,))
-ecef_euler_from_ned = numpy_wrap(ecef_euler_from_ned_single, (3,), (3,))
-ned_euler_from_ecef = numpy_wrap(ned_euler_from_ecef_single, (3,), (3,))
+def batch_wrap(function, input_shape, output_shape) -> Callable[..., np.ndarray]:
+  """Wrap a batch kernel to take either an input or list of inputs and return the correct shape.
+  Results are written into out when given, so per-frame callers can reuse their arrays"""
+  def f(*inps, out: np.ndarray | None = None):
+    *args, inp = inps
+    inp = np.ascontiguousarray(inp, dtype=np.float64)
+
+    if inp.ndim == len(input_shape):
+      out_shape = output_shape
+    else:
+      out_shape = (inp.shape[0],) + output_shape
+
+    if out is None:
+      out = np.empty(out_shape)
+    elif out.shape != out_shape or out.dtype != np.float64 or not out.flags.c_contiguous:
+      raise ValueError(f"out must be a C-contiguous float64 array of shape {out_shape}, got {out.dtype} {out.shape}")
+
+    # assigning shape raises instead of copying, so the kernel always writes into out
+    inp_batch, out_batch = inp.view(), out.view()
+    inp_batch.shape = (-1,) + input_shape
+    out_batch.shape = (-1,) + output_shape
+    function(*args, inp_batch, out_batch)
+    return out
+  return f
+
+
+euler2quat = batch_wrap(euler2quat_batch, (3,), (4,))
+quat2euler = batch_wrap(quat2euler_batch, (4,), (3,))
+quat2rot = batch_wrap(quat2rot_batch, (4,), (3, 3))
+rot2quat = batch_wrap(rot2quat_batch, (3, 3), (4,))
+euler2rot = batch_wrap(euler2rot_batch, (3,), (3, 3))
+rot2euler = batch_wrap(rot2euler_batch, (3, 3), (3,))
+ecef_euler_from_ned = batch_wrap(ecef_euler_from_ned_batch, (3,), (3,))
+ned_euler_from_ecef = batch_wrap(ned_euler_from_ecef_batch, (3,), (3,))
 
 quats_from_rotations = rot2quat
 quat_from_rot = rot2quat
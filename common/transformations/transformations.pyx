@@ -32,6 +32,21 @@ cdef Matrix3 numpy2matrix(np.ndarray[double, ndim=2, mode="fortran"] m):
     assert m.shape[1] == 3
     return Matrix3(<double*>m.data)
 
+cdef Matrix3 array2matrix(const double[:, :, ::1] m, Py_ssize_t i):
+    # Eigen is column major
+    cdef double data[9]
+    cdef int r, c
+    for r in range(3):
+        for c in range(3):
+            data[c * 3 + r] = m[i, r, c]
+    return Matrix3(data)
+
+cdef void matrix2array(Matrix3 m, double[:, :, ::1] out, Py_ssize_t i):
+    cdef int r, c
+    for r in range(3):
+        for c in range(3):
+            out[i, r, c] = m(r, c)
+
 cdef ECEF list2ecef(ecef):
     cdef ECEF e
     e.x = ecef[0]
@@ -111,6 +126,81 @@ def ecef2geodetic_single(ecef):
     return [g.lat, g.lon, g.alt]
 
 
+# Batch kernels, loop over contiguous (N, 3), (N, 4) or (N, 3, 3) inputs and write into preallocated outputs
+
+def euler2quat_batch(const double[:, ::1] euler, double[:, ::1] out):
+    cdef Quaternion q
+    cdef Py_ssize_t i
+    for i in range(euler.shape[0]):
+        q = euler2quat_c(Vector3(euler[i, 0], euler[i, 1], euler[i, 2]))
+        out[i, 0], out[i, 1], out[i, 2], out[i, 3] = q.w(), q.x(), q.y(), q.z()
+
+def quat2euler_batch(const double[:, ::1] quat, double[:, ::1] out):
+    cdef Vector3 e
+    cdef Py_ssize_t i
+    for i in range(quat.shape[0]):
+        e = quat2euler_c(Quaternion(quat[i, 0], quat[i, 1], quat[i, 2], quat[i, 3]))
+        out[i, 0], out[i, 1], out[i, 2] = e(0), e(1), e(2)
+
+def quat2rot_batch(const double[:, ::1] quat, double[:, :, ::1] out):
+    cdef Py_ssize_t i
+    for i in range(quat.shape[0]):
+        matrix2array(quat2rot_c(Quaternion(quat[i, 0], quat[i, 1], quat[i, 2], quat[i, 3])), out, i)
+
+def rot2quat_batch(const double[:, :, ::1] rot, double[:, ::1] out):
+    cdef Quaternion q
+    cdef Py_ssize_t i
+    for i in range(rot.shape[0]):
+        q = rot2quat_c(array2matrix(rot, i))
+        out[i, 0], out[i, 1], out[i, 2], out[i, 3] = q.w(), q.x(), q.y(), q.z()
+
+def euler2rot_batch(const double[:, ::1] euler, double[:, :, ::1] out):
+    cdef Py_ssize_t i
+    for i in range(euler.shape[0]):
+        matrix2array(euler2rot_c(Vector3(euler[i, 0], euler[i, 1], euler[i, 2])), out, i)
+
+def rot2euler_batch(const double[:, :, ::1] rot, double[:, ::1] out):
+    cdef Vector3 e
+    cdef Py_ssize_t i
+    for i in range(rot.shape[0]):
+        e = rot2euler_c(array2matrix(rot, i))
+        out[i, 0], out[i, 1], out[i, 2] = e(0), e(1), e(2)
+
+def ecef_euler_from_ned_batch(ecef_init, const double[:, ::1] ned_pose, double[:, ::1] out):
+    cdef ECEF init = list2ecef(ecef_init)
+    cdef Vector3 e
+    cdef Py_ssize_t i
+    for i in range(ned_pose.shape[0]):
+        e = ecef_euler_from_ned_c(init, Vector3(ned_pose[i, 0], ned_pose[i, 1], ned_pose[i, 2]))
+        out[i, 0], out[i, 1], out[i, 2] = e(0), e(1), e(2)
+
+def ned_euler_from_ecef_batch(ecef_init, const double[:, ::1] ecef_pose, double[:, ::1] out):
+    cdef ECEF init = list2ecef(ecef_init)
+    cdef Vector3 e
+    cdef Py_ssize_t i
+    for i in range(ecef_pose.shape[0]):
+        e = ned_euler_from_ecef_c(init, Vector3(ecef_pose[i, 0], ecef_pose[i, 1], ecef_pose[i, 2]))
+        out[i, 0], out[i, 1], out[i, 2] = e(0), e(1), e(2)
+
+def geodetic2ecef_batch(const double[:, ::1] geodetic, double[:, ::1] out):
+    cdef Geodetic g
+    cdef ECEF e
+    cdef Py_ssize_t i
+    for i in range(geodetic.shape[0]):
+        g.lat, g.lon, g.alt = geodetic[i, 0], geodetic[i, 1], geodetic[i, 2]
+        e = geodetic2ecef_c(g)
+        out[i, 0], out[i, 1], out[i, 2] = e.x, e.y, e.z
+
+def ecef2geodetic_batch(const double[:, ::1] ecef, double[:, ::1] out):
+    cdef ECEF e
+    cdef Geodetic g
+    cdef Py_ssize_t i
+    for i in range(ecef.shape[0]):
+        e.x, e.y, e.z = ecef[i, 0], ecef[i, 1], ecef[i, 2]
+        g = ecef2geodetic_c(e)
+        out[i, 0], out[i, 1], out[i, 2] = g.lat, g.lon, g.alt
+
+
 cdef class LocalCoord:
     cdef LocalCoord_c * lc
 
@@ -169,5 +259,45 @@ cdef class LocalCoord:
         cdef Geodetic g = self.lc.ned2geodetic(n)
         return [g.lat, g.lon, g.alt]
 
+    def ecef2ned_batch(self, const double[:, ::1] ecef, double[:, ::1] out):
+        assert self.lc
+        cdef ECEF e
+        cdef NED n
+        cdef Py_ssize_t i
+        for i in range(ecef.shape[0]):
+            e.x, e.y, e.z = ecef[i, 0], ecef[i, 1], ecef[i, 2]
+            n = self.lc.ecef2ned(e)
+            out[i, 0], out[i, 1], out[i, 2] = n.n, n.e, n.d
+
+    def ned2ecef_batch(self, const double[:, ::1] ned, double[:, ::1] out):
+        assert self.lc
+        cdef NED n
+        cdef ECEF e
+        cdef Py_ssize_t i
+        for i in range(ned.shape[0]):
+            n.n, n.e, n.d = ned[i, 0], ned[i, 1], ned[i, 2]
+            e = self.lc.ned2ecef(n)
+            out[i, 0], out[i, 1], out[i, 2] = e.x, e.y, e.z
+
+    def geodetic2ned_batch(self, const double[:, ::1] geodetic, double[:, ::1] out):
+        assert self.lc
+        cdef Geodetic g
+        cdef NED n
+        cdef Py_ssize_t i
+        for i in range(geodetic.shape[0]):
+            g.lat, g.lon, g.alt = geodetic[i, 0], geodetic[i, 1], geodetic[i, 2]
+            n = self.lc.geodetic2ned(g)
+            out[i, 0], out[i, 1], out[i, 2] = n.n, n.e, n.d
+
+    def ned2geodetic_batch(self, const double[:, ::1] ned, double[:, ::1] out):
+        assert self.lc
+        cdef NED n
+        cdef Geodetic g
+        cdef Py_ssize_t i
+        for i in range(ned.shape[0]):
+            n.n, n.e, n.d = ned[i, 0], ned[i, 1], ned[i, 2]
+            g = self.lc.ned2geodetic(n)
+            out[i, 0], out[i, 1], out[i, 2] = g.lat, g.lon, g.alt
+
     def __dealloc__(self):
         del self.lc
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+
+from openpilot.common.transformations import transformations as t
+from openpilot.common.transformations.coordinates import LocalCoord
+from openpilot.common.transformations.orientation import batch_wrap, numpy_wrap
+
+
+def timeit(f, *args, **kwargs) -> float:
+  t0 = time.perf_counter()
+  f(*args, **kwargs)
+  return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Per-row wrappers against the batch transformation kernels")
+  parser.add_argument("--rows", type=int, default=100000)
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  euler = rng.uniform(-np.pi / 2, np.pi / 2, (args.rows, 3))
+  quats = batch_wrap(t.euler2quat_batch, (3,), (4,))(euler)
+  rots = batch_wrap(t.euler2rot_batch, (3,), (3, 3))(euler)
+  geodetic = np.column_stack([rng.uniform(-80, 80, args.rows), rng.uniform(-180, 180, args.rows), rng.uniform(0, 1000, args.rows)])
+  ecef = batch_wrap(t.geodetic2ecef_batch, (3,), (3,))(geodetic)
+  lc = LocalCoord.from_geodetic([37.7749, -122.4194, 0.])
+
+  cases = [
+    ("euler2quat", t.euler2quat_single, t.euler2quat_batch, (3,), (4,), (), euler),
+    ("quat2euler", t.quat2euler_single, t.quat2euler_batch, (4,), (3,), (), quats),
+    ("quat2rot", t.quat2rot_single, t.quat2rot_batch, (4,), (3, 3), (), quats),
+    ("rot2quat", t.rot2quat_single, t.rot2quat_batch, (3, 3), (4,), (), rots),
+    ("euler2rot", t.euler2rot_single, t.euler2rot_batch, (3,), (3, 3), (), euler),
+    ("rot2euler", t.rot2euler_single, t.rot2euler_batch, (3, 3), (3,), (), rots),
+    ("geodetic2ecef", t.geodetic2ecef_single, t.geodetic2ecef_batch, (3,), (3,), (), geodetic),
+    ("ecef2geodetic", t.ecef2geodetic_single, t.ecef2geodetic_batch, (3,), (3,), (), ecef),
+    ("ecef2ned", t.LocalCoord.ecef2ned_single, t.LocalCoord.ecef2ned_batch, (3,), (3,), (lc,), ecef),
+    ("ned2geodetic", t.LocalCoord.ned2geodetic_single, t.LocalCoord.ned2geodetic_batch, (3,), (3,), (lc,), ecef - ecef.mean(axis=0)),
+  ]
+
+  print(f"{args.rows} rows")
+  for name, single, batch, input_shape, output_shape, extra, inp in cases:
+    before = timeit(numpy_wrap(single, input_shape, output_shape), *extra, inp)
+    after = timeit(batch_wrap(batch, input_shape, output_shape), *extra, inp)
+    out = np.empty((len(inp),) + output_shape)
+    after_out = timeit(batch_wrap(batch, input_shape, output_shape), *extra, inp, out=out)
+    print(f"{name:>14}: per row {before * 1e3:8.1f} ms, batch {after * 1e3:6.1f} ms, batch into out {after_out * 1e3:6.1f} ms")
@@ -65,6 +65,8 @@ KONIK_PATH = Path("/cache/use_konik")
 MAPD_PATH = Path("/data/media/0/osm/mapd")
 MAPS_PATH = Path("/data/media/0/osm/offline")
 
+SPEED_LIMITS_PATH = Path("/data/speed_limits/speed_limits.db")
+
 NEURAL_PARAMS_PATH = Path(BASEDIR) / "selfdrive/car/torque_data/neural_ff_weights.json"
 TORQUE_NN_MODEL_PATH = Path(BASEDIR) / "frogpilot/assets/nnff_models"
 
@@ -1,82 +1,108 @@
 #!/usr/bin/env python3
 # PFEIFER - MTSC - Modified by FrogAi for FrogPilot
 import json
-import math
+import numpy as np
 
 from openpilot.common.conversions import Conversions as CV
+from openpilot.common.realtime import DT_MDL
 
 from openpilot.frogpilot.common.frogpilot_utilities import calculate_distance_to_point
-from openpilot.frogpilot.common.frogpilot_variables import PLANNER_TIME, params_memory
+from openpilot.frogpilot.common.frogpilot_variables import EARTH_RADIUS, PLANNER_TIME, params_memory
 
-def calculate_curvature(p1, p2, p3):
-  lat1, lon1 = p1
-  lat2, lon2 = p2
-  lat3, lon3 = p3
+def calculate_distances(lat1, lon1, lat2, lon2):
+  # calculate_distance_to_point over arrays, coordinates in radians
+  a = (np.sin((lat2 - lat1) / 2) ** 2) + np.cos(lat1) * np.cos(lat2) * (np.sin((lon2 - lon1) / 2) ** 2)
+  return EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
-  lat1_rad, lon1_rad = lat1 * CV.DEG_TO_RAD, lon1 * CV.DEG_TO_RAD
-  lat2_rad, lon2_rad = lat2 * CV.DEG_TO_RAD, lon2 * CV.DEG_TO_RAD
-  lat3_rad, lon3_rad = lat3 * CV.DEG_TO_RAD, lon3 * CV.DEG_TO_RAD
-
-  side_a = calculate_distance_to_point(lat2_rad, lon2_rad, lat3_rad, lon3_rad)
-  side_b = calculate_distance_to_point(lat1_rad, lon1_rad, lat3_rad, lon3_rad)
-  side_c = calculate_distance_to_point(lat1_rad, lon1_rad, lat2_rad, lon2_rad)
+def calculate_curvatures(latitudes, longitudes):
+  # curvature of the circle through every point and its neighbours, zero at both ends, coordinates in radians
+  side_a = calculate_distances(latitudes[1:-1], longitudes[1:-1], latitudes[2:], longitudes[2:])
+  side_b = calculate_distances(latitudes[:-2], longitudes[:-2], latitudes[2:], longitudes[2:])
+  side_c = calculate_distances(latitudes[:-2], longitudes[:-2], latitudes[1:-1], longitudes[1:-1])
 
   s = (side_a + side_b + side_c) / 2
-
   area_squared = s * (s - side_a) * (s - side_b) * (s - side_c)
-  if area_squared <= 0:
-    return 0
-
-  area = math.sqrt(area_squared)
 
-  radius = (side_a * side_b * side_c) / (4 * area)
-  if radius == 0:
-    return 0
-
-  curvature = 1 / radius
-  return curvature
+  curvatures = np.zeros(len(latitudes))
+  valid = area_squared > 0
+  curvatures[1:-1][valid] = 1 / ((side_a[valid] * side_b[valid] * side_c[valid]) / (4 * np.sqrt(area_squared[valid])))
+  return curvatures
 
 class MapTurnSpeedController:
+  def __init__(self):
+    self.target_velocities_raw = None
+
+    # the mapd path as arrays, rebuilt only when mapd publishes new target velocities
+    self.latitudes = np.empty(0)
+    self.longitudes = np.empty(0)
+    self.curvatures = np.empty(0)
+    self.path_lengths = np.empty(0)
+
+    self.nearest_idx = None
+    self.nearest_distance = None
+
+  def update_target_velocities(self):
+    target_velocities_raw = params_memory.get("MapTargetVelocities")
+    if target_velocities_raw == self.target_velocities_raw:
+      return
+    self.target_velocities_raw = target_velocities_raw
+
+    target_velocities = json.loads(target_velocities_raw or "[]")
+    self.latitudes = np.array([target_velocity["latitude"] for target_velocity in target_velocities], dtype=float) * CV.DEG_TO_RAD
+    self.longitudes = np.array([target_velocity["longitude"] for target_velocity in target_velocities], dtype=float) * CV.DEG_TO_RAD
+    self.curvatures = calculate_curvatures(self.latitudes, self.longitudes) if len(target_velocities) >= 3 else np.zeros(len(target_velocities))
+    segment_lengths = calculate_distances(self.latitudes[:-1], self.longitudes[:-1], self.latitudes[1:], self.longitudes[1:])
+    self.path_lengths = np.concatenate(([0.0], np.cumsum(segment_lengths)))
+    self.nearest_idx = None
+
+  def get_nearest_idx(self, latitude, longitude, v_ego):
+    def distance(i):
+      return calculate_distance_to_point(latitude, longitude, self.latitudes[i], self.longitudes[i])
+
+    if self.nearest_idx is not None:
+      # the car moves a few meters per cycle, so walk from the last nearest point instead of searching the whole path
+      idx = self.nearest_idx
+      nearest_distance = distance(idx)
+      for step in (1, -1):
+        while 0 <= idx + step < len(self.latitudes) and (next_distance := distance(idx + step)) < nearest_distance:
+          idx += step
+          nearest_distance = next_distance
+
+      # further than the car could have moved since the last cycle means the walk is stuck on a stale local minimum
+      if nearest_distance < 1000.0 and nearest_distance - self.nearest_distance <= v_ego * DT_MDL:
+        self.nearest_idx, self.nearest_distance = idx, nearest_distance
+        return idx, nearest_distance
+
+    distances = calculate_distances(latitude, longitude, self.latitudes, self.longitudes)
+    self.nearest_idx = int(np.argmin(distances))
+    self.nearest_distance = distances[self.nearest_idx]
+    return self.nearest_idx, self.nearest_distance
+
   def get_map_curvature(self, gps_position, v_ego):
     if not gps_position:
       return 1e-6
-    current_latitude = gps_position["latitude"]
-    current_longitude = gps_position["longitude"]
 
-    distances = []
-    minimum_idx = 0
-    minimum_distance = 1000.0
-
-    target_velocities = json.loads(params_memory.get("MapTargetVelocities") or "[]")
-    for i, target_velocity in enumerate(target_velocities):
-      target_latitude = target_velocity["latitude"]
-      target_longitude = target_velocity["longitude"]
-
-      distance = calculate_distance_to_point(current_latitude * CV.DEG_TO_RAD, current_longitude * CV.DEG_TO_RAD, target_latitude * CV.DEG_TO_RAD, target_longitude * CV.DEG_TO_RAD)
-      distances.append(distance)
-
-      if distance < minimum_distance:
-        minimum_distance = distance
-        minimum_idx = i
+    self.update_target_velocities()
+    if len(self.latitudes) == 0:
+      return 1e-6
 
-    forward_distances = distances[minimum_idx:]
+    current_latitude = gps_position["latitude"] * CV.DEG_TO_RAD
+    current_longitude = gps_position["longitude"] * CV.DEG_TO_RAD
 
-    cumulative_distance = 0.0
-    target_idx = None
+    minimum_idx, minimum_distance = self.get_nearest_idx(current_latitude, current_longitude, v_ego)
+    if minimum_distance >= 1000.0:
+      minimum_idx = 0
 
-    for i, distance in enumerate(forward_distances):
-      cumulative_distance += distance
-      if cumulative_distance >= PLANNER_TIME * v_ego:
-        target_idx = i
-        break
+    # two consecutive distances from the car add up to at least the segment between their points,
+    # so the sum below reaches the planner distance within twice that distance along the path
+    planner_distance = PLANNER_TIME * v_ego
+    end_idx = int(np.searchsorted(self.path_lengths, self.path_lengths[minimum_idx] + 2 * planner_distance)) + 1
 
-    forward_points = target_velocities[minimum_idx:]
+    # the first point ahead whose summed distances from the car reach where the planner will be
+    forward_distances = calculate_distances(current_latitude, current_longitude, self.latitudes[minimum_idx:end_idx], self.longitudes[minimum_idx:end_idx])
+    target_idx = int(np.searchsorted(np.cumsum(forward_distances), planner_distance))
 
-    if target_idx is None or target_idx == 0 or target_idx >= len(forward_points) - 1:
+    if target_idx == 0 or target_idx >= len(self.latitudes) - minimum_idx - 1:
       return 1e-6
 
-    p1 = (forward_points[target_idx - 1]["latitude"], forward_points[target_idx - 1]["longitude"])
-    p2 = (forward_points[target_idx]["latitude"], forward_points[target_idx]["longitude"])
-    p3 = (forward_points[target_idx + 1]["latitude"], forward_points[target_idx + 1]["longitude"])
-
-    return max(calculate_curvature(p1, p2, p3), 1e-6)
+    return max(self.curvatures[minimum_idx + target_idx], 1e-6)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import time
+
+import numpy as np
+
+from openpilot.common.git import load_module_at
+
+from openpilot.frogpilot.common.frogpilot_variables import params_memory
+from openpilot.frogpilot.controls.lib.map_turn_speed_controller import MapTurnSpeedController
+
+METERS_PER_DEG_LAT = 111_320
+
+
+def make_path(points: int, spacing: float) -> list[dict]:
+  rng = np.random.default_rng(0)
+  heading, latitude, longitude = 0.0, 40.0, -80.0
+  path = []
+  for _ in range(points):
+    heading += rng.normal(0, 0.05)
+    latitude += spacing * math.cos(heading) / METERS_PER_DEG_LAT
+    longitude += spacing * math.sin(heading) / (METERS_PER_DEG_LAT * math.cos(math.radians(latitude)))
+    path.append({"latitude": latitude, "longitude": longitude, "velocity": 25.0})
+  return path
+
+
+def benchmark(mtsc: MapTurnSpeedController, path: list[dict], cycles: int, v_ego: float) -> float:
+  # drive along the path, mapd republishing the target velocities every 20 planner cycles
+  elapsed = 0.0
+  for cycle in range(cycles):
+    if cycle % 20 == 0:
+      params_memory.put("MapTargetVelocities", json.dumps(path))
+
+    point = path[min(cycle // 4, len(path) - 1)]
+    t = time.perf_counter()
+    mtsc.get_map_curvature(point, v_ego)
+    elapsed += time.perf_counter() - t
+  return elapsed / cycles
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Per-cycle cost of MapTurnSpeedController.get_map_curvature")
+  parser.add_argument("--points", type=int, default=500)
+  parser.add_argument("--cycles", type=int, default=2000)
+  parser.add_argument("--baseline", help="commit to compare against, the controller is loaded as of that commit")
+  args = parser.parse_args()
+
+  runs = [("current", MapTurnSpeedController)]
+  if args.baseline:
+    runs.insert(0, (args.baseline, load_module_at("frogpilot/controls/lib/map_turn_speed_controller.py", args.baseline).MapTurnSpeedController))
+
+  path = make_path(args.points, spacing=10.0)
+  for name, cls in runs:
+    print(f"{name:>10}: {benchmark(cls(), path, args.cycles, v_ego=25.0) * 1e6:8.1f} us per cycle")
+  params_memory.remove("MapTargetVelocities")
@@ -4,7 +4,7 @@ import math
 import requests
 import time
 
-from collections import OrderedDict, deque
+from collections import defaultdict, deque
 from datetime import datetime, timedelta, timezone
 
 import openpilot.system.sentry as sentry
@@ -13,14 +13,15 @@ from cereal import log, messaging
 
 from openpilot.frogpilot.common.frogpilot_utilities import calculate_distance_to_point, calculate_lane_width, is_url_pingable
 from openpilot.frogpilot.common.frogpilot_variables import params, params_memory
+from openpilot.frogpilot.system.speed_limit_store import MAX_ENTRIES, SpeedLimitStore
 
 NetworkType = log.DeviceState.NetworkType
 
 BOUNDING_BOX_RADIUS_DEGREE = 0.1
-MAX_ENTRIES = 1_000_000
 MAX_OVERPASS_DATA_BYTES = 1_073_741_824
 MAX_OVERPASS_REQUESTS = 10_000
 METERS_PER_DEG_LAT = 111_320
+SEGMENT_GRID_DEGREE = 0.01
 VETTING_INTERVAL_DAYS = 7
 
 OVERPASS_API_URL = "https://overpass-api.de/api/interpreter"
@@ -32,9 +33,13 @@ class MapSpeedLogger:
     self.previous_coordinates = None
 
     self.cached_segments = {}
+    self.segment_grid = defaultdict(set)
 
     self.dataset_additions = deque(maxlen=MAX_ENTRIES)
 
+    self.store = SpeedLimitStore()
+    self.store.migrate_params()
+
     self.overpass_requests = json.loads(params.get("OverpassRequests") or "{}")
     self.overpass_requests.setdefault("day", datetime.now(timezone.utc).day)
     self.overpass_requests.setdefault("total_bytes", 0)
@@ -54,27 +59,6 @@ class MapSpeedLogger:
   def should_stop_processing(self):
     return self.sm["deviceState"].started or not params_memory.get_bool("UpdateSpeedLimits")
 
-  @staticmethod
-  def cleanup_dataset(dataset):
-    cleaned_data = OrderedDict()
-
-    for item in dataset:
-      if "last_vetted" in item:
-        required = {"incorrect_limit", "last_vetted", "segment_id", "source", "speed_limit", "start_coordinates"}
-      else:
-        required = {"bearing", "end_coordinates", "incorrect_limit", "road_name", "road_width", "source", "speed_limit", "start_coordinates"}
-
-      if not required.issubset(item.keys()):
-        continue
-
-      entry_copy = item.copy()
-      entry_copy.pop("last_vetted", None)
-
-      key = json.dumps(entry_copy, sort_keys=True)
-      cleaned_data[key] = item
-
-    return deque(cleaned_data.values(), maxlen=MAX_ENTRIES)
-
   @staticmethod
   def meters_to_deg_lat(meters):
     return meters / METERS_PER_DEG_LAT
@@ -113,10 +97,25 @@ class MapSpeedLogger:
         "total_bytes": 0,
       })
 
-  def update_params(self, dataset, filtered_dataset):
+  def reset_cached_segments(self):
+    self.cached_box = None
+    self.cached_segments.clear()
+    self.segment_grid.clear()
+
+  def index_segment(self, segment_id, bounds):
+    # add the segment to every grid cell its bounding box overlaps, clipped to the fetched area
+    min_lat, max_lat, min_lon, max_lon = bounds
+    min_lat = max(min_lat, self.cached_box["min_latitude"] - SEGMENT_GRID_DEGREE)
+    max_lat = min(max_lat, self.cached_box["max_latitude"] + SEGMENT_GRID_DEGREE)
+    min_lon = max(min_lon, self.cached_box["min_longitude"] - SEGMENT_GRID_DEGREE)
+    max_lon = min(max_lon, self.cached_box["max_longitude"] + SEGMENT_GRID_DEGREE)
+
+    for row in range(math.floor(min_lat / SEGMENT_GRID_DEGREE), math.floor(max_lat / SEGMENT_GRID_DEGREE) + 1):
+      for column in range(math.floor(min_lon / SEGMENT_GRID_DEGREE), math.floor(max_lon / SEGMENT_GRID_DEGREE) + 1):
+        self.segment_grid[(row, column)].add(segment_id)
+
+  def update_params(self):
     params.put("OverpassRequests", json.dumps(self.overpass_requests))
-    params.put("SpeedLimits", json.dumps(list(dataset)))
-    params.put("SpeedLimitsFiltered", json.dumps(list(filtered_dataset)))
 
   def wait_for_api(self):
     while not is_url_pingable(OVERPASS_STATUS_URL):
@@ -135,8 +134,8 @@ class MapSpeedLogger:
     min_lon = longitude - BOUNDING_BOX_RADIUS_DEGREE
     max_lon = longitude + BOUNDING_BOX_RADIUS_DEGREE
 
+    self.reset_cached_segments()
     self.cached_box = {"min_latitude": min_lat, "max_latitude": max_lat, "min_longitude": min_lon, "max_longitude": max_lon}
-    self.cached_segments.clear()
 
     query = (
       f"[out:json][timeout:90][maxsize:{MAX_OVERPASS_DATA_BYTES // 10}];"
@@ -163,7 +162,6 @@ class MapSpeedLogger:
       return response.json().get("elements", [])
     except requests.exceptions.RequestException as exception:
       print(f"Overpass API request failed: {exception}")
-      self.cached_segments.clear()
       return []
 
   def filter_segments_for_entry(self, entry):
@@ -187,15 +185,17 @@ class MapSpeedLogger:
     min_lon = min(start_lon, end_lon) - abs(delta_lon_fwd) - abs(delta_lon_side)
     max_lon = max(start_lon, end_lon) + abs(delta_lon_fwd) + abs(delta_lon_side)
 
-    relevant_segments = []
-    for segment in self.cached_segments.values():
-      if not segment or "nodes" not in segment:
-        continue
+    candidates = set()
+    for row in range(math.floor(min_lat / SEGMENT_GRID_DEGREE), math.floor(max_lat / SEGMENT_GRID_DEGREE) + 1):
+      for column in range(math.floor(min_lon / SEGMENT_GRID_DEGREE), math.floor(max_lon / SEGMENT_GRID_DEGREE) + 1):
+        candidates |= self.segment_grid.get((row, column), set())
 
-      latitudes = [node[0] for node in segment["nodes"]]
-      longitudes = [node[1] for node in segment["nodes"]]
+    relevant_segments = []
+    for segment_id in sorted(candidates):
+      segment = self.cached_segments[segment_id]
+      seg_min_lat, seg_max_lat, seg_min_lon, seg_max_lon = segment["bounds"]
 
-      if not (max(latitudes) < min_lat or min(latitudes) > max_lat or max(longitudes) < min_lon or min(longitudes) > max_lon):
+      if not (seg_max_lat < min_lat or seg_min_lat > max_lat or seg_max_lon < min_lon or seg_min_lon > max_lon):
         relevant_segments.append(segment)
 
     return relevant_segments
@@ -253,12 +253,10 @@ class MapSpeedLogger:
 
     self.previous_coordinates = {"latitude": current_latitude, "longitude": current_longitude}
 
-  def process_new_entries(self, dataset, filtered_dataset):
-    existing_segment_ids = {entry["segment_id"] for entry in filtered_dataset if "segment_id" in entry}
-    entries_to_process = list(dataset)
-    total_entries = len(entries_to_process)
+  def process_new_entries(self):
+    total_entries = self.store.entry_count()
 
-    for i, entry in enumerate(entries_to_process):
+    for i, (entry_id, entry) in enumerate(self.store.iter_entries()):
       self.sm.update()
 
       if self.should_stop_processing:
@@ -275,18 +273,16 @@ class MapSpeedLogger:
       self.update_cached_segments(start_coords["latitude"], start_coords["longitude"])
       segments = self.filter_segments_for_entry(entry)
 
-      dataset.remove(entry)
-
       for segment in segments:
         segment_id = segment["segment_id"]
-        if segment_id in existing_segment_ids:
+        if self.store.has_segment(segment_id):
           continue
         if segment["maxspeed"] and not entry.get("incorrect_limit"):
           continue
         if segment["road_name"] != entry.get("road_name"):
           continue
 
-        filtered_dataset.append({
+        self.store.put_segment({
           "incorrect_limit": entry.get("incorrect_limit"),
           "last_vetted": datetime.now(timezone.utc).isoformat(),
           "segment_id": segment_id,
@@ -294,10 +290,11 @@ class MapSpeedLogger:
           "speed_limit": entry["speed_limit"],
           "start_coordinates": entry["start_coordinates"],
         })
-        existing_segment_ids.add(segment_id)
+
+      self.store.remove_entry(entry_id)
 
       if i % 100 == 0:
-        self.update_params(dataset, filtered_dataset)
+        self.update_params()
 
   def process_speed_limits(self):
     self.reset_daily_api_limits()
@@ -305,20 +302,18 @@ class MapSpeedLogger:
     if not self.wait_for_api():
       return
 
-    self.cached_box, self.cached_segments = None, {}
-
-    dataset = self.cleanup_dataset(json.loads(params.get("SpeedLimits") or "[]"))
-    filtered_dataset = self.cleanup_dataset(json.loads(params.get("SpeedLimitsFiltered") or "[]"))
+    self.reset_cached_segments()
 
-    filtered_dataset = self.vet_entries(filtered_dataset)
-    self.update_params(dataset, filtered_dataset)
+    self.vet_entries()
+    self.update_params()
 
-    if dataset and not self.should_stop_processing:
-      self.cached_box, self.cached_segments = None, {}
+    if self.store.entry_count() and not self.should_stop_processing:
+      self.reset_cached_segments()
       params_memory.put("UpdateSpeedLimitsStatus", "Calculating...")
-      self.process_new_entries(dataset, filtered_dataset)
+      self.process_new_entries()
 
-    self.update_params(dataset, filtered_dataset)
+    self.update_params()
+    self.store.compact()
     params_memory.put("UpdateSpeedLimitsStatus", "Completed!")
     params_memory.remove("UpdateSpeedLimits")
 
@@ -331,36 +326,36 @@ class MapSpeedLogger:
           if vetting:
             self.cached_segments[segment_id] = tags.get("maxspeed")
           elif "geometry" in way and (nodes := way["geometry"]):
+            latitudes = [node["lat"] for node in nodes]
+            longitudes = [node["lon"] for node in nodes]
+            bounds = (min(latitudes), max(latitudes), min(longitudes), max(longitudes))
+
             self.cached_segments[segment_id] = {
+              "bounds": bounds,
               "maxspeed": tags.get("maxspeed"),
-              "nodes": [(node["lat"], node["lon"]) for node in nodes],
               "road_name": tags.get("name"),
               "segment_id": segment_id,
             }
+            self.index_segment(segment_id, bounds)
 
-  def vet_entries(self, filtered_dataset):
-    dataset_list = list(filtered_dataset)
-    total_to_vet = len(filtered_dataset)
-    vetted_entries = deque(maxlen=MAX_ENTRIES)
+  def vet_entries(self):
+    total_to_vet = self.store.segment_count()
 
-    for i, entry in enumerate(dataset_list):
+    for i, entry in enumerate(self.store.iter_segments()):
       self.sm.update()
 
       if self.should_stop_processing:
-        vetted_entries.extend(dataset_list[i:])
         break
 
       if not self.can_make_overpass_request:
         params_memory.put("UpdateSpeedLimitsStatus", "Hit API limit...")
         time.sleep(5)
-        vetted_entries.extend(dataset_list[i:])
         break
 
       params_memory.put("UpdateSpeedLimitsStatus", f"Vetting: {i + 1} / {total_to_vet}")
 
       last_vetted_time = datetime.fromisoformat(entry["last_vetted"])
       if datetime.now(timezone.utc) - last_vetted_time < timedelta(days=VETTING_INTERVAL_DAYS):
-        vetted_entries.append(entry)
         continue
 
       start_coords = entry["start_coordinates"]
@@ -369,9 +364,9 @@ class MapSpeedLogger:
       current_maxspeed = self.cached_segments.get(entry["segment_id"])
       if current_maxspeed is None or (entry.get("incorrect_limit") and current_maxspeed != entry.get("speed_limit")):
         entry["last_vetted"] = datetime.now(timezone.utc).isoformat()
-        vetted_entries.append(entry)
-
-    return self.cleanup_dataset(list(vetted_entries))
+        self.store.put_segment(entry)
+      else:
+        self.store.remove_segment(entry["segment_id"])
 
 def main():
   logger = MapSpeedLogger()
@@ -387,11 +382,7 @@ def main():
 
         previously_started = True
       elif previously_started:
-        existing_dataset = json.loads(params.get("SpeedLimits") or "[]")
-        existing_dataset.extend(logger.dataset_additions)
-
-        new_dataset = logger.cleanup_dataset(existing_dataset)
-        params.put("SpeedLimits", json.dumps(list(new_dataset)))
+        logger.store.add_entries(logger.dataset_additions)
 
         if logger.sm["deviceState"].networkType in (NetworkType.ethernet, NetworkType.wifi):
           params_memory.put_bool("UpdateSpeedLimits", True)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import math
+import sqlite3
+
+from collections.abc import Iterable, Iterator
+
+from openpilot.frogpilot.common.frogpilot_variables import SPEED_LIMITS_PATH, params
+
+# entries are ordered by grid cell so consecutive ones fall in the same Overpass bounding box
+GRID_CELL_DEGREES = 0.1
+BATCH_SIZE = 1000
+MAX_ENTRIES = 1_000_000
+
+ENTRY_KEYS = {"bearing", "end_coordinates", "incorrect_limit", "road_name", "road_width", "source", "speed_limit", "start_coordinates"}
+SEGMENT_KEYS = {"incorrect_limit", "last_vetted", "segment_id", "source", "speed_limit", "start_coordinates"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, cell INTEGER NOT NULL, entry TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_cell ON entries (cell, id);
+CREATE TABLE IF NOT EXISTS segments (segment_id INTEGER PRIMARY KEY, cell INTEGER NOT NULL, entry TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS segments_cell ON segments (cell, segment_id);
+"""
+
+
+def grid_cell(coordinates: dict) -> int:
+  row = math.floor((coordinates["latitude"] + 90) / GRID_CELL_DEGREES)
+  column = math.floor((coordinates["longitude"] + 180) / GRID_CELL_DEGREES)
+  return row * round(360 / GRID_CELL_DEGREES) + column
+
+
+class SpeedLimitStore:
+  # On-disk dataset for speed_limit_filler. Drives append their entries to "entries", deduplicated by content, and
+  # processing moves them into "segments", keyed by OSM segment id. Both are read back in grid cell order a batch at
+  # a time, so memory stays flat no matter how large the dataset grows.
+
+  def __init__(self, path=SPEED_LIMITS_PATH):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self.db = sqlite3.connect(path, timeout=60)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(SCHEMA)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self) -> None:
+    self.db.close()
+
+  def add_entries(self, entries: Iterable[dict]) -> int:
+    rows = []
+    for entry in entries:
+      if not ENTRY_KEYS.issubset(entry.keys()):
+        continue
+      key = hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+      rows.append((key, grid_cell(entry["start_coordinates"]), json.dumps(entry)))
+
+    with self.db:
+      before = self.db.total_changes
+      self.db.executemany("INSERT OR IGNORE INTO entries (key, cell, entry) VALUES (?, ?, ?)", rows)
+      added = self.db.total_changes - before
+      # drop the oldest entries past the limit
+      self.db.execute("DELETE FROM entries WHERE id IN (SELECT id FROM entries ORDER BY id LIMIT max((SELECT COUNT(*) FROM entries) - ?, 0))",
+                      (MAX_ENTRIES,))
+    return added
+
+  def entry_count(self) -> int:
+    return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+  def iter_entries(self) -> Iterator[tuple[int, dict]]:
+    # (id, entry) in grid cell order, safe to remove entries while iterating
+    last = (-1, -1)
+    while rows := self.db.execute("SELECT cell, id, entry FROM entries WHERE (cell, id) > (?, ?) ORDER BY cell, id LIMIT ?",
+                                  (*last, BATCH_SIZE)).fetchall():
+      for _, entry_id, entry in rows:
+        yield entry_id, json.loads(entry)
+      last = rows[-1][:2]
+
+  def remove_entry(self, entry_id: int) -> None:
+    with self.db:
+      self.db.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+
+  def has_segment(self, segment_id: int) -> bool:
+    return self.db.execute("SELECT 1 FROM segments WHERE segment_id = ?", (segment_id,)).fetchone() is not None
+
+  def put_segments(self, entries: Iterable[dict]) -> None:
+    rows = [(entry["segment_id"], grid_cell(entry["start_coordinates"]), json.dumps(entry))
+            for entry in entries if SEGMENT_KEYS.issubset(entry.keys())]
+    with self.db:
+      self.db.executemany("INSERT OR REPLACE INTO segments (segment_id, cell, entry) VALUES (?, ?, ?)", rows)
+
+  def put_segment(self, entry: dict) -> None:
+    self.put_segments([entry])
+
+  def remove_segment(self, segment_id: int) -> None:
+    with self.db:
+      self.db.execute("DELETE FROM segments WHERE segment_id = ?", (segment_id,))
+
+  def segment_count(self) -> int:
+    return self.db.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+
+  def iter_segments(self) -> Iterator[dict]:
+    # entries in grid cell order, safe to update or remove segments while iterating
+    last = (-1, -1)
+    while rows := self.db.execute("SELECT cell, segment_id, entry FROM segments WHERE (cell, segment_id) > (?, ?) ORDER BY cell, segment_id LIMIT ?",
+                                  (*last, BATCH_SIZE)).fetchall():
+      for _, _, entry in rows:
+        yield json.loads(entry)
+      last = rows[-1][:2]
+
+  def set_last_vetted(self, last_vetted: str) -> None:
+    with self.db:
+      self.db.execute("UPDATE segments SET entry = json_set(entry, '$.last_vetted', ?)", (last_vetted,))
+
+  def compact(self) -> None:
+    # give back the space of processed entries and fold the WAL into the database
+    self.db.execute("VACUUM")
+    self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+  def migrate_params(self) -> None:
+    # the dataset used to be stored as JSON lists in params
+    for key, add in (("SpeedLimits", self.add_entries), ("SpeedLimitsFiltered", self.put_segments)):
+      if (data := params.get(key)) is not None:
+        add(json.loads(data))
+        params.remove(key)
@@ -8,7 +8,6 @@ const state = reactive({
   routes: [],
   selectedRoute: null,
   showPreservedOnly: false,
-  progress: 0,
   total: 0,
   showDeleteAllModal: false,
   isDeletingAll: false,
@@ -31,57 +30,47 @@ function formatRouteDate(dateString) {
   return `${month} ${day}${getOrdinalSuffix(day)}, ${year} - ${hour}:${minuteStr}${ampm}`
 }
 
+// bumped by refresh() so a page that was still loading doesn't land in the new list
+let generation = 0
+
 async function fetchRoutes() {
+  const requested = generation
   try {
-    const userTimezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
-    const response = await fetch(`/api/routes?timezone=${encodeURIComponent(userTimezone)}`);
+    const params = new URLSearchParams({ offset: state.routes.length })
+    if (state.showPreservedOnly) params.set("preserved", "1")
+    const response = await fetch(`/api/routes?${params}`);
     if (!response.ok) throw new Error();
 
-    const reader = response.body.getReader();
-    const decoder = new TextDecoder();
-    let buffer = "";
-
-    while (true) {
-      const { value, done } = await reader.read();
-      if (done) break;
-
-      buffer += decoder.decode(value, { stream: true });
-      const lines = buffer.split("\n\n");
-      buffer = lines.pop();
-
-      for (const line of lines) {
-        if (line.startsWith("data: ")) {
-          try {
-            const data = JSON.parse(line.substring(6));
-            if (data.progress !== undefined && data.total !== undefined) {
-              state.progress = data.progress;
-              state.total = data.total;
-            }
-            if (data.routes) {
-              const routes = data.routes.map(route => ({
-                ...route,
-                timestamp: formatRouteDate(route.timestamp),
-              }));
-              state.routes.push(...routes);
-            }
-          } catch (e) {
-            console.error("Failed to parse JSON:", e);
-          }
-        }
-      }
-    }
+    const data = await response.json();
+    if (requested !== generation) return;
+
+    const routes = data.routes.map(route => ({
+      ...route,
+      timestamp: formatRouteDate(route.timestamp),
+    }));
+    state.routes.push(...routes);
+    state.total = data.total;
   } catch (_) {
-    state.error = "Couldn't load routes. Please try again later..."
+    if (requested === generation) state.error = "Couldn't load routes. Please try again later..."
   } finally {
-    state.loading = false
+    if (requested === generation) state.loading = false
   }
 }
 
 fetchRoutes()
 
 function refresh() {
+  generation++
   state.loading = true
+  state.error = null
   state.routes = []
+  state.total = 0
+  fetchRoutes()
+}
+
+function loadMoreRoutes() {
+  if (state.loading) return
+  state.loading = true
   fetchRoutes()
 }
 
@@ -327,7 +316,10 @@ export function RouteRecordings() {
         <div class="screen-recordings-title">Dashcam Routes</div>
         <button
           class="show-preserved-button"
-          @click="${() => (state.showPreservedOnly = !state.showPreservedOnly)}"
+          @click="${() => {
+            state.showPreservedOnly = !state.showPreservedOnly;
+            refresh();
+          }}"
           ?disabled="${state.loading && state.routes.length === 0}"
         >
           ${() => (state.showPreservedOnly ? "Show All" : "Show Only Preserved Routes")}
@@ -337,9 +329,6 @@ export function RouteRecordings() {
           const routesToShow = state.routes.filter(r => !state.showPreservedOnly || r.is_preserved);
 
           if (routesToShow.length === 0) {
-            if (state.loading && state.total > 0) {
-              return html`<p class="screen-recordings-message">Processing Routes: ${state.progress} of ${state.total}</p>`;
-            }
             if (state.loading && !state.isDeletingAll) {
               return html`<p class="screen-recordings-message">Loading...</p>`;
             }
@@ -410,6 +399,7 @@ export function RouteRecordings() {
                     <div class="recording-preview-container">
                       <img
                         src="${route.png}"
+                        loading="lazy"
                         class="recording-preview recording-preview-png"
                         style="display:block;"
                       >
@@ -426,6 +416,20 @@ export function RouteRecordings() {
             </div>
           `;
         }}
+        ${() => {
+          if (state.routes.length > 0 && state.routes.length < state.total) {
+            return html`
+              <button
+                class="show-preserved-button"
+                @click="${loadMoreRoutes}"
+                ?disabled="${state.loading}"
+              >
+                ${() => (state.loading ? "Loading..." : `Load More Routes (${state.routes.length} of ${state.total})`)}
+              </button>
+            `;
+          }
+          return "";
+        }}
         ${() => {
           if (state.routes.length > 0) {
             return html`
@@ -0,0 +1,341 @@
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+from openpilot.common.inotify import IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR, Inotify
+
+from openpilot.frogpilot.system.the_pond import utilities
+
+CATALOG_PATH = Path("/data/the_pond/route_catalog.db")
+
+# a directory modified this recently might change again within the same mtime tick, so it's rescanned next time
+RACY_MTIME_NS = 2 * 10**9
+WATCH_INTERVAL = 10
+
+PREVIEWS = {
+  "preview.gif": utilities.video_to_gif,
+  "preview.png": utilities.video_to_png,
+}
+PRIORITY_VISIBLE = 0  # a client is waiting on it
+PRIORITY_PAGE = 1  # on a page of routes a client just listed
+PRIORITY_BACKGROUND = 2
+
+CATALOG_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (footage_path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS segments (footage_path TEXT NOT NULL, route TEXT NOT NULL, segment_num INTEGER NOT NULL,
+                                     duration REAL, duration_mtime_ns INTEGER, PRIMARY KEY (footage_path, route, segment_num));
+CREATE TABLE IF NOT EXISTS routes (footage_path TEXT NOT NULL, route TEXT NOT NULL, custom_name TEXT, start_time REAL,
+                                   is_preserved INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, PRIMARY KEY (footage_path, route));
+CREATE INDEX IF NOT EXISTS routes_order ON routes (route DESC, footage_path);
+"""
+
+
+class Route(NamedTuple):
+  footage_path: str
+  name: str
+  custom_name: str | None
+  start_time: float | None
+  is_preserved: bool
+
+  @property
+  def segment_path(self) -> str:
+    return os.path.join(self.footage_path, f"{self.name}--0")
+
+  def summary(self) -> dict:
+    # the listing The Pond shows for a route
+    timestamp = self.custom_name
+    if not timestamp and self.start_time is not None:
+      timestamp = datetime.fromtimestamp(self.start_time).isoformat()
+
+    return {
+      "name": self.name,
+      "gif": f"/thumbnails/{self.name}--0/preview.gif",
+      "png": f"/thumbnails/{self.name}--0/preview.png",
+      "timestamp": timestamp,
+      "is_preserved": self.is_preserved,
+    }
+
+
+def read_route(footage_path: str, route: str) -> tuple:
+  segment_path = os.path.join(footage_path, f"{route}--0")
+  # taken first, so a file written while the route is read changes it again
+  try:
+    mtime_ns = os.stat(segment_path).st_mtime_ns
+  except OSError:
+    mtime_ns = -1
+  if time.time_ns() - mtime_ns < RACY_MTIME_NS:
+    mtime_ns = -1
+
+  try:
+    start_time = os.path.getctime(os.path.join(segment_path, "rlog"))
+  except OSError:
+    start_time = None
+
+  try:
+    is_preserved = utilities.has_preserve_attr(segment_path)
+  except OSError:
+    is_preserved = False
+
+  return utilities.get_custom_name(segment_path), start_time, is_preserved, mtime_ns
+
+
+class RouteCatalog:
+  """Persistent index of the routes in the footage paths for The Pond.
+
+  A footage path is only listed again when its mtime changes, and then only the segments that appeared or
+  disappeared are touched. start_watcher() keeps the catalog current with inotify so requests rarely have to scan.
+  """
+
+  def __init__(self, footage_paths: list[str], path=CATALOG_PATH):
+    self.footage_paths = list(dict.fromkeys(footage_paths))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    # the catalog can always be rebuilt from the footage paths, so an older layout is simply dropped
+    with self.db:
+      if self.db.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+        for table in ("directories", "segments", "routes"):
+          self.db.execute(f"DROP TABLE IF EXISTS {table}")
+        self.db.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+    self.db.executescript(SCHEMA)
+    self.lock = threading.Lock()
+
+    # drop paths that are no longer footage paths
+    placeholders = ",".join("?" * len(self.footage_paths))
+    with self.db:
+      for table in ("directories", "segments", "routes"):
+        self.db.execute(f"DELETE FROM {table} WHERE footage_path NOT IN ({placeholders})", self.footage_paths)
+
+  def refresh(self) -> None:
+    with self.lock:
+      for footage_path in self.footage_paths:
+        try:
+          mtime_ns = os.stat(footage_path).st_mtime_ns
+        except FileNotFoundError:
+          mtime_ns = -1
+
+        row = self.db.execute("SELECT mtime_ns FROM directories WHERE footage_path = ?", (footage_path,)).fetchone()
+        if row is None or row[0] != mtime_ns or mtime_ns == -1:
+          self._scan(footage_path, mtime_ns)
+
+        # routes that were listed before loggerd wrote their rlog, read again only once their first segment changed
+        for route, route_mtime_ns in self.db.execute("SELECT route, mtime_ns FROM routes WHERE footage_path = ? AND start_time IS NULL",
+                                                     (footage_path,)).fetchall():
+          try:
+            segment_mtime_ns = os.stat(os.path.join(footage_path, f"{route}--0")).st_mtime_ns
+          except OSError:
+            segment_mtime_ns = -1
+          if segment_mtime_ns != route_mtime_ns or route_mtime_ns == -1:
+            self._update_route(footage_path, route)
+
+  def _scan(self, footage_path: str, mtime_ns: int) -> None:
+    try:
+      entries = os.listdir(footage_path)
+    except FileNotFoundError:
+      entries = []
+
+    on_disk = set()
+    for entry in entries:
+      if utilities.SEGMENT_RE.fullmatch(entry):
+        route, segment_num = entry.rsplit("--", 1)
+        on_disk.add((route, int(segment_num)))
+
+    cataloged = set(self.db.execute("SELECT route, segment_num FROM segments WHERE footage_path = ?", (footage_path,)).fetchall())
+    added = on_disk - cataloged
+    removed = cataloged - on_disk
+
+    if time.time_ns() - mtime_ns < RACY_MTIME_NS:
+      mtime_ns = -1
+
+    with self.db:
+      self.db.executemany("DELETE FROM segments WHERE footage_path = ? AND route = ? AND segment_num = ?",
+                          [(footage_path, route, segment_num) for route, segment_num in removed])
+      self.db.executemany("INSERT INTO segments (footage_path, route, segment_num) VALUES (?, ?, ?)",
+                          [(footage_path, route, segment_num) for route, segment_num in added])
+      self.db.execute("INSERT OR REPLACE INTO directories (footage_path, mtime_ns) VALUES (?, ?)", (footage_path, mtime_ns))
+
+    # routes are listed by their first segment, which holds the preview and custom name
+    for route, segment_num in removed:
+      if segment_num == 0:
+        with self.db:
+          self.db.execute("DELETE FROM routes WHERE footage_path = ? AND route = ?", (footage_path, route))
+    for route, segment_num in added:
+      if segment_num == 0:
+        self._update_route(footage_path, route)
+
+  def _update_route(self, footage_path: str, route: str) -> None:
+    with self.db:
+      self.db.execute("INSERT OR REPLACE INTO routes (footage_path, route, custom_name, start_time, is_preserved, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)",
+                      (footage_path, route, *read_route(footage_path, route)))
+
+  def update_route(self, footage_path: str, route: str) -> None:
+    """Re-read a route after its name or preserve attribute changed"""
+    with self.lock:
+      if os.path.isdir(os.path.join(footage_path, f"{route}--0")):
+        self._update_route(footage_path, route)
+
+  def route_count(self) -> int:
+    with self.lock:
+      return self.db.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+
+  def preserved_count(self) -> int:
+    with self.lock:
+      return self.db.execute("SELECT COUNT(*) FROM routes WHERE is_preserved").fetchone()[0]
+
+  def get_routes(self, offset: int = 0, limit: int = -1, preserved_only: bool = False) -> list[Route]:
+    """Routes newest first"""
+    where = "WHERE is_preserved" if preserved_only else ""
+    with self.lock:
+      rows = self.db.execute(f"SELECT footage_path, route, custom_name, start_time, is_preserved FROM routes {where} ORDER BY route DESC, footage_path LIMIT ? OFFSET ?",
+                             (limit, offset)).fetchall()
+    return [Route(footage_path, route, custom_name, start_time, bool(is_preserved)) for footage_path, route, custom_name, start_time, is_preserved in rows]
+
+  def get_segments(self, footage_path: str, route: str) -> list[int]:
+    with self.lock:
+      rows = self.db.execute("SELECT segment_num FROM segments WHERE footage_path = ? AND route = ? ORDER BY segment_num",
+                             (footage_path, route)).fetchall()
+    return [segment_num for (segment_num,) in rows]
+
+  def get_duration(self, footage_path: str, route: str, segment_num: int) -> float:
+    # ffprobe only runs again if the video changed since it was last probed, e.g. the segment was still recording
+    video_path = os.path.join(footage_path, f"{route}--{segment_num}", "fcamera.hevc")
+    try:
+      mtime_ns = os.stat(video_path).st_mtime_ns
+    except FileNotFoundError:
+      mtime_ns = -1
+
+    key = (footage_path, route, segment_num)
+    with self.lock:
+      row = self.db.execute("SELECT duration, duration_mtime_ns FROM segments WHERE footage_path = ? AND route = ? AND segment_num = ?", key).fetchone()
+    if row is not None and row[0] is not None and row[1] == mtime_ns:
+      return row[0]
+
+    duration = utilities.get_video_duration(video_path)
+    with self.lock, self.db:
+      self.db.execute("UPDATE segments SET duration = ?, duration_mtime_ns = ? WHERE footage_path = ? AND route = ? AND segment_num = ?",
+                      (duration, mtime_ns, *key))
+    return duration
+
+  def start_watcher(self) -> threading.Thread:
+    thread = threading.Thread(target=self._watch, name="route_catalog", daemon=True)
+    thread.start()
+    return thread
+
+  def _watch(self) -> None:
+    # segments are directories in the footage paths, so only their creation and removal matter. The periodic
+    # refresh picks up footage paths that didn't exist yet, and is all there is if inotify isn't available.
+    mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+    try:
+      inotify = Inotify()
+    except OSError:
+      inotify = None
+
+    while True:
+      if inotify is not None:
+        watched = set(inotify.watches.values())
+        for footage_path in self.footage_paths:
+          if footage_path not in watched and os.path.isdir(footage_path):
+            try:
+              inotify.add_watch(footage_path, mask)
+            except OSError:
+              pass
+
+      try:
+        self.refresh()
+      except Exception as exception:
+        print(f"Error refreshing route catalog: {exception}")
+
+      if inotify is not None:
+        if inotify.read(timeout=WATCH_INTERVAL):
+          # let a burst of changes, like deleting a route, settle into one refresh
+          time.sleep(1)
+          inotify.read()
+      else:
+        time.sleep(WATCH_INTERVAL)
+
+
+class ThumbnailQueue:
+  """Bounded priority queue of route previews to generate in the background.
+
+  Requesting a preview that's already queued only raises its priority. When the queue is full, the lowest priority
+  job makes way for a more urgent one.
+  """
+
+  def __init__(self, workers: int = 2, max_jobs: int = 256):
+    self.max_jobs = max_jobs
+    self.condition = threading.Condition()
+    self.counter = itertools.count()
+    self.heap: list[tuple[int, int, str]] = []
+    self.jobs: dict[str, list] = {}  # output path -> [priority, sequence, done event]
+    self.running: dict[str, threading.Event] = {}
+
+    for i in range(workers):
+      threading.Thread(target=self._work, name=f"thumbnails_{i}", daemon=True).start()
+
+  def request(self, segment_path: str, preview: str, priority: int) -> threading.Event | None:
+    """Event set once the preview exists or failed to generate, None if the queue is full of more urgent jobs"""
+    output_path = os.path.join(segment_path, preview)
+    with self.condition:
+      if output_path in self.running:
+        return self.running[output_path]
+
+      done = threading.Event()
+      if os.path.exists(output_path):
+        done.set()
+        return done
+
+      job = self.jobs.get(output_path)
+      if job is not None:
+        if priority < job[0]:
+          job[0], job[1] = priority, next(self.counter)
+          heapq.heappush(self.heap, (job[0], job[1], output_path))
+        return job[2]
+
+      if len(self.jobs) >= self.max_jobs:
+        evicted = max(self.jobs, key=lambda path: self.jobs[path][:2])
+        if self.jobs[evicted][0] <= priority:
+          return None
+        self.jobs.pop(evicted)[2].set()
+
+      job = [priority, next(self.counter), done]
+      self.jobs[output_path] = job
+      heapq.heappush(self.heap, (job[0], job[1], output_path))
+      self.condition.notify()
+      return done
+
+  def _work(self) -> None:
+    while True:
+      with self.condition:
+        while True:
+          while not self.heap:
+            self.condition.wait()
+          priority, sequence, output_path = heapq.heappop(self.heap)
+          job = self.jobs.get(output_path)
+          # entries left behind by a priority bump or eviction
+          if job is not None and job[:2] == [priority, sequence]:
+            break
+        del self.jobs[output_path]
+        self.running[output_path] = done = job[2]
+
+      segment_path, preview = os.path.split(output_path)
+      input_path = os.path.join(segment_path, "qcamera.ts")
+      try:
+        if os.path.exists(input_path) and not os.path.exists(output_path):
+          PREVIEWS[preview](input_path, output_path)
+      except Exception as exception:
+        print(f"Error generating {output_path}: {exception}")
+      finally:
+        with self.condition:
+          del self.running[output_path]
+        done.set()
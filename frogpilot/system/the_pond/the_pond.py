@@ -31,7 +31,9 @@ from panda import Panda
 from openpilot.frogpilot.common.frogpilot_utilities import delete_file, get_lock_status, run_cmd
 from openpilot.frogpilot.common.frogpilot_variables import ERROR_LOGS_PATH, EXCLUDED_KEYS, SCREEN_RECORDINGS_PATH,\
                                                            frogpilot_default_params, params, update_frogpilot_toggles
+from openpilot.frogpilot.system.speed_limit_store import SpeedLimitStore
 from openpilot.frogpilot.system.the_pond import utilities
+from openpilot.frogpilot.system.the_pond.route_catalog import PREVIEWS, PRIORITY_BACKGROUND, PRIORITY_PAGE, PRIORITY_VISIBLE, RouteCatalog, ThumbnailQueue
 
 FOOTAGE_PATHS = [
   Paths.log_root(HD=True, raw=True),
@@ -46,9 +48,16 @@ KEYS = {
   "secret": ("secret", "sk.", "MapboxSecretKey", "Secret key", 80),
 }
 
+ROUTES_PAGE_SIZE = 50
+THUMBNAIL_TIMEOUT = 60
+
 TMUX_LOGS_PATH = Path("/data/tmux_logs")
 
 def setup(app):
+  catalog = RouteCatalog(FOOTAGE_PATHS)
+  catalog.start_watcher()
+  thumbnails = ThumbnailQueue()
+
   @app.errorhandler(404)
   def not_found(_):
     return render_template("index.html")
@@ -295,25 +304,21 @@ def setup(app):
 
   @app.route("/api/routes", methods=["GET"])
   def list_routes():
-    def generate():
-      routes = [(path, name) for path in FOOTAGE_PATHS for name in utilities.get_routes_names(path)]
-      total = len(routes)
-      yield f"data: {json.dumps({'progress': 0, 'total': total})}\n\n"
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", ROUTES_PAGE_SIZE, type=int), 1), ROUTES_PAGE_SIZE)
+    preserved_only = request.args.get("preserved", "0") == "1"
 
-      with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {executor.submit(utilities.process_route, path, name): (path, name) for path, name in routes}
-        for processed, future in enumerate(as_completed(futures), start=1):
-          try:
-            result = future.result()
-            yield f"data: {json.dumps({'routes': [result]})}\n\n"
-          except Exception as exception:
-            print(f"Error processing route: {exception}")
-          yield f"data: {json.dumps({'progress': processed, 'total': total})}\n\n"
+    catalog.refresh()
+    routes = catalog.get_routes(offset, limit, preserved_only)
+    total = catalog.preserved_count() if preserved_only else catalog.route_count()
 
-        for path, name in routes:
-          utilities.process_route_gif(path, name)
+    # the previews are made in the background, the ones on screen first
+    for route in routes:
+      thumbnails.request(route.segment_path, "preview.png", PRIORITY_PAGE)
+    for route in routes:
+      thumbnails.request(route.segment_path, "preview.gif", PRIORITY_BACKGROUND)
 
-    return Response(generate(), mimetype="text/event-stream")
+    return {"routes": [route.summary() for route in routes], "offset": offset, "total": total}, 200
 
   @app.route("/api/routes/<name>", methods=["DELETE"])
   def delete_route(name):
@@ -342,21 +347,15 @@ def setup(app):
 
   @app.route("/api/routes/<name>/preserve", methods=["POST"])
   def preserve_route(name):
-    preserved_routes = 0
-    for footage_path in FOOTAGE_PATHS:
-      for segment in os.listdir(footage_path):
-        if segment.endswith("--0"):
-          segment_path = os.path.join(footage_path, segment)
-          if PRESERVE_ATTR_NAME in os.listxattr(segment_path) and os.getxattr(segment_path, PRESERVE_ATTR_NAME) == PRESERVE_ATTR_VALUE:
-            preserved_routes += 1
-
-    if preserved_routes >= PRESERVE_COUNT:
+    catalog.refresh()
+    if catalog.preserved_count() >= PRESERVE_COUNT:
       return {"error": f"Maximum of {PRESERVE_COUNT} preserved routes reached..."}, 400
 
     for footage_path in FOOTAGE_PATHS:
       route_path = os.path.join(footage_path, f"{name}--0")
       if os.path.exists(route_path):
         os.setxattr(route_path, PRESERVE_ATTR_NAME, PRESERVE_ATTR_VALUE)
+        catalog.update_route(footage_path, name)
         return {"message": "Route preserved!!"}, 200
 
     return {"error": "Route not found"}, 404
@@ -367,20 +366,22 @@ def setup(app):
       route_path = os.path.join(footage_path, f"{name}--0")
       if PRESERVE_ATTR_NAME in os.listxattr(route_path):
         os.removexattr(route_path, PRESERVE_ATTR_NAME)
+        catalog.update_route(footage_path, name)
         return {"message": "Route unpreserved!"}, 200
     return {"error": "Route not found"}, 404
 
   @app.route("/api/routes/<name>", methods=["GET"])
   def get_route(name):
+    catalog.refresh()
     for footage_path in FOOTAGE_PATHS:
       base_path = f"{footage_path}{name}--0"
       if os.path.exists(base_path):
-        segments = utilities.get_segments_in_route(name, footage_path)
+        segments = catalog.get_segments(footage_path, name)
         if not segments:
           break
 
-        segment_urls = [f"/video/{segment}" for segment in segments]
-        total_duration = sum(utilities.get_video_duration(f"{footage_path}{name}--{i}/fcamera.hevc") for i in range(len(segment_urls)))
+        segment_urls = [f"/video/{name}--{segment_num}" for segment_num in segments]
+        total_duration = sum(catalog.get_duration(footage_path, name, segment_num) for segment_num in segments)
         return {
           "name": name,
           "segment_urls": segment_urls,
@@ -423,6 +424,8 @@ def setup(app):
           route_timestamp_dt = utilities.get_route_start_time(rlog_path)
           original_timestamp = route_timestamp_dt.isoformat() if route_timestamp_dt else None
 
+      catalog.update_route(footage_path, route_name)
+
     if cleared:
       return jsonify({"message": "Route name cleared successfully!", "timestamp": original_timestamp}), 200
     else:
@@ -468,6 +471,8 @@ def setup(app):
         except OSError as e:
           return jsonify({"error": f"Error creating new name file: {e}"}), 500
 
+      catalog.update_route(footage_path, old_name)
+
     if renamed:
       return jsonify({"message": "Route renamed successfully!"}), 200
     else:
@@ -566,13 +571,12 @@ def setup(app):
 
   @app.route("/api/speed_limits", methods=["GET"])
   def speed_limits():
-    data = json.loads(params.get("SpeedLimitsFiltered") or "[]")
     current_time = (datetime.now(timezone.utc) - timedelta(days=6, hours=23)).isoformat()
-    data = [{**e, "last_vetted": current_time} for e in data]
-
-    params.put("SpeedLimitsFiltered", json.dumps(data))
+    with SpeedLimitStore() as store:
+      store.set_last_vetted(current_time)
+      segments = list(store.iter_segments())
 
-    buffer = BytesIO(json.dumps(data, indent=2).encode())
+    buffer = BytesIO(json.dumps(segments, indent=2).encode())
     buffer.seek(0)
     return send_file(buffer, as_attachment=True, download_name="speed_limits.json", mimetype="application/json")
 
@@ -918,6 +922,17 @@ def setup(app):
     for footage_path in FOOTAGE_PATHS:
       if os.path.exists(os.path.join(footage_path, file_path)):
         return send_from_directory(footage_path, file_path, as_attachment=True)
+
+    # a route preview that hasn't been made yet jumps the queue
+    segment, _, preview = file_path.partition("/")
+    if utilities.SEGMENT_RE.fullmatch(segment) and preview in PREVIEWS:
+      for footage_path in FOOTAGE_PATHS:
+        segment_path = os.path.join(footage_path, segment)
+        if os.path.isdir(segment_path):
+          done = thumbnails.request(segment_path, preview, PRIORITY_VISIBLE)
+          if done is not None and done.wait(THUMBNAIL_TIMEOUT) and os.path.exists(os.path.join(segment_path, preview)):
+            return send_from_directory(footage_path, file_path, as_attachment=True)
+          break
     return {"error": "Thumbnail not found"}, 404
 
   @app.route("/video/<path>", methods=["GET"])
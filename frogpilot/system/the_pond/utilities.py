@@ -14,8 +14,6 @@ from typing import List
 from openpilot.common.conversions import Conversions as CV
 from openpilot.system.loggerd.config import get_available_bytes, get_used_bytes
 from openpilot.system.loggerd.deleter import PRESERVE_ATTR_NAME, PRESERVE_ATTR_VALUE
-from openpilot.system.loggerd.uploader import listdir_by_creation
-from openpilot.tools.lib.route import SegmentName
 
 from openpilot.frogpilot.common.frogpilot_variables import params, params_tracking
 
@@ -71,17 +69,6 @@ def format_git_date(raw_date: str):
 
   return date_object.strftime(f"%B {day}{suffix}, %Y")
 
-def get_all_segment_names(footage_path):
-  entries = listdir_by_creation(footage_path)
-
-  segment_names = []
-  for entry in entries:
-    if not SEGMENT_RE.fullmatch(entry):
-      continue
-
-    segment_names.append(segment_to_segment_name(footage_path, entry))
-  return segment_names
-
 def get_available_cameras(segment_path):
   segment_path = Path(segment_path)
   return [
@@ -92,6 +79,14 @@ def get_available_cameras(segment_path):
     }.items() if (segment_path / file).exists()
   ]
 
+def get_custom_name(segment_path):
+  # routes are renamed with an empty file named after them, ".mp4" skips video_to_gif's intermediate file
+  if os.path.isdir(segment_path):
+    for item in os.listdir(segment_path):
+      if not item.endswith((".hevc", ".ts", ".png", ".gif", ".mp4")) and item not in LOG_CANDIDATES:
+        return item
+  return None
+
 def get_disk_usage():
   free = get_available_bytes()
   used = get_used_bytes()
@@ -145,18 +140,6 @@ def get_route_start_time(log_file_path):
   creation_time = os.path.getctime(log_file_path)
   return datetime.fromtimestamp(creation_time)
 
-def get_routes_names(footage_path):
-  segments = get_all_segment_names(footage_path)
-  route_times = {segment.route_name.time_str for segment in segments}
-  return sorted(route_times, reverse=True)
-
-def get_segments_in_route(route_time_str, footage_path):
-  return [
-    f"{segment.time_str}--{segment.segment_num}"
-    for segment in get_all_segment_names(footage_path)
-    if segment.time_str == route_time_str
-  ]
-
 def get_video_duration(input_path):
   try:
     result = subprocess.run([
@@ -173,43 +156,6 @@ def has_preserve_attr(path: str):
 def list_file(path):
   return sorted(os.listdir(path), reverse=True)
 
-def process_route(footage_path, route_name):
-  segment_path = f"{footage_path}{route_name}--0"
-  qcamera_path = f"{segment_path}/qcamera.ts"
-  rlog_path = f"{segment_path}/rlog"
-
-  png_output_path = os.path.join(segment_path, "preview.png")
-  if not os.path.exists(png_output_path):
-    video_to_png(qcamera_path, png_output_path)
-
-  custom_name = None
-  if os.path.isdir(segment_path):
-    for item in os.listdir(segment_path):
-      if not item.endswith((".hevc", ".ts", ".png", ".gif")) and item not in LOG_CANDIDATES:
-        custom_name = item
-        break
-
-  route_timestamp_str = custom_name
-  if not custom_name:
-    route_timestamp_dt = get_route_start_time(rlog_path)
-    route_timestamp_str = route_timestamp_dt.isoformat() if route_timestamp_dt else None
-
-  return {
-    "name": route_name,
-    "gif": f"/thumbnails/{route_name}--0/preview.gif",
-    "png": f"/thumbnails/{route_name}--0/preview.png",
-    "timestamp": route_timestamp_str,
-    "is_preserved": has_preserve_attr(segment_path)
-  }
-
-def process_route_gif(footage_path, route_name):
-  segment_path = f"{footage_path}{route_name}--0"
-  qcamera_path = f"{segment_path}/qcamera.ts"
-  gif_output_path = os.path.join(segment_path, "preview.gif")
-
-  if not os.path.exists(gif_output_path):
-    video_to_gif(qcamera_path, gif_output_path)
-
 def process_screen_recording(mp4):
   stem = mp4.with_suffix("")
   png_path = stem.with_suffix(".png")
@@ -242,10 +188,6 @@ def run_ffmpeg(args):
   stdout, stderr = process.communicate()
   return stdout
 
-def segment_to_segment_name(data_dir, segment):
-  full_path = os.path.join(data_dir, f"FakeDongleID1337|{segment}")
-  return SegmentName(full_path)
-
 def video_to_gif(input_path, output_path):
   output_path = Path(output_path)
   sped_up_path = output_path.with_suffix(f".{uuid.uuid4()}.spedup.mp4")
@@ -0,0 +1,130 @@
+from collections.abc import Iterable
+from functools import partial
+from typing import NamedTuple
+
+import numpy as np
+
+from opendbc.can.parser_pyx import calc_checksums, counters_valid, get_dbc_messages  # pylint: disable=no-name-in-module, import-error
+
+
+class SignalDef(NamedTuple):
+  start_bit: int
+  msb: int
+  lsb: int
+  size: int
+  is_signed: bool
+  factor: float
+  offset: float
+  is_little_endian: bool
+  is_counter: bool
+  has_checksum: bool
+
+
+def get_raw_values(dat: np.ndarray, sig: SignalDef) -> np.ndarray:
+  # vectorized get_raw_value from the C++ parser, dat is (frames, message size) uint8
+  ret = np.zeros(len(dat), dtype=np.uint64)
+  i = sig.msb // 8
+  bits = sig.size
+  while 0 <= i < dat.shape[1] and bits > 0:
+    lsb = sig.lsb if sig.lsb // 8 == i else i * 8
+    msb = sig.msb if sig.msb // 8 == i else (i + 1) * 8 - 1
+    size = msb - lsb + 1
+    d = (dat[:, i].astype(np.uint64) >> np.uint64(lsb - i * 8)) & np.uint64((1 << size) - 1)
+    ret |= d << np.uint64(bits - size)
+    bits -= size
+    i = i - 1 if sig.is_little_endian else i + 1
+
+  ret = ret.astype(np.int64)
+  if sig.is_signed:
+    ret -= ((ret >> (sig.size - 1)) & 1) << sig.size
+  return ret
+
+
+class CANDecoder:
+  """Decodes DBC signals from whole routes of can events at once, instead of 10ms at a time through CANParser.
+
+  signals are (message name or address, signal name) pairs. Frames that fail checksum or counter checks are
+  dropped, same as CANParser would, when check_checksum or check_counter is set.
+  """
+
+  def __init__(self, dbc_name: str, signals: list[tuple[str | int, str]], bus: int = 0,
+               check_checksum: bool = False, check_counter: bool = False):
+    self.dbc_name = dbc_name
+    self.signals = signals
+    self.bus = bus
+    self.check_checksum = check_checksum
+    self.check_counter = check_counter
+
+    messages = get_dbc_messages(dbc_name)
+    by_address = {address: (name, size, sigs) for name, (address, size, sigs) in messages.items()}
+
+    # address -> (message size, {signal name: SignalDef})
+    self.messages: dict[int, tuple[int, dict[str, SignalDef]]] = {}
+    self.addresses: dict[str | int, int] = {}
+    for msg, sig_name in signals:
+      try:
+        name, size, sigs = by_address[msg] if isinstance(msg, int) else (msg, *messages[msg][1:])
+      except KeyError:
+        raise RuntimeError(f"could not find message {repr(msg)} in DBC {dbc_name}") from None
+      if sig_name not in sigs:
+        raise RuntimeError(f"could not find signal {repr(sig_name)} in message {repr(name)} in DBC {dbc_name}")
+      address = messages[name][0]
+      self.addresses[msg] = address
+      self.messages[address] = (size, {s: SignalDef(*d) for s, d in sigs.items()})
+
+  def collect(self, can_events: Iterable) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    # {address: (logMonoTime, (frames, size) uint8)} for the frames of the requested messages on our bus
+    frames: dict[int, tuple[list[int], list[bytes]]] = {address: ([], []) for address in self.messages}
+    for evt in can_events:
+      if evt.which() != 'can':
+        continue
+      t = evt.logMonoTime
+      for c in evt.can:
+        if c.src == self.bus and c.address in frames:
+          ts, dat = frames[c.address]
+          ts.append(t)
+          dat.append(c.dat)
+
+    ret = {}
+    for address, (ts, dat) in frames.items():
+      # like CANParser, frames with the wrong length can't be decoded
+      size = self.messages[address][0]
+      valid = [i for i, d in enumerate(dat) if len(d) == size]
+      ret[address] = (np.array(ts, dtype=np.uint64)[valid],
+                      np.frombuffer(b"".join(dat[i] for i in valid), dtype=np.uint8).reshape(-1, size))
+    return ret
+
+  def _valid_frames(self, address: int, dat: np.ndarray) -> np.ndarray:
+    valid = np.ones(len(dat), dtype=bool)
+    for sig_name, sig in self.messages[address][1].items():
+      if self.check_checksum and sig.has_checksum:
+        expected = np.empty(len(dat), dtype=np.int64)
+        calc_checksums(self.dbc_name, address, sig_name, np.ascontiguousarray(dat), expected)
+        valid &= get_raw_values(dat, sig) == expected
+      if self.check_counter and sig.is_counter:
+        counter_valid = np.empty(len(dat), dtype=np.uint8)
+        counters_valid(get_raw_values(dat, sig), sig.size, counter_valid)
+        valid &= counter_valid.astype(bool)
+    return valid
+
+  def decode(self, can_events: Iterable) -> dict[tuple[str | int, str], tuple[np.ndarray, np.ndarray]]:
+    """{(message, signal): (logMonoTime, values)} for all the requested signals"""
+    frames = self.collect(can_events)
+    valid = {address: self._valid_frames(address, dat) for address, (_, dat) in frames.items()}
+
+    ret = {}
+    for msg, sig_name in self.signals:
+      address = self.addresses[msg]
+      ts, dat = frames[address]
+      sig = self.messages[address][1][sig_name]
+      values = get_raw_values(dat[valid[address]], sig) * sig.factor + sig.offset
+      ret[(msg, sig_name)] = (ts[valid[address]], values)
+    return ret
+
+  def _decode_segment(self, lr) -> list:
+    return [self.decode(lr)]
+
+  def decode_route(self, lr, num_processes: int = 8) -> dict[tuple[str | int, str], tuple[np.ndarray, np.ndarray]]:
+    """decode() with one process per segment of a LogReader. Counter checks restart at each segment."""
+    segments = lr.run_across_segments(num_processes, partial(CANDecoder._decode_segment, self))
+    return {k: (np.concatenate([s[k][0] for s in segments]), np.concatenate([s[k][1] for s in segments])) for k in self.signals}
@@ -2,18 +2,29 @@
 # cython: c_string_encoding=ascii, language_level=3
 
 from libc.stdint cimport uint8_t, uint32_t
+from libcpp.string cimport string
 from libcpp.vector cimport vector
 
 from .common cimport CANPacker as cpp_CANPacker
 from .common cimport dbc_lookup, SignalPackValue, DBC, Msg
 
+import numpy as np
+
+
+cdef list can_msg(uint32_t addr, vector[uint8_t] &val, bus):
+  return [addr, 0, (<char *>&val[0])[:val.size()], bus]
+
 
 cdef class CANPacker:
   cdef:
     cpp_CANPacker *packer
     const DBC *dbc
 
+  cdef readonly:
+    string dbc_name
+
   def __init__(self, dbc_name):
+    self.dbc_name = dbc_name
     self.dbc = dbc_lookup(dbc_name)
     if not self.dbc:
       raise RuntimeError(f"Can't lookup {dbc_name}")
@@ -50,4 +61,100 @@ cdef class CANPacker:
         pass
 
     cdef vector[uint8_t] val = self.pack(addr, values)
-    return [addr, 0, (<char *>&val[0])[:val.size()], bus]
+    return can_msg(addr, val, bus)
+
+  def template(self, name_or_addr, bus, signals):
+    """MessageTemplate packing the given signals of a message, for messages sent every cycle"""
+    return MessageTemplate(self, name_or_addr, bus, signals)
+
+  def pack_many(self, messages):
+    """can messages for a whole cycle at once. Each item is a MessageTemplate, packed from its current values,
+    or a (MessageTemplate, values) pair, with values as for MessageTemplate.make_can_msg"""
+    ret = []
+    cdef MessageTemplate tmpl
+    cdef vector[uint8_t] val
+    for item in messages:
+      if isinstance(item, MessageTemplate):
+        tmpl = item
+      else:
+        tmpl, values = item
+        tmpl.fill(values)
+      val = tmpl.pack()
+      ret.append(can_msg(tmpl.address, val, tmpl.bus))
+    return ret
+
+
+cdef class MessageTemplate:
+  """A message and signal set resolved once, packed from a value buffer that keeps its values between cycles.
+  Signals left out are packed as 0, and COUNTER and the checksum are filled in by the packer when they
+  aren't in signals, same as make_can_msg."""
+  cdef:
+    CANPacker packer
+    vector[SignalPackValue] signal_values
+    dict signal_index
+    double[::1] values_buf
+
+  cdef readonly:
+    uint32_t address
+    object bus
+    tuple signals
+    object values
+
+  def __init__(self, CANPacker packer, name_or_addr, bus, signals):
+    cdef const Msg* m
+    try:
+      if isinstance(name_or_addr, int):
+        m = packer.dbc.addr_to_msg.at(name_or_addr)
+      else:
+        m = packer.dbc.name_to_msg.at(name_or_addr.encode("utf8"))
+    except IndexError:
+      raise RuntimeError(f"could not find message {repr(name_or_addr)} in DBC {packer.dbc_name}")
+
+    msg_signals = set()
+    for i in range(m.sigs.size()):
+      msg_signals.add(m.sigs[i].name.decode("utf8"))
+    cdef SignalPackValue spv
+    spv.value = 0
+    for name in signals:
+      if name not in msg_signals:
+        raise RuntimeError(f"could not find signal {repr(name)} in message {repr(name_or_addr)} in DBC {packer.dbc_name}")
+      spv.name = name.encode("utf8")
+      self.signal_values.push_back(spv)
+
+    self.packer = packer
+    self.address = m.address
+    self.bus = bus
+    self.signals = tuple(signals)
+    self.signal_index = {name: i for i, name in enumerate(self.signals)}
+    self.values = np.zeros(len(self.signals), dtype=np.float64)
+    self.values_buf = self.values
+
+  def index(self, name):
+    """Position of a signal in values"""
+    return self.signal_index[name]
+
+  cpdef fill(self, values):
+    """Update the value buffer from a {signal: value} dict, leaving signals it doesn't have as they were,
+    or from a sequence with a value for every signal, in order"""
+    cdef Py_ssize_t i
+    if isinstance(values, dict):
+      for name, value in values.items():
+        i = self.signal_index[name]
+        self.values_buf[i] = value
+    else:
+      if len(values) != self.values_buf.shape[0]:
+        raise ValueError(f"expected {self.values_buf.shape[0]} values, got {len(values)}")
+      for i, value in enumerate(values):
+        self.values_buf[i] = value
+
+  cdef vector[uint8_t] pack(self):
+    cdef size_t i
+    for i in range(self.signal_values.size()):
+      self.signal_values[i].value = self.values_buf[i]
+    return self.packer.packer.pack(self.address, self.signal_values)
+
+  def make_can_msg(self, values=None):
+    if values is not None:
+      self.fill(values)
+    cdef vector[uint8_t] val = self.pack()
+    return can_msg(self.address, val, self.bus)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+
+from opendbc.can.parser import CANParser
+from opendbc.can.parser_pyx import get_dbc_messages  # pylint: disable=no-name-in-module, import-error
+from openpilot.tools.lib.logreader import LogReader
+
+DBCS = {
+  "toyota": "toyota_nodsu_pt_generated",
+  "hyundai": "hyundai_kia_generic",
+}
+
+
+def load_route(route: str, dbc_name: str, bus: int, max_cycles: int):
+  # the DBC's messages seen on the bus, and each can event as one 100Hz cycle
+  addresses = {address: name for name, (address, _, _) in get_dbc_messages(dbc_name).items()}
+  seen, cycles = set(), []
+  for msg in LogReader(route, services=['can']):
+    if len(cycles) >= max_cycles:
+      break
+    seen.update(c.address for c in msg.can if c.src == bus and c.address in addresses)
+    cycles.append([msg.as_builder().to_bytes()])
+  return sorted(addresses[address] for address in seen), cycles
+
+
+def read_dicts(cp: CANParser, signals: list[tuple[str, str]]) -> list[float]:
+  # how every CarState reads its signals
+  return [cp.vl[msg][sig] for msg, sig in signals]
+
+
+def benchmark(cp: CANParser, read, cycles: list[list[bytes]]) -> np.ndarray:
+  times = np.empty(len(cycles))
+  for i, can_strings in enumerate(cycles):
+    t = time.process_time_ns()
+    cp.update_strings(can_strings)
+    read(cp)
+    times[i] = time.process_time_ns() - t
+  return times / 1e3
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Per-cycle CPU of CANParser replaying a route's can, through the dicts and through handles")
+  parser.add_argument("--toyota", help="Toyota route or segment, anything LogReader accepts")
+  parser.add_argument("--hyundai", help="Hyundai route or segment, anything LogReader accepts")
+  parser.add_argument("--bus", type=int, default=0)
+  parser.add_argument("--cycles", type=int, default=6000)
+  args = parser.parse_args()
+
+  for brand, dbc_name in DBCS.items():
+    route = getattr(args, brand)
+    if route is None:
+      continue
+
+    messages, cycles = load_route(route, dbc_name, args.bus, args.cycles)
+    signals = [(msg, sig) for msg in messages for sig in get_dbc_messages(dbc_name)[msg][2]]
+    print(f"{brand}: {dbc_name}, {len(messages)} messages, {len(signals)} signals, {len(cycles)} cycles")
+
+    cp = CANParser(dbc_name, [(msg, 0) for msg in messages], args.bus)
+    handles = cp.get_handles(signals)
+    runs = (
+      ("vl dicts", lambda cp: read_dicts(cp, signals)),
+      ("handles", lambda cp: cp.values[handles].tolist()),
+      ("update only", lambda cp: None),
+    )
+    for name, read in runs:
+      times = benchmark(cp, read, cycles)
+      print(f"{name:>12}: mean {times.mean():7.1f} us, p50 {np.percentile(times, 50):7.1f} us, p99 {np.percentile(times, 99):7.1f} us")
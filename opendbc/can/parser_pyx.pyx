@@ -5,26 +5,71 @@ from cython.operator cimport dereference as deref, preincrement as preinc
 from libcpp.pair cimport pair
 from libcpp.string cimport string
 from libcpp.vector cimport vector
-from libc.stdint cimport uint32_t
+from libcpp.unordered_map cimport unordered_map
+from libc.stdint cimport int64_t, uint8_t, uint32_t, uint64_t
 
 from .common cimport CANParser as cpp_CANParser
-from .common cimport dbc_lookup, SignalValue, DBC
+from .common cimport dbc_lookup, SignalValue, DBC, Msg, Signal, COUNTER
 
 import numbers
+import sys
 from collections import defaultdict
 
+import numpy as np
+
+# same as the C++ parser, a message is only dropped after this many bad counters in a row
+cdef int MAX_BAD_COUNTER = 5
+
+
+cdef class CANStrings:
+  # can strings converted to C++ once, so every CANParser on the car reads the same copy
+  cdef vector[string] strings
+
+  def __init__(self, strings):
+    self.strings = strings
+
+  def __len__(self):
+    return self.strings.size()
+
 
 cdef class CANParser:
+  """Parses can strings into the signals of the given messages.
+
+  Every signal of a tracked message has a handle, an index into values and timestamps, which are updated in
+  place by update_strings. Resolve handles once with get_handle or get_handles and read values through them
+  instead of the vl, vl_all and ts_nanos dicts, which are only filled in when they're accessed.
+  """
   cdef:
     cpp_CANParser *can
     const DBC *dbc
-    vector[SignalValue] can_values
     vector[uint32_t] addresses
+    unordered_map[string, int] name_ids
+    list names
+
+    # handles of a message are contiguous and in DBC signal order, which is the order the C++ parser emits them
+    unordered_map[uint32_t, int] first_handle
+    unordered_map[uint64_t, int] handle_ids
+    vector[uint32_t] handle_addresses
+    vector[string] handle_signals
+    list handle_names
+    list handle_vl
+    list handle_ts_nanos
+    double[::1] values_buf
+    uint64_t[::1] ts_nanos_buf
+    object values_view
+    object ts_nanos_view
+
+    # handles updated since the dicts were last filled in, and the values of the last update for vl_all
+    vector[int] dirty
+    vector[uint8_t] is_dirty
+    vector[SignalValue] last_vals
+    bint vl_all_stale
+
+    dict _vl
+    dict _vl_all
+    dict _ts_nanos
 
   cdef readonly:
-    dict vl
-    dict vl_all
-    dict ts_nanos
     string dbc_name
 
   def __init__(self, dbc_name, messages, bus=0):
@@ -33,12 +78,18 @@ cdef class CANParser:
     if not self.dbc:
       raise RuntimeError(f"Can't find DBC: {dbc_name}")
 
-    self.vl = {}
-    self.vl_all = {}
-    self.ts_nanos = {}
+    self._vl = {}
+    self._vl_all = {}
+    self._ts_nanos = {}
+    self.names = []
+    self.handle_names = []
+    self.handle_vl = []
+    self.handle_ts_nanos = []
 
     # Convert message names into addresses and check existence in DBC
     cdef vector[pair[uint32_t, int]] message_v
+    cdef int name_id
+    cdef const Signal *sig
     for i in range(len(messages)):
       c = messages[i]
       try:
@@ -48,15 +99,43 @@ cdef class CANParser:
 
       address = m.address
       message_v.push_back((address, c[1]))
+      if self.first_handle.count(address):
+        continue
       self.addresses.push_back(address)
 
       name = m.name.decode("utf8")
-      self.vl[address] = {}
-      self.vl[name] = self.vl[address]
-      self.vl_all[address] = defaultdict(list)
-      self.vl_all[name] = self.vl_all[address]
-      self.ts_nanos[address] = {}
-      self.ts_nanos[name] = self.ts_nanos[address]
+      self._vl[address] = {}
+      self._vl[name] = self._vl[address]
+      self._vl_all[address] = defaultdict(list)
+      self._vl_all[name] = self._vl_all[address]
+      self._ts_nanos[address] = {}
+      self._ts_nanos[name] = self._ts_nanos[address]
+
+      # interned signal names, so update_strings doesn't decode and hash a new key for every value
+      self.first_handle[address] = self.handle_signals.size()
+      for j in range(m.sigs.size()):
+        sig = &m.sigs[j]
+        if self.name_ids.count(sig.name) == 0:
+          self.name_ids[sig.name] = len(self.names)
+          self.names.append(sys.intern(sig.name.decode("utf8")))
+
+        name_id = self.name_ids[sig.name]
+        self.handle_ids[(<uint64_t>address << 32) | name_id] = self.handle_signals.size()
+        self.handle_addresses.push_back(address)
+        self.handle_signals.push_back(sig.name)
+        self.handle_names.append(self.names[name_id])
+        self.handle_vl.append(self._vl[address])
+        self.handle_ts_nanos.append(self._ts_nanos[address])
+
+    values = np.zeros(self.handle_signals.size(), dtype=np.float64)
+    ts_nanos = np.zeros(self.handle_signals.size(), dtype=np.uint64)
+    self.values_buf = values
+    self.ts_nanos_buf = ts_nanos
+    self.values_view = values.view()
+    self.values_view.flags.writeable = False
+    self.ts_nanos_view = ts_nanos.view()
+    self.ts_nanos_view.flags.writeable = False
+    self.is_dirty.resize(self.handle_signals.size(), 0)
 
     self.can = new cpp_CANParser(bus, dbc_name, message_v)
     self.update_strings([])
@@ -65,38 +144,136 @@ cdef class CANParser:
     if self.can:
       del self.can
 
-  def update_strings(self, strings, sendcan=False):
+  def get_handle(self, message, signal):
+    """Index of signal in message into values and timestamps, message being a name or an address"""
+    try:
+      m = self.dbc.addr_to_msg.at(message) if isinstance(message, numbers.Number) else self.dbc.name_to_msg.at(message)
+    except IndexError:
+      raise RuntimeError(f"could not find message {repr(message)} in DBC {self.dbc_name}")
+
+    cdef string sig_name = signal.encode("utf8")
+    cdef unordered_map[string, int].iterator name_it = self.name_ids.find(sig_name)
+    cdef unordered_map[uint64_t, int].iterator it = self.handle_ids.end()
+    if name_it != self.name_ids.end():
+      it = self.handle_ids.find((<uint64_t>m.address << 32) | deref(name_it).second)
+    if it == self.handle_ids.end():
+      if not self.first_handle.count(m.address):
+        raise RuntimeError(f"message {repr(message)} is not parsed by this CANParser")
+      raise RuntimeError(f"could not find signal {repr(signal)} in message {repr(message)} in DBC {self.dbc_name}")
+    return deref(it).second
+
+  def get_handles(self, signals):
+    """get_handle of each (message, signal) pair, as an array to index values and timestamps with"""
+    return np.array([self.get_handle(message, signal) for message, signal in signals], dtype=np.intp)
+
+  @property
+  def values(self):
+    # read-only view, updated in place by update_strings
+    return self.values_view
+
+  @property
+  def timestamps(self):
+    # nanoseconds each value was last updated, read-only view updated in place by update_strings
+    return self.ts_nanos_view
+
+  @property
+  def vl(self):
+    self.sync_dicts()
+    return self._vl
+
+  @property
+  def vl_all(self):
+    if self.vl_all_stale:
+      self.sync_vl_all()
+    return self._vl_all
+
+  @property
+  def ts_nanos(self):
+    self.sync_dicts()
+    return self._ts_nanos
+
+  cdef int find_handle(self, const SignalValue *cv, int expected):
+    if expected < <int>self.handle_signals.size() and self.handle_addresses[expected] == cv.address \
+       and self.handle_signals[expected] == cv.name:
+      return expected
+
+    cdef unordered_map[string, int].iterator name_it = self.name_ids.find(cv.name)
+    if name_it == self.name_ids.end():
+      return -1
+    cdef unordered_map[uint64_t, int].iterator it = self.handle_ids.find((<uint64_t>cv.address << 32) | deref(name_it).second)
+    if it == self.handle_ids.end():
+      return -1
+    return deref(it).second
+
+  cdef sync_dicts(self):
+    cdef int h
+    for h in self.dirty:
+      (<dict>self.handle_vl[h])[self.handle_names[h]] = self.values_buf[h]
+      (<dict>self.handle_ts_nanos[h])[self.handle_names[h]] = self.ts_nanos_buf[h]
+      self.is_dirty[h] = 0
+    self.dirty.clear()
+
+  cdef sync_vl_all(self):
     for address in self.addresses:
-      self.vl_all[address].clear()
+      self._vl_all[address].clear()
 
-    cdef vector[SignalValue] new_vals
-    cur_address = -1
-    vl = {}
+    cdef vector[SignalValue].iterator it = self.last_vals.begin()
+    cdef SignalValue* cv
+    cdef uint32_t cur_address = 0
+    cdef int h = -1
     vl_all = {}
-    ts_nanos = {}
+    while it != self.last_vals.end():
+      cv = &deref(it)
+      if h < 0 or cv.address != cur_address:
+        cur_address = cv.address
+        vl_all = self._vl_all[cur_address]
+        h = self.first_handle[cur_address] - 1
+
+      h = self.find_handle(cv, h + 1)
+      vl_all[self.handle_names[h] if h >= 0 else <unicode>cv.name] = cv.all_values
+      preinc(it)
+    self.vl_all_stale = False
+
+  def update_strings(self, strings, sendcan=False):
+    cdef vector[SignalValue] new_vals
     updated_addrs = set()
 
-    self.can.update_strings(strings, new_vals, sendcan)
+    cdef vector[string] converted
+    if isinstance(strings, CANStrings):
+      self.can.update_strings((<CANStrings>strings).strings, new_vals, sendcan)
+    else:
+      converted = strings
+      self.can.update_strings(converted, new_vals, sendcan)
+
     cdef vector[SignalValue].iterator it = new_vals.begin()
     cdef SignalValue* cv
+    cdef uint32_t cur_address = 0
+    cdef int h = -1
     while it != new_vals.end():
       cv = &deref(it)
 
       # Check if the address has changed
-      if cv.address != cur_address:
+      if h < 0 or cv.address != cur_address:
         cur_address = cv.address
-        vl = self.vl[cur_address]
-        vl_all = self.vl_all[cur_address]
-        ts_nanos = self.ts_nanos[cur_address]
+        h = self.first_handle[cur_address] - 1
         updated_addrs.add(cur_address)
 
-      # Cast char * directly to unicode
-      cv_name = <unicode>cv.name
-      vl[cv_name] = cv.value
-      vl_all[cv_name] = cv.all_values
-      ts_nanos[cv_name] = cv.ts_nanos
+      # values come in handle order, so the next handle is almost always the right one
+      h = self.find_handle(cv, h + 1)
+      if h >= 0:
+        self.values_buf[h] = cv.value
+        self.ts_nanos_buf[h] = cv.ts_nanos
+        if not self.is_dirty[h]:
+          self.is_dirty[h] = 1
+          self.dirty.push_back(h)
+      else:
+        # Cast char * directly to unicode
+        self._vl[cur_address][<unicode>cv.name] = cv.value
+        self._ts_nanos[cur_address][<unicode>cv.name] = cv.ts_nanos
       preinc(it)
 
+    self.last_vals.swap(new_vals)
+    self.vl_all_stale = True
     return updated_addrs
 
   @property
@@ -146,3 +323,61 @@ cdef class CANDefine():
       dv[msgname][sgname] = dv[address][sgname]
 
     self.dv = dict(dv)
+
+
+def get_dbc_messages(dbc_name):
+  # {message name: (address, size, {signal name: (start_bit, msb, lsb, size, is_signed, factor, offset,
+  #  is_little_endian, is_counter, has_checksum)})}, for decoding frames outside of CANParser
+  cdef const DBC *dbc = dbc_lookup(dbc_name)
+  if not dbc:
+    raise RuntimeError(f"Can't find DBC: {dbc_name}")
+
+  cdef const Msg *m
+  cdef const Signal *sig
+  messages = {}
+  for i in range(dbc.msgs.size()):
+    m = &dbc.msgs[i]
+    sigs = {}
+    for j in range(m.sigs.size()):
+      sig = &m.sigs[j]
+      sigs[sig.name.decode("utf8")] = (sig.start_bit, sig.msb, sig.lsb, sig.size, sig.is_signed, sig.factor, sig.offset,
+                                       sig.is_little_endian, sig.type == COUNTER, sig.calc_checksum != NULL)
+    messages[m.name.decode("utf8")] = (m.address, m.size, sigs)
+  return messages
+
+
+def calc_checksums(dbc_name, uint32_t address, signal_name, const uint8_t[:, ::1] dat, int64_t[::1] out):
+  # checksum signal_name should have in each frame of dat, written to out
+  cdef const DBC *dbc = dbc_lookup(dbc_name)
+  if not dbc:
+    raise RuntimeError(f"Can't find DBC: {dbc_name}")
+
+  cdef const Msg *m = dbc.addr_to_msg.at(address)
+  cdef const Signal *sig = NULL
+  cdef string name = signal_name.encode("utf8")
+  cdef vector[uint8_t] frame
+  cdef Py_ssize_t i
+  for i in range(m.sigs.size()):
+    if m.sigs[i].name == name:
+      sig = &m.sigs[i]
+  if sig == NULL or sig.calc_checksum == NULL:
+    raise RuntimeError(f"{signal_name} is not a checksum in {dbc_name}")
+
+  for i in range(dat.shape[0]):
+    frame.assign(&dat[i, 0], &dat[i, 0] + dat.shape[1])
+    out[i] = sig.calc_checksum(address, sig[0], frame)
+
+
+def counters_valid(const int64_t[::1] counters, int size, uint8_t[::1] out):
+  # whether the C++ parser would accept each frame given its counter, tolerating a few bad counters in a row.
+  # like a new parser, the first frame is checked against a counter of 0
+  cdef int64_t counter = 0
+  cdef int counter_fail = 0
+  cdef Py_ssize_t i
+  for i in range(counters.shape[0]):
+    if ((counter + 1) & ((<int64_t>1 << size) - 1)) != counters[i]:
+      counter_fail = min(counter_fail + 1, MAX_BAD_COUNTER)
+    elif counter_fail > 0:
+      counter_fail -= 1
+    counter = counters[i]
+    out[i] = counter_fail < MAX_BAD_COUNTER
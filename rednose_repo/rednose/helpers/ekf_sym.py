@@ -10,6 +10,9 @@ from rednose.helpers.sympy_helpers import sympy_into_c
 from rednose.helpers import TEMPLATE_DIR, load_code
 from rednose.helpers.chi2_lookup import chi2_ppf
 
+# number of checkpoints kept for rewinding
+REWIND_TO_KEEP = 512
+
 
 def solve(a, b):
   if a.shape[0] == 1 and a.shape[1] == 1:
@@ -122,6 +125,7 @@ def gen_code(folder, name, f_sym, dt_sym, x_sym, obs_eqs, dim_x, dim_err, eskf_p
   pre_code = f"#include \"{name}.h\"\n"
   pre_code += "\nnamespace {\n"
   pre_code += "#define DIM %d\n" % dim_x
+  pre_code += "#define MDIM %d\n" % dim_main
   pre_code += "#define EDIM %d\n" % dim_err
   pre_code += "#define MEDIM %d\n" % dim_main_err
   pre_code += "typedef void (*Hfun)(double *, double *, double *);\n"
@@ -163,6 +167,10 @@ def gen_code(folder, name, f_sym, dt_sym, x_sym, obs_eqs, dim_x, dim_err, eskf_p
   post_code += f"void {name}_predict(double *in_x, double *in_P, double *in_Q, double dt) {{\n"
   post_code += "  predict(in_x, in_P, in_Q, dt);\n"
   post_code += "}\n"
+  header += f"void {name}_rts_smooth(double *x_pred, double *x_filt, double *P_pred, double *P_filt, double *dt, int n, int quat_idx, double *out_x, double *out_P);\n"
+  post_code += f"void {name}_rts_smooth(double *x_pred, double *x_filt, double *P_pred, double *P_filt, double *dt, int n, int quat_idx, double *out_x, double *out_P) {{\n"
+  post_code += "  rts_smooth(x_pred, x_filt, P_pred, P_filt, dt, n, quat_idx, out_x, out_P);\n"
+  post_code += "}\n"
   if global_vars is not None:
     for var in global_vars:
       header += f"void {name}_set_{var.name}(double x);\n"
@@ -245,11 +253,12 @@ class EKF_sym():
     # process noise
     self.Q = Q
 
-    # rewind stuff
+    # rewind stuff, ring buffers of the last REWIND_TO_KEEP checkpoints starting at rewind_start
     self.max_rewind_age = max_rewind_age
-    self.rewind_t = []
-    self.rewind_states = []
-    self.rewind_obscache = []
+    self.rewind_t = np.zeros(REWIND_TO_KEEP, dtype=np.float64)
+    self.rewind_x = np.zeros((REWIND_TO_KEEP, self.dim_x, 1), dtype=np.float64)
+    self.rewind_P = np.zeros((REWIND_TO_KEEP, self.dim_err, self.dim_err), dtype=np.float64)
+    self.rewind_obscache = [None] * REWIND_TO_KEEP
     self.init_state(x_initial, P_initial, None)
 
     ffi, lib = load_code(folder, name)
@@ -290,6 +299,21 @@ class EKF_sym():
     self.f = wrap_1list_1float("f_fun")
     self.F = wrap_1list_1float("F_fun")
 
+    # wrap the generated RTS smoother
+    rts_smooth_fun = getattr(lib, f"{name}_rts_smooth")
+
+    def _rts_smooth_generated(x_pred, x_filt, P_pred, P_filt, dt, quat_idx, out_x, out_P):
+      rts_smooth_fun(ffi.cast("double *", x_pred.ctypes.data),
+                     ffi.cast("double *", x_filt.ctypes.data),
+                     ffi.cast("double *", P_pred.ctypes.data),
+                     ffi.cast("double *", P_filt.ctypes.data),
+                     ffi.cast("double *", dt.ctypes.data),
+                     ffi.cast("int", x_pred.shape[0]),
+                     ffi.cast("int", quat_idx),
+                     ffi.cast("double *", out_x.ctypes.data),
+                     ffi.cast("double *", out_P.ctypes.data))
+    self._rts_smooth = _rts_smooth_generated
+
     self.err_function = wrap_2lists("err_fun")
     self.inv_err_function = wrap_2lists("inv_err_fun")
     self.H_mod = wrap_1lists("H_mod_fun")
@@ -350,14 +374,11 @@ class EKF_sym():
     self.P = np.array(covs).astype(np.float64)
     self.filter_time = filter_time
     self.augment_times = [0] * self.N
-    self.rewind_obscache = []
-    self.rewind_t = []
-    self.rewind_states = []
+    self.reset_rewind()
 
   def reset_rewind(self):
-    self.rewind_obscache = []
-    self.rewind_t = []
-    self.rewind_states = []
+    self.rewind_start = 0
+    self.rewind_len = 0
 
   def augment(self):
     # TODO this is not a generalized way of doing this and implies that the augmented states
@@ -412,39 +433,40 @@ class EKF_sym():
   def set_global(self, global_var, val):
     self.set_globals[global_var](val)
 
+  def rewind_slot(self, idx):
+    # ring buffer slot of the idx-th oldest checkpoint
+    return (self.rewind_start + idx) % REWIND_TO_KEEP
+
   def rewind(self, t):
     # find where we are rewinding to
-    idx = bisect_right(self.rewind_t, t)
-    assert self.rewind_t[idx - 1] <= t
-    assert self.rewind_t[idx] > t    # must be true, or rewind wouldn't be called
+    rewind_t = [self.rewind_t[self.rewind_slot(i)] for i in range(self.rewind_len)]
+    idx = bisect_right(rewind_t, t)
+    assert rewind_t[idx - 1] <= t
+    assert rewind_t[idx] > t    # must be true, or rewind wouldn't be called
 
     # set the state to the time right before that
-    self.filter_time = self.rewind_t[idx - 1]
-    self.x[:] = self.rewind_states[idx - 1][0]
-    self.P[:] = self.rewind_states[idx - 1][1]
-
-    # return the observations we rewound over for fast forwarding
-    ret = self.rewind_obscache[idx:]
-
-    # throw away the old future
-    # TODO: is this making a copy?
-    self.rewind_t = self.rewind_t[:idx]
-    self.rewind_states = self.rewind_states[:idx]
-    self.rewind_obscache = self.rewind_obscache[:idx]
-
+    slot = self.rewind_slot(idx - 1)
+    self.filter_time = rewind_t[idx - 1]
+    self.x[:] = self.rewind_x[slot]
+    self.P[:] = self.rewind_P[slot]
+
+    # return the observations we rewound over for fast forwarding, and throw away the old future
+    ret = [self.rewind_obscache[self.rewind_slot(i)] for i in range(idx, self.rewind_len)]
+    self.rewind_len = idx
     return ret
 
   def checkpoint(self, obs):
-    # push to rewinder
-    self.rewind_t.append(self.filter_time)
-    self.rewind_states.append((np.copy(self.x), np.copy(self.P)))
-    self.rewind_obscache.append(obs)
+    # push to rewinder, overwriting the oldest checkpoint once full
+    slot = self.rewind_slot(self.rewind_len)
+    if self.rewind_len == REWIND_TO_KEEP:
+      self.rewind_start = (self.rewind_start + 1) % REWIND_TO_KEEP
+    else:
+      self.rewind_len += 1
 
-    # only keep a certain number around
-    REWIND_TO_KEEP = 512
-    self.rewind_t = self.rewind_t[-REWIND_TO_KEEP:]
-    self.rewind_states = self.rewind_states[-REWIND_TO_KEEP:]
-    self.rewind_obscache = self.rewind_obscache[-REWIND_TO_KEEP:]
+    self.rewind_t[slot] = self.filter_time
+    self.rewind_x[slot] = self.x
+    self.rewind_P[slot] = self.P
+    self.rewind_obscache[slot] = obs
 
   def predict(self, t):
     # initialize time
@@ -459,42 +481,49 @@ class EKF_sym():
     self.filter_time = t
 
   def predict_and_update_batch(self, t, kind, z, R, extra_args=[[]], augment=False):  # pylint: disable=dangerous-default-value
-    # TODO handle rewinding at this level"
+    ret = self.predict_and_update_multi(t, [(kind, z, R, extra_args)], augment)
+    return None if ret is None else ret[0]
+
+  def predict_and_update_multi(self, t, observations, augment=False):
+    """Updates several kinds of observations at the same time t with a single predict and checkpoint.
+    observations are (kind, z, R) or (kind, z, R, extra_args), as for predict_and_update_batch, applied in order.
+    This gives the same result as a predict_and_update_batch call per kind, since the predicts in between
+    have dt = 0. Returns an estimate per kind, or None if t is too old to rewind to.
+    """
+    observations = [(kind, z, R, extra_args[0] if extra_args else [[]]) for kind, z, R, *extra_args in observations]
 
     # rewind
     if self.filter_time is not None and t < self.filter_time:
-      if len(self.rewind_t) == 0 or t < self.rewind_t[0] or t < self.rewind_t[-1] - self.max_rewind_age:
+      if self.rewind_len == 0 or t < self.rewind_t[self.rewind_slot(0)] or \
+         t < self.rewind_t[self.rewind_slot(self.rewind_len - 1)] - self.max_rewind_age:
         self.logger.error(f"observation too old at {t:.3f} with filter at {self.filter_time:.3f}, ignoring")
         return None
       rewound = self.rewind(t)
     else:
       rewound = []
 
-    ret = self._predict_and_update_batch(t, kind, z, R, extra_args, augment)
+    ret = self._predict_and_update_multi(t, observations, augment)
 
     # optional fast forward
     for r in rewound:
-      self._predict_and_update_batch(*r)
+      self._predict_and_update_multi(*r)
 
     return ret
 
-  def _predict_and_update_batch(self, t, kind, z, R, extra_args, augment=False):
+  def _predict_and_update_multi(self, t, observations, augment=False):
     """The main kalman filter function
-    Predicts the state and then updates a batch of observations
+    Predicts the state and then updates a batch of observations of each kind
     dim_x: dimensionality of the state space
     dim_z: dimensionality of the observation and depends on kind
     n: number of observations
     Args:
       t                 (float): Time of observation
-      kind                (int): Type of observation
-      z         (vec [n,dim_z]): Measurements
-      R  (mat [n,dim_z, dim_z]): Measurement Noise
-      extra_args    (list, [n]): Values used in H computations
+      observations       (list): (kind, z, R, extra_args) for each kind, with
+        kind                (int): Type of observation
+        z         (vec [n,dim_z]): Measurements
+        R  (mat [n,dim_z, dim_z]): Measurement Noise
+        extra_args    (list, [n]): Values used in H computations
     """
-    assert z.shape[0] == R.shape[0]
-    assert z.shape[1] == R.shape[1]
-    assert z.shape[1] == R.shape[2]
-
     # initialize time
     if self.filter_time is None:
       self.filter_time = t
@@ -504,28 +533,35 @@ class EKF_sym():
     assert dt >= 0
     self.x, self.P = self._predict(self.x, self.P, dt)
     self.filter_time = t
-    xk_km1, Pk_km1 = np.copy(self.x).flatten(), np.copy(self.P)
-
-    # update batch
-    y = []
-    for i in range(len(z)):
-      # these are from the user, so we canonicalize them
-      z_i = np.array(z[i], dtype=np.float64, order='F')
-      R_i = np.array(R[i], dtype=np.float64, order='F')
-      extra_args_i = np.array(extra_args[i], dtype=np.float64, order='F')
-      # update
-      self.x, self.P, y_i = self._update(self.x, self.P, kind, z_i, R_i, extra_args=extra_args_i)
-      self.normalize_quaternions()
-      y.append(y_i)
-    xk_k, Pk_k = np.copy(self.x).flatten(), np.copy(self.P)
+
+    estimates = []
+    for kind, z, R, extra_args in observations:
+      assert z.shape[0] == R.shape[0]
+      assert z.shape[1] == R.shape[1]
+      assert z.shape[1] == R.shape[2]
+      xk_km1, Pk_km1 = np.copy(self.x).flatten(), np.copy(self.P)
+
+      # update batch
+      y = []
+      for i in range(len(z)):
+        # these are from the user, so we canonicalize them
+        z_i = np.array(z[i], dtype=np.float64, order='F')
+        R_i = np.array(R[i], dtype=np.float64, order='F')
+        extra_args_i = np.array(extra_args[i], dtype=np.float64, order='F')
+        # update
+        self.x, self.P, y_i = self._update(self.x, self.P, kind, z_i, R_i, extra_args=extra_args_i)
+        self.normalize_quaternions()
+        y.append(y_i)
+      xk_k, Pk_k = np.copy(self.x).flatten(), np.copy(self.P)
+      estimates.append((xk_km1, xk_k, Pk_km1, Pk_k, t, kind, y, z, extra_args))
 
     if augment:
       self.augment()
 
     # checkpoint
-    self.checkpoint((t, kind, z, R, extra_args))
+    self.checkpoint((t, observations))
 
-    return xk_km1, xk_k, Pk_km1, Pk_k, t, kind, y, z, extra_args
+    return estimates
 
   def _predict_python(self, x, P, dt):
     x_new = np.zeros(x.shape, dtype=np.float64)
@@ -652,36 +688,98 @@ class EKF_sym():
     If the kalman state is augmented with
     old states only the main state is smoothed
     '''
-    xk_n = estimates[-1][0]
-    Pk_n = estimates[-1][2]
-    Fk_1 = np.zeros(Pk_n.shape, dtype=np.float64)
-
-    states_smoothed = [xk_n]
-    covs_smoothed = [Pk_n]
-    for k in range(len(estimates) - 2, -1, -1):
-      xk1_n = xk_n
-      if norm_quats:
-        xk1_n[3:7] /= np.linalg.norm(xk1_n[3:7])
-      Pk1_n = Pk_n
-
-      xk1_k, _, Pk1_k, _, t2, _, _, _, _ = estimates[k + 1]
-      _, xk_k, _, Pk_k, t1, _, _, _, _ = estimates[k]
-      dt = t2 - t1
-      self.F(xk_k, dt, Fk_1)
-
-      d1 = self.dim_main
-      d2 = self.dim_main_err
-      Ck = np.linalg.solve(Pk1_k[:d2, :d2], Fk_1[:d2, :d2].dot(Pk_k[:d2, :d2].T)).T
-      xk_n = xk_k
-      delta_x = np.zeros((Pk_n.shape[0], 1), dtype=np.float64)
-      self.inv_err_function(xk1_k, xk1_n, delta_x)
-      delta_x[:d2] = Ck.dot(delta_x[:d2])
-      x_new = np.zeros((xk_n.shape[0], 1), dtype=np.float64)
-      self.err_function(xk_k, delta_x, x_new)
-      xk_n[:d1] = x_new[:d1, 0]
-      Pk_n = Pk_k
-      Pk_n[:d2, :d2] = Pk_k[:d2, :d2] + Ck.dot(Pk1_n[:d2, :d2] - Pk1_k[:d2, :d2]).dot(Ck.T)
-      states_smoothed.append(xk_n)
-      covs_smoothed.append(Pk_n)
-
-    return np.flipud(np.vstack(states_smoothed)), np.stack(covs_smoothed, 0)[::-1]
+    x_pred = np.array([e[0] for e in estimates], dtype=np.float64)
+    x_filt = np.array([e[1] for e in estimates], dtype=np.float64)
+    # smoothing has always started from the last prediction here, rather than the last filtered state
+    x_filt[-1] = x_pred[-1]
+    P_pred = np.array([e[2] for e in estimates], dtype=np.float64)
+    P_filt = np.array([e[3] for e in estimates], dtype=np.float64)
+    P_filt[-1] = P_pred[-1]
+    t = np.array([e[4] for e in estimates], dtype=np.float64)
+    return self.rts_smooth_batch(x_pred, x_filt, P_pred, P_filt, t, norm_quats)
+
+  def rts_smooth_batch(self, x_pred, x_filt, P_pred, P_filt, t, norm_quats=False):
+    '''
+    Returns rts smoothed states (N, dim_x) and covariances (N, dim_err, dim_err)
+    from the predicted and filtered states and covariances of N filter steps
+    at times t, starting from the last filtered state. The Jacobians and the
+    backward pass are all evaluated in the generated code.
+    If the kalman state is augmented with
+    old states only the main state is smoothed
+    '''
+    x_pred = np.ascontiguousarray(x_pred, dtype=np.float64).reshape((-1, self.dim_x))
+    x_filt = np.ascontiguousarray(x_filt, dtype=np.float64).reshape((-1, self.dim_x))
+    P_pred = np.ascontiguousarray(P_pred, dtype=np.float64)
+    P_filt = np.ascontiguousarray(P_filt, dtype=np.float64)
+    n = x_pred.shape[0]
+    assert n > 0 and x_filt.shape[0] == n
+    assert P_pred.shape == P_filt.shape == (n, self.dim_err, self.dim_err)
+
+    dt = np.ascontiguousarray(np.diff(np.asarray(t, dtype=np.float64)))
+    assert dt.shape == (n - 1,)
+
+    states_smoothed = np.empty((n, self.dim_x), dtype=np.float64)
+    covs_smoothed = np.empty((n, self.dim_err, self.dim_err), dtype=np.float64)
+    self._rts_smooth(x_pred, x_filt, P_pred, P_filt, dt, 3 if norm_quats else -1, states_smoothed, covs_smoothed)
+    return states_smoothed, covs_smoothed
+
+  def fixed_lag_smoother(self, lag, norm_quats=False):
+    return FixedLagSmoother(self, lag, norm_quats)
+
+
+class FixedLagSmoother():
+  '''
+  Streaming rts smoother with bounded memory. Each filter estimate
+  pushed in returns the estimate from lag steps earlier, smoothed
+  over the steps since, and flush returns the ones still pending
+  '''
+  def __init__(self, ekf, lag, norm_quats=False):
+    assert lag > 0
+    self.ekf = ekf
+    self.window = lag + 1
+    self.norm_quats = norm_quats
+    self.x_pred = np.zeros((self.window, ekf.dim_x), dtype=np.float64)
+    self.x_filt = np.zeros((self.window, ekf.dim_x), dtype=np.float64)
+    self.P_pred = np.zeros((self.window, ekf.dim_err, ekf.dim_err), dtype=np.float64)
+    self.P_filt = np.zeros((self.window, ekf.dim_err, ekf.dim_err), dtype=np.float64)
+    self.t = np.zeros(self.window, dtype=np.float64)
+    self.n = 0
+
+  def push(self, estimate):
+    '''
+    Takes an estimate as returned by predict_and_update_batch, and returns
+    (t, x, P) of the estimate lag steps before it once there is one
+    '''
+    if self.n == self.window:
+      for buf in (self.x_pred, self.x_filt, self.P_pred, self.P_filt, self.t):
+        buf[:-1] = buf[1:]
+      self.n -= 1
+
+    xk_km1, xk_k, Pk_km1, Pk_k, t = estimate[:5]
+    self.x_pred[self.n] = np.ravel(xk_km1)
+    self.x_filt[self.n] = np.ravel(xk_k)
+    self.P_pred[self.n] = Pk_km1
+    self.P_filt[self.n] = Pk_k
+    self.t[self.n] = t
+    self.n += 1
+
+    if self.n < self.window:
+      return None
+    x, P = self.smooth()
+    return self.t[0], x[0], P[0]
+
+  def flush(self):
+    '''
+    Returns (t, x, P) of the estimates that haven't been returned yet
+    '''
+    if self.n == 0:
+      return []
+    x, P = self.smooth()
+    start = 1 if self.n == self.window else 0
+    ret = [(self.t[i], x[i], P[i]) for i in range(start, self.n)]
+    self.n = 0
+    return ret
+
+  def smooth(self):
+    n = self.n
+    return self.ekf.rts_smooth_batch(self.x_pred[:n], self.x_filt[:n], self.P_pred[:n], self.P_filt[:n], self.t[:n], self.norm_quats)
@@ -179,6 +179,17 @@ cdef class EKF_sym_pyx:
       extra_args,
     )
 
+  def predict_and_update_multi(self, double t, observations, bool augment=False):
+    # same results as EKF_sym.predict_and_update_multi, but the C++ filter has no fused update, so each kind
+    # is still its own predict, with dt = 0 after the first, and checkpoint
+    ret = []
+    for i, (kind, z, R, *extra_args) in enumerate(observations):
+      res = self.predict_and_update_batch(t, kind, z, R, extra_args[0] if extra_args else [[]], augment and i == len(observations) - 1)
+      if res is None:
+        return None
+      ret.append(res)
+    return ret
+
   def augment(self):
     raise NotImplementedError()  # TODO
 
@@ -50,3 +50,14 @@ class KalmanFilter:
       R = self.get_R(kind, len(data))
 
     self.filter.predict_and_update_batch(t, kind, data, R)
+
+  def predict_and_observe_multi(self, t, observations):
+    # observations are (kind, data) or (kind, data, R), all observed at t. EKF_sym fuses them behind a single predict
+    # and checkpoint, the C++ EKF_sym_pyx still runs them one kind at a time with the same results
+    batch = []
+    for kind, data, *R in observations:
+      if len(data) > 0:
+        data = np.atleast_2d(data)
+      batch.append((kind, data, R[0] if R else self.get_R(kind, len(data))))
+
+    self.filter.predict_and_update_multi(t, batch)
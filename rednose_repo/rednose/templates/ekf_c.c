@@ -120,4 +120,49 @@ void update(double *in_x, double *in_P, Hfun h_fun, Hfun H_fun, Hfun Hea_fun, do
   memcpy(in_z, y.data(), y.rows() * sizeof(double));
 }
 
+// Rauch-Tung-Striebel backward pass over n filter steps, smoothing the main state only.
+// x_filt's last row is where smoothing starts, and quaternions at quat_idx are normalized
+// before they're smoothed over if quat_idx >= 0
+void rts_smooth(double *x_pred, double *x_filt, double *P_pred, double *P_filt, double *dt, int n, int quat_idx,
+                double *out_x, double *out_P) {
+  typedef Eigen::Matrix<double, MEDIM, MEDIM, Eigen::RowMajor> RRM;
+  typedef Eigen::Matrix<double, MEDIM, 1> R1M;
+
+  double in_F[EDIM*EDIM] = {0};
+  double delta_x[EDIM] = {0};
+  double x_new[DIM] = {0};
+
+  memcpy(out_x, x_filt, n * DIM * sizeof(double));
+  memcpy(out_P, P_filt, n * EDIM * EDIM * sizeof(double));
+
+  for (int k = n - 2; k >= 0; k--) {
+    double *xk1_n = out_x + (k + 1) * DIM;
+    double *xk1_k = x_pred + (k + 1) * DIM;
+    double *xk_k = x_filt + k * DIM;
+    if (quat_idx >= 0) {
+      Eigen::Map<Eigen::Vector4d> q(xk1_n + quat_idx);
+      q /= q.norm();
+    }
+
+    // functions from sympy
+    F_fun(xk_k, dt[k], in_F);
+
+    Eigen::Map<EEM> F(in_F);
+    Eigen::Map<EEM> Pk1_k(P_pred + (k + 1) * EDIM * EDIM);
+    Eigen::Map<EEM> Pk_k(P_filt + k * EDIM * EDIM);
+    Eigen::Map<EEM> Pk1_n(out_P + (k + 1) * EDIM * EDIM);
+    Eigen::Map<EEM> Pk_n(out_P + k * EDIM * EDIM);
+
+    RRM F_main = F.topLeftCorner(MEDIM, MEDIM);
+    RRM Pk_main = Pk_k.topLeftCorner(MEDIM, MEDIM);
+    RRM Ck = Pk1_k.topLeftCorner(MEDIM, MEDIM).partialPivLu().solve(F_main * Pk_main.transpose()).transpose();
 
+    inv_err_fun(xk1_k, xk1_n, delta_x);
+    Eigen::Map<R1M> delta_main(delta_x);
+    delta_main = Ck * delta_main;
+    err_fun(xk_k, delta_x, x_new);
+    memcpy(out_x + k * DIM, x_new, MDIM * sizeof(double));
+
+    Pk_n.topLeftCorner(MEDIM, MEDIM) = Pk_main + Ck * (Pk1_n.topLeftCorner(MEDIM, MEDIM) - Pk1_k.topLeftCorner(MEDIM, MEDIM)) * Ck.transpose();
+  }
+}
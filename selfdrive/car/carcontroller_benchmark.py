@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+from opendbc.can.packer import CANPacker
+from openpilot.frogpilot.common.frogpilot_variables import get_frogpilot_toggles
+from openpilot.selfdrive.car.car_helpers import get_car_interface
+from openpilot.tools.lib.logreader import LogReader
+
+
+class RecordingPacker:
+  # stands in for a CarController's packer, keeping every make_can_msg call of the cycle
+  def __init__(self, packer: CANPacker, calls: list):
+    self.packer = packer
+    self.calls = calls
+
+  def __getattr__(self, name):
+    return getattr(self.packer, name)
+
+  def make_can_msg(self, name_or_addr, bus, values):
+    self.calls.append((self.packer.dbc_name, name_or_addr, bus, dict(values)))
+    return self.packer.make_can_msg(name_or_addr, bus, values)
+
+
+def load_route(route: str, max_cycles: int):
+  CP, FPCP, CC, cycles = None, None, None, []
+  for msg in LogReader(route, services=['can', 'carParams', 'frogpilotCarParams', 'carControl']):
+    if msg.which() == 'carParams':
+      CP = CP or msg.carParams
+    elif msg.which() == 'frogpilotCarParams':
+      FPCP = FPCP or msg.frogpilotCarParams
+    elif msg.which() == 'carControl':
+      CC = msg.carControl
+    elif CC is not None and len(cycles) < max_cycles:
+      cycles.append((msg.logMonoTime, [msg.as_builder().to_bytes()], CC.as_builder()))
+  assert CP is not None and FPCP is not None, "route has no carParams"
+  return CP, FPCP, cycles
+
+
+def record_frames(CP, FPCP, cycles) -> list[list[tuple]]:
+  # the (dbc, message, bus, values) the car's CarController packs each cycle of the route
+  CI = get_car_interface(CP.as_builder(), FPCP.as_builder())
+  toggles = get_frogpilot_toggles(block=False)
+  calls: list[tuple] = []
+  for name, value in vars(CI.CC).items():
+    if isinstance(value, CANPacker):
+      setattr(CI.CC, name, RecordingPacker(value, calls))
+
+  frames = []
+  for now_nanos, can_strings, CC in cycles:
+    CI.update(CC, can_strings, toggles)
+    CI.apply(CC, now_nanos, toggles)
+    frames.append(calls[:])
+    calls.clear()
+  return frames
+
+
+def pack_legacy(packers: dict, frames: list[list[tuple]]) -> tuple[float, list]:
+  out = []
+  t = time.process_time_ns()
+  for calls in frames:
+    out.append([packers[dbc_name].make_can_msg(msg, bus, values) for dbc_name, msg, bus, values in calls])
+  return (time.process_time_ns() - t) / len(frames) / 1e3, out
+
+
+def pack_templates(packers: dict, frames: list[list[tuple]]) -> tuple[float, list]:
+  # templates are built once, like a CarController would in its __init__, and the values are passed in order
+  templates = {}
+  cycles = []
+  for calls in frames:
+    cycle: dict[str, list] = {dbc_name: [] for dbc_name in packers}
+    for dbc_name, msg, bus, values in calls:
+      key = (dbc_name, msg, bus, tuple(values))
+      if key not in templates:
+        templates[key] = packers[dbc_name].template(msg, bus, list(values))
+      cycle[dbc_name].append((templates[key], list(values.values())))
+    cycles.append(cycle)
+
+  out = []
+  t = time.process_time_ns()
+  for cycle in cycles:
+    frame = []
+    for dbc_name, items in cycle.items():
+      frame += packers[dbc_name].pack_many(items)
+    out.append(frame)
+  return (time.process_time_ns() - t) / len(frames) / 1e3, out
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Per-cycle cost of packing a CarController's can messages, one route per brand")
+  parser.add_argument("routes", nargs="+", help="routes or segments to replay, anything LogReader accepts")
+  parser.add_argument("--cycles", type=int, default=6000)
+  args = parser.parse_args()
+
+  for route in args.routes:
+    CP, FPCP, cycles = load_route(route, args.cycles)
+    frames = record_frames(CP, FPCP, cycles)
+    dbc_names = {call[0] for calls in frames for call in calls}
+    print(f"{CP.carName} ({CP.carFingerprint}): {len(frames)} cycles, {sum(map(len, frames)) / len(frames):.1f} messages per cycle")
+
+    before, legacy_out = pack_legacy({dbc_name: CANPacker(dbc_name) for dbc_name in dbc_names}, frames)
+    after, template_out = pack_templates({dbc_name: CANPacker(dbc_name) for dbc_name in dbc_names}, frames)
+    same = all(sorted(a) == sorted(b) for a, b in zip(legacy_out, template_out, strict=True))
+    print(f"  make_can_msg {before:7.1f} us, templates + pack_many {after:7.1f} us per cycle, same frames: {same}")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+
+from cereal import car
+from openpilot.frogpilot.common.frogpilot_variables import get_frogpilot_toggles
+from openpilot.selfdrive.car.car_helpers import get_car_interface
+from openpilot.tools.lib.logreader import LogReader
+
+
+def load_route(route: str, max_cycles: int):
+  CP, FPCP, cycles = None, None, []
+  for msg in LogReader(route, services=['can', 'carParams', 'frogpilotCarParams']):
+    if msg.which() == 'carParams':
+      CP = CP or msg.carParams
+    elif msg.which() == 'frogpilotCarParams':
+      FPCP = FPCP or msg.frogpilotCarParams
+    elif len(cycles) < max_cycles:
+      # pandad publishes can at 100Hz, so each event is one card cycle
+      cycles.append([msg.as_builder().to_bytes()])
+  assert CP is not None and FPCP is not None, "route has no carParams"
+  return CP, FPCP, cycles
+
+
+def parse_legacy(CI, can_strings: list[bytes]) -> None:
+  # every parser converts and deserializes the can strings on its own, as CarInterfaceBase.update used to
+  for cp in CI.can_parsers:
+    if cp is not None:
+      cp.update_strings(can_strings)
+
+
+def benchmark(CI, update, cycles: list[list[bytes]]) -> np.ndarray:
+  CC = car.CarControl.new_message()
+  toggles = get_frogpilot_toggles(block=False)
+  times = np.empty(len(cycles))
+  for i, can_strings in enumerate(cycles):
+    t = time.process_time_ns()
+    update(CC, can_strings, toggles)
+    times[i] = time.process_time_ns() - t
+  return times / 1e3
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Per-cycle CPU of CarInterface.update replaying a route's can")
+  parser.add_argument("route", help="route or segment to replay, anything LogReader accepts")
+  parser.add_argument("--cycles", type=int, default=6000)
+  args = parser.parse_args()
+
+  CP, FPCP, cycles = load_route(args.route, args.cycles)
+  print(f"{CP.carFingerprint}, {len(cycles)} cycles")
+
+  CI = get_car_interface(CP.as_builder(), FPCP.as_builder())
+  runs = (
+    ("parsers only, before", lambda CC, can_strings, toggles: parse_legacy(CI, can_strings)),
+    ("parsers only, after", lambda CC, can_strings, toggles: CI.parse_can(can_strings)),
+    ("CarInterface.update", CI.update),
+  )
+  for name, update in runs:
+    times = benchmark(CI, update, cycles)
+    print(f"{name:>22}: mean {times.mean():7.1f} us, p50 {np.percentile(times, 50):7.1f} us, p99 {np.percentile(times, 99):7.1f} us")
@@ -10,6 +10,7 @@ from functools import cache
 from types import SimpleNamespace
 
 from cereal import car, custom
+from opendbc.can.parser import CANStrings
 from openpilot.common.basedir import BASEDIR
 from openpilot.common.conversions import Conversions as CV
 from openpilot.common.params import Params
@@ -290,12 +291,17 @@ class CarInterfaceBase(ABC):
   def _update(self, c: car.CarControl) -> car.CarState:
     pass
 
-  def update(self, c: car.CarControl, can_strings: list[bytes], frogpilot_toggles) -> car.CarState:
-    # parse can
+  def parse_can(self, can_strings: list[bytes]) -> None:
+    # convert the can strings once and share them between all the parsers, each only keeps its own bus and addresses
+    can_strings = CANStrings(can_strings)
     for cp in self.can_parsers:
       if cp is not None:
         cp.update_strings(can_strings)
 
+  def update(self, c: car.CarControl, can_strings: list[bytes], frogpilot_toggles) -> car.CarState:
+    # parse can
+    self.parse_can(can_strings)
+
     # get CarState
     ret, fp_ret = self._update(c, frogpilot_toggles)
 
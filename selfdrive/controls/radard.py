@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import importlib
-import math
 from collections import deque
 from types import SimpleNamespace
-from typing import Any
+from typing import Any, NamedTuple
 
 import capnp
+import numpy as np
 from cereal import messaging, log, car
 from openpilot.common.filter_simple import FirstOrderFilter
 from openpilot.common.numpy_fast import interp
@@ -13,8 +13,6 @@ from openpilot.common.params import Params
 from openpilot.common.realtime import DT_CTRL, DT_MDL, Ratekeeper, Priority, config_realtime_process
 from openpilot.common.swaglog import cloudlog
 
-from openpilot.common.simple_kalman import KF1D
-
 from openpilot.frogpilot.common.frogpilot_variables import get_frogpilot_toggles
 
 # Default lead acceleration decay set to 50% at 1s
@@ -52,116 +50,156 @@ class KalmanParams:
     self.K = [[interp(dt, dts, K0)], [interp(dt, dts, K1)]]
 
 
-class Track:
-  def __init__(self, identifier: int, v_lead: float, kalman_params: KalmanParams):
-    self.identifier = identifier
-    self.cnt = 0
-    self.aLeadTau = FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL)
-    self.K_A = kalman_params.A
-    self.K_C = kalman_params.C
-    self.K_K = kalman_params.K
-    self.kf = KF1D([[v_lead], [0.0]], self.K_A, self.K_C, self.K_K)
+class LaneLines(NamedTuple):
+  left_x: np.ndarray
+  left_y: np.ndarray
+  right_x: np.ndarray
+  right_y: np.ndarray
 
-    # FrogPilot variables
-    self.lead_track_id = 0
 
-  def update(self, d_rel: float, y_rel: float, v_rel: float, v_lead: float, measured: float):
-    # relative values, copy
-    self.dRel = d_rel   # LONG_DIST
-    self.yRel = y_rel   # -LAT_DIST
-    self.vRel = v_rel   # REL_SPEED
-    self.vLead = v_lead
-    self.measured = measured   # measured or estimate
+class Tracks:
+  # Struct of arrays of the radar tracks, one row per radar point. Kalman filters, vision matching and lane checks
+  # run on all of the rows at once instead of one object per track.
 
-    # computed velocity and accelerations
-    if self.cnt > 0:
-      self.kf.update(self.vLead)
+  def __init__(self, kalman_params: KalmanParams):
+    A, C, K = kalman_params.A, kalman_params.C, kalman_params.K
+    # KF1D with the gain precomputed, x = (A - K C) x + K meas
+    self.A_K = (A[0][0] - K[0][0] * C[0], A[0][1] - K[0][0] * C[1], A[1][0] - K[1][0] * C[0], A[1][1] - K[1][0] * C[1])
+    self.K = (K[0][0], K[1][0])
+    self.a_lead_tau_alpha = FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL).alpha
 
-    self.vLeadK = float(self.kf.x[SPEED][0])
-    self.aLeadK = float(self.kf.x[ACCEL][0])
+    self.identifier = np.empty(0, dtype=np.int64)
+    self.cnt = np.empty(0, dtype=np.int64)
+    self.dRel = np.empty(0)
+    self.yRel = np.empty(0)
+    self.vRel = np.empty(0)
+    self.vLead = np.empty(0)
+    self.measured = np.empty(0, dtype=bool)
+    self.vLeadK = np.empty(0)
+    self.aLeadK = np.empty(0)
+    self.aLeadTau = np.empty(0)
+
+    # FrogPilot variables
+    self.lead_track_id = np.empty(0, dtype=np.int64)
+
+  def __len__(self) -> int:
+    return len(self.identifier)
+
+  def update(self, points: dict[int, list], v_ego: float):
+    # points is {trackId: [dRel, yRel, vRel, measured]}, tracks that are gone are dropped and new ones appended
+    ids = np.fromiter(points.keys(), dtype=np.int64, count=len(points))
+    pts = np.array(list(points.values()), dtype=np.float64).reshape(-1, 4)
+
+    keep = np.isin(self.identifier, ids)
+    new = ~np.isin(ids, self.identifier)
+    num_new = int(new.sum())
+
+    self.identifier = np.concatenate([self.identifier[keep], ids[new]])
+    sorter = np.argsort(ids)
+    rows = sorter[np.searchsorted(ids, self.identifier, sorter=sorter)]
+    self.dRel, self.yRel, self.vRel = pts[rows, 0], pts[rows, 1], pts[rows, 2]
+    self.measured = pts[rows, 3].astype(bool)
+    # align v_ego by a fixed time to align it with the radar measurement
+    self.vLead = self.vRel + v_ego
+
+    # new tracks start with the Kalman state at the measured speed and no acceleration
+    self.cnt = np.concatenate([self.cnt[keep], np.zeros(num_new, dtype=np.int64)])
+    v_lead_k = np.concatenate([self.vLeadK[keep], self.vLead[-num_new:] if num_new else []])
+    a_lead_k = np.concatenate([self.aLeadK[keep], np.zeros(num_new)])
+    self.aLeadTau = np.concatenate([self.aLeadTau[keep], np.full(num_new, _LEAD_ACCEL_TAU)])
+    self.lead_track_id = np.concatenate([self.lead_track_id[keep], np.zeros(num_new, dtype=np.int64)])
+
+    # computed velocity and accelerations
+    seen = self.cnt > 0
+    self.vLeadK = np.where(seen, self.A_K[0] * v_lead_k + self.A_K[1] * a_lead_k + self.K[0] * self.vLead, v_lead_k)
+    self.aLeadK = np.where(seen, self.A_K[2] * v_lead_k + self.A_K[3] * a_lead_k + self.K[1] * self.vLead, a_lead_k)
 
     # Learn if constant acceleration
-    if abs(self.aLeadK) < 0.5:
-      self.aLeadTau.x = _LEAD_ACCEL_TAU
-    else:
-      self.aLeadTau.update(0.0)
+    self.aLeadTau = np.where(np.abs(self.aLeadK) < 0.5, _LEAD_ACCEL_TAU, (1. - self.a_lead_tau_alpha) * self.aLeadTau)
 
     self.cnt += 1
 
-  def get_RadarState(self, model_prob: float = 0.0):
+  def get_RadarState(self, i: int, model_prob: float = 0.0):
     return {
-      "dRel": float(self.dRel),
-      "yRel": float(self.yRel),
-      "vRel": float(self.vRel),
-      "vLead": float(self.vLead),
-      "vLeadK": float(self.vLeadK),
-      "aLeadK": float(self.aLeadK),
-      "aLeadTau": float(self.aLeadTau.x),
+      "dRel": float(self.dRel[i]),
+      "yRel": float(self.yRel[i]),
+      "vRel": float(self.vRel[i]),
+      "vLead": float(self.vLead[i]),
+      "vLeadK": float(self.vLeadK[i]),
+      "aLeadK": float(self.aLeadK[i]),
+      "aLeadTau": float(self.aLeadTau[i]),
       "status": True,
-      "fcw": self.is_potential_fcw(model_prob),
+      "fcw": is_potential_fcw(model_prob),
       "modelProb": model_prob,
       "radar": True,
-      "radarTrackId": self.identifier,
+      "radarTrackId": int(self.identifier[i]),
       "farLead": False,
     }
 
-  def potential_adjacent_lead(self, left: bool, standstill: bool, model_data: capnp._DynamicStructReader):
-    if standstill or self.vLeadK < 1 or self.lead_track_id == self.identifier:
-      return False
+  def closest(self, mask: np.ndarray) -> int | None:
+    # index of the nearest track among mask
+    candidates = np.flatnonzero(mask)
+    if len(candidates) == 0:
+      return None
+    return int(candidates[np.argmin(self.dRel[candidates])])
+
+  def potential_adjacent_lead(self, left: bool, standstill: bool, lane_lines: LaneLines | None) -> np.ndarray:
+    if standstill or lane_lines is None:
+      return np.zeros(len(self), dtype=bool)
 
+    mask = (self.vLeadK >= 1) & (self.lead_track_id != self.identifier)
     if left:
-      left_lane = interp(self.dRel, model_data.laneLines[1].x, model_data.laneLines[1].y)
-      return -self.yRel < left_lane
+      return mask & (-self.yRel < np.interp(self.dRel, lane_lines.left_x, lane_lines.left_y))
     else:
-      right_lane = interp(self.dRel, model_data.laneLines[2].x, model_data.laneLines[2].y)
-      return -self.yRel > right_lane
+      return mask & (-self.yRel > np.interp(self.dRel, lane_lines.right_x, lane_lines.right_y))
 
-  def potential_far_lead(self, standstill: bool, model_data: capnp._DynamicStructReader):
-    if standstill or self.vLeadK < 1 or abs(self.yRel) > 1:
-      return False
+  def potential_far_lead(self, standstill: bool, lane_lines: LaneLines | None) -> np.ndarray:
+    if standstill or lane_lines is None:
+      return np.zeros(len(self), dtype=bool)
 
-    left_lane = interp(self.dRel, model_data.laneLines[1].x, model_data.laneLines[1].y)
-    right_lane = interp(self.dRel, model_data.laneLines[2].x, model_data.laneLines[2].y)
+    left_lane = np.interp(self.dRel, lane_lines.left_x, lane_lines.left_y)
+    right_lane = np.interp(self.dRel, lane_lines.right_x, lane_lines.right_y)
+    return (self.vLeadK >= 1) & (np.abs(self.yRel) <= 1) & (left_lane < -self.yRel) & (-self.yRel < right_lane)
 
-    return left_lane < -self.yRel < right_lane
-
-  def potential_low_speed_lead(self, v_ego: float):
+  def potential_low_speed_lead(self, v_ego: float) -> np.ndarray:
     # stop for stuff in front of you and low speed, even without model confirmation
     # Radar points closer than 0.75, are almost always glitches on toyota radars
-    return abs(self.yRel) < 1.0 and (v_ego < V_EGO_STATIONARY) and (0.75 < self.dRel < 25)
+    return (np.abs(self.yRel) < 1.0) & (v_ego < V_EGO_STATIONARY) & (0.75 < self.dRel) & (self.dRel < 25)
+
 
-  def is_potential_fcw(self, model_prob: float):
-    return model_prob > .9
+def get_lane_lines(model_data: capnp._DynamicStructReader) -> LaneLines | None:
+  # the lane lines on either side of the car, converted once per model frame instead of once per track
+  if len(model_data.laneLines) < 3 or len(model_data.laneLines[1].x) == 0 or len(model_data.laneLines[2].x) == 0:
+    return None
+  left, right = model_data.laneLines[1], model_data.laneLines[2]
+  return LaneLines(np.array(left.x), np.array(left.y), np.array(right.x), np.array(right.y))
 
-  def __str__(self):
-    ret = f"x: {self.dRel:4.1f}  y: {self.yRel:4.1f}  v: {self.vRel:4.1f}  a: {self.aLeadK:4.1f}"
-    return ret
 
+def is_potential_fcw(model_prob: float):
+  return model_prob > .9
 
-def laplacian_pdf(x: float, mu: float, b: float):
+
+def laplacian_pdf(x: np.ndarray, mu: float, b: float):
   b = max(b, 1e-4)
-  return math.exp(-abs(x-mu)/b)
+  return np.exp(-np.abs(x-mu)/b)
 
 
-def match_vision_to_track(v_ego: float, lead: capnp._DynamicStructReader, tracks: dict[int, Track]):
+def match_vision_to_track(v_ego: float, lead: capnp._DynamicStructReader, tracks: Tracks) -> int | None:
   offset_vision_dist = lead.x[0] - RADAR_TO_CAMERA
 
-  def prob(c):
-    prob_d = laplacian_pdf(c.dRel, offset_vision_dist, lead.xStd[0])
-    prob_y = laplacian_pdf(c.yRel, -lead.y[0], lead.yStd[0])
-    prob_v = laplacian_pdf(c.vRel + v_ego, lead.v[0], lead.vStd[0])
-
-    # This isn't exactly right, but it's a good heuristic
-    return prob_d * prob_y * prob_v
+  prob_d = laplacian_pdf(tracks.dRel, offset_vision_dist, lead.xStd[0])
+  prob_y = laplacian_pdf(tracks.yRel, -lead.y[0], lead.yStd[0])
+  prob_v = laplacian_pdf(tracks.vRel + v_ego, lead.v[0], lead.vStd[0])
 
-  track = max(tracks.values(), key=prob)
+  # This isn't exactly right, but it's a good heuristic
+  i = int(np.argmax(prob_d * prob_y * prob_v))
 
   # if no 'sane' match is found return -1
   # stationary radar points can be false positives
-  dist_sane = abs(track.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
-  vel_sane = (abs(track.vRel + v_ego - lead.v[0]) < 10) or (v_ego + track.vRel > 3)
+  dist_sane = abs(tracks.dRel[i] - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
+  vel_sane = (abs(tracks.vRel[i] + v_ego - lead.v[0]) < 10) or (v_ego + tracks.vRel[i] > 3)
   if dist_sane and vel_sane:
-    return track
+    return i
   else:
     return None
 
@@ -185,8 +223,8 @@ def get_RadarState_from_vision(lead_msg: capnp._DynamicStructReader, v_ego: floa
   }
 
 
-def get_lead(v_ego: float, ready: bool, tracks: dict[int, Track], lead_msg: capnp._DynamicStructReader,
-             model_v_ego: float, model_data: capnp._DynamicStructReader, standstill: bool,
+def get_lead(v_ego: float, ready: bool, tracks: Tracks, lead_msg: capnp._DynamicStructReader,
+             model_v_ego: float, lane_lines: LaneLines | None, standstill: bool,
              frogpilot_toggles: SimpleNamespace, frogpilotCarState: capnp._DynamicStructReader,
              low_speed_override: bool = True) -> dict[str, Any]:
   # Determine leads, this is where the essential logic happens
@@ -197,29 +235,25 @@ def get_lead(v_ego: float, ready: bool, tracks: dict[int, Track], lead_msg: capn
 
   lead_dict = {'status': False}
   if track is not None:
-    lead_dict = track.get_RadarState(lead_msg.prob)
+    lead_dict = tracks.get_RadarState(track, lead_msg.prob)
   elif (track is None) and ready and (lead_msg.prob > frogpilot_toggles.lead_detection_probability):
     lead_dict = get_RadarState_from_vision(lead_msg, v_ego, model_v_ego)
 
   if low_speed_override:
-    low_speed_tracks = [c for c in tracks.values() if c.potential_low_speed_lead(v_ego)]
-    if len(low_speed_tracks) > 0:
-      closest_track = min(low_speed_tracks, key=lambda c: c.dRel)
-
+    closest_track = tracks.closest(tracks.potential_low_speed_lead(v_ego))
+    if closest_track is not None:
       # Only choose new track if it is actually closer than the previous one
-      if (not lead_dict['status']) or (closest_track.dRel < lead_dict['dRel']):
-        lead_dict = closest_track.get_RadarState()
+      if (not lead_dict['status']) or (tracks.dRel[closest_track] < lead_dict['dRel']):
+        lead_dict = tracks.get_RadarState(closest_track)
 
     if not lead_dict['status'] and len(tracks) > 0:
-      far_lead_tracks = [c for c in tracks.values() if c.potential_far_lead(standstill, model_data)]
-      if len(far_lead_tracks) > 0:
-        closest_track = min(far_lead_tracks, key=lambda c: c.dRel)
-        lead_dict = closest_track.get_RadarState()
+      closest_track = tracks.closest(tracks.potential_far_lead(standstill, lane_lines))
+      if closest_track is not None:
+        lead_dict = tracks.get_RadarState(closest_track)
         lead_dict['farLead'] = True
         lead_dict['vLead'] = lead_dict['vLeadK']
 
-  for track in tracks.values():
-    track.lead_track_id = lead_dict.get('radarTrackId', -1)
+  tracks.lead_track_id[:] = lead_dict.get('radarTrackId', -1)
 
   if 'dRel' in lead_dict:
     lead_dict['dRel'] -= frogpilot_toggles.increased_stopped_distance if not frogpilotCarState.trafficModeEnabled else 0
@@ -227,13 +261,12 @@ def get_lead(v_ego: float, ready: bool, tracks: dict[int, Track], lead_msg: capn
   return lead_dict
 
 
-def get_adjacent_lead(tracks: dict[int, Track], standstill: bool, model_data: capnp._DynamicStructReader, left: bool = True) -> dict[str, Any]:
+def get_adjacent_lead(tracks: Tracks, standstill: bool, lane_lines: LaneLines | None, left: bool = True) -> dict[str, Any]:
   lead_dict = {'status': False}
 
-  adjacent_tracks = [c for c in tracks.values() if c.potential_adjacent_lead(left, standstill, model_data)]
-  if len(adjacent_tracks) > 0:
-    closest_track = min(adjacent_tracks, key=lambda c: c.dRel)
-    lead_dict = closest_track.get_RadarState()
+  closest_track = tracks.closest(tracks.potential_adjacent_lead(left, standstill, lane_lines))
+  if closest_track is not None:
+    lead_dict = tracks.get_RadarState(closest_track)
 
   return lead_dict
 
@@ -242,8 +275,11 @@ class RadarD:
   def __init__(self, radar_ts: float, delay: int = 0):
     self.current_time = 0.0
 
-    self.tracks: dict[int, Track] = {}
     self.kalman_params = KalmanParams(radar_ts)
+    self.tracks = Tracks(self.kalman_params)
+
+    self.lane_lines: LaneLines | None = None
+    self.lane_lines_mono_time = -1
 
     self.v_ego = 0.0
     self.v_ego_hist = deque([0.0], maxlen=delay+1)
@@ -278,22 +314,12 @@ class RadarD:
     for pt in radar_points:
       ar_pts[pt.trackId] = [pt.dRel, pt.yRel, pt.vRel, pt.measured]
 
-    # *** remove missing points from meta data ***
-    for ids in list(self.tracks.keys()):
-      if ids not in ar_pts:
-        self.tracks.pop(ids, None)
-
     # *** compute the tracks ***
-    for ids in ar_pts:
-      rpt = ar_pts[ids]
-
-      # align v_ego by a fixed time to align it with the radar measurement
-      v_lead = rpt[2] + self.v_ego_hist[0]
+    self.tracks.update(ar_pts, self.v_ego_hist[0])
 
-      # create the track if it doesn't exist or it's a new track
-      if ids not in self.tracks:
-        self.tracks[ids] = Track(ids, v_lead, self.kalman_params)
-      self.tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
+    if sm.logMonoTime['modelV2'] != self.lane_lines_mono_time:
+      self.lane_lines = get_lane_lines(sm['modelV2'])
+      self.lane_lines_mono_time = sm.logMonoTime['modelV2']
 
     # *** publish radarState ***
     self.radar_state_valid = sm.all_checks() and len(radar_errors) == 0
@@ -310,12 +336,12 @@ class RadarD:
       model_v_ego = self.v_ego
     leads_v3 = sm['modelV2'].leadsV3
     if len(leads_v3) > 1:
-      self.radar_state.leadOne = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[0], model_v_ego, sm['modelV2'], sm['carState'].standstill, self.frogpilot_toggles, sm['frogpilotCarState'], low_speed_override=True)
-      self.radar_state.leadTwo = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[1], model_v_ego, sm['modelV2'], sm['carState'].standstill, self.frogpilot_toggles, sm['frogpilotCarState'], low_speed_override=False)
+      self.radar_state.leadOne = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[0], model_v_ego, self.lane_lines, sm['carState'].standstill, self.frogpilot_toggles, sm['frogpilotCarState'], low_speed_override=True)
+      self.radar_state.leadTwo = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[1], model_v_ego, self.lane_lines, sm['carState'].standstill, self.frogpilot_toggles, sm['frogpilotCarState'], low_speed_override=False)
 
     if self.frogpilot_toggles.adjacent_lead_tracking and self.ready:
-      self.radar_state.leadLeft = get_adjacent_lead(self.tracks, sm['carState'].standstill, sm['modelV2'], left=True)
-      self.radar_state.leadRight = get_adjacent_lead(self.tracks, sm['carState'].standstill, sm['modelV2'], left=False)
+      self.radar_state.leadLeft = get_adjacent_lead(self.tracks, sm['carState'].standstill, self.lane_lines, left=True)
+      self.radar_state.leadRight = get_adjacent_lead(self.tracks, sm['carState'].standstill, self.lane_lines, left=False)
 
     # Update FrogPilot variables
     if sm['frogpilotPlan'].togglesUpdated:
@@ -333,12 +359,12 @@ class RadarD:
     # publish tracks for UI debugging (keep last)
     tracks_msg = messaging.new_message('liveTracks', len(self.tracks))
     tracks_msg.valid = self.radar_state_valid
-    for index, tid in enumerate(sorted(self.tracks.keys())):
+    for index, i in enumerate(np.argsort(self.tracks.identifier)):
       tracks_msg.liveTracks[index] = {
-        "trackId": tid,
-        "dRel": float(self.tracks[tid].dRel),
-        "yRel": float(self.tracks[tid].yRel),
-        "vRel": float(self.tracks[tid].vRel),
+        "trackId": int(self.tracks.identifier[i]),
+        "dRel": float(self.tracks.dRel[i]),
+        "yRel": float(self.tracks.yRel[i]),
+        "vRel": float(self.tracks.vRel[i]),
       }
     pm.send('liveTracks', tracks_msg)
 
@@ -52,27 +52,40 @@ def rotate_std(rot_matrix, std_in):
 
 
 class NPQueue:
+  # fixed capacity ring buffer. every row is written twice, maxlen apart, so the rows in
+  # insertion order are always a contiguous slice of the buffer
   def __init__(self, maxlen: int, rowsize: int) -> None:
     self.maxlen = maxlen
-    self.arr = np.empty((0, rowsize))
+    self.buf = np.empty((2 * maxlen, rowsize))
+    self.start = 0
+    self.len = 0
 
   def __len__(self) -> int:
-    return len(self.arr)
+    return self.len
+
+  @property
+  def arr(self) -> np.ndarray:
+    return self.buf[self.start:self.start + self.len]
 
   def append(self, pt: list[float]) -> None:
-    if len(self.arr) < self.maxlen:
-      self.arr = np.append(self.arr, [pt], axis=0)
+    idx = (self.start + self.len) % self.maxlen
+    self.buf[idx] = pt
+    self.buf[idx + self.maxlen] = pt
+    if self.len < self.maxlen:
+      self.len += 1
     else:
-      self.arr[:-1] = self.arr[1:]
-      self.arr[-1] = pt
+      self.start = (self.start + 1) % self.maxlen
 
 
 class PointBuckets:
-  def __init__(self, x_bounds: list[tuple[float, float]], min_points: list[float], min_points_total: int, points_per_bucket: int, rowsize: int) -> None:
+  def __init__(self, x_bounds: list[tuple[float, float]], min_points: list[float], min_points_total: int, points_per_bucket: int, rowsize: int,
+               rng: np.random.Generator | None = None) -> None:
     self.x_bounds = x_bounds
     self.buckets = {bounds: NPQueue(maxlen=points_per_bucket, rowsize=rowsize) for bounds in x_bounds}
     self.buckets_min_points = dict(zip(x_bounds, min_points, strict=True))
     self.min_points_total = min_points_total
+    self.rowsize = rowsize
+    self.rng = rng
 
   def __len__(self) -> int:
     return sum([len(v) for v in self.buckets.values()])
@@ -89,10 +102,23 @@ class PointBuckets:
     raise NotImplementedError
 
   def get_points(self, num_points: int = None) -> Any:
-    points = np.vstack([x.arr for x in self.buckets.values()])
+    arrs = [x.arr for x in self.buckets.values()]
     if num_points is None:
-      return points
-    return points[np.random.choice(np.arange(len(points)), min(len(points), num_points), replace=False)]
+      return np.vstack(arrs)
+
+    # sample over all buckets as if they were concatenated, then gather only the chosen rows from each
+    ends = np.cumsum([len(arr) for arr in arrs])
+    # without a generator of its own, each call seeds one from numpy's global state, so np.random.seed keeps sampling
+    # reproducible while choice(replace=False) still avoids permuting every point like np.random.choice does
+    rng = self.rng if self.rng is not None else np.random.default_rng(np.random.randint(2**63))
+    idxs = np.sort(rng.choice(ends[-1], min(ends[-1], num_points), replace=False))
+    splits = np.searchsorted(idxs, ends)
+    points = np.empty((len(idxs), self.rowsize))
+    lo = 0
+    for arr, end, hi in zip(arrs, ends, splits, strict=True):
+      points[lo:hi] = arr[idxs[lo:hi] - (end - len(arr))]
+      lo = hi
+    return points
 
   def load_points(self, points: list[list[float]]) -> None:
     for point in points:
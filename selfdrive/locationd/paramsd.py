@@ -71,27 +71,29 @@ class ParamsLearner:
       yaw_rate_valid = yaw_rate_valid and abs(self.yaw_rate) < 1  # rad/s
 
       if self.active:
+        # each group is observed at t with a single predict
+        observations = []
         if msg.posenetOK:
-
           if yaw_rate_valid:
-            self.kf.predict_and_observe(t,
-                                        ObservationKind.ROAD_FRAME_YAW_RATE,
-                                        np.array([[-self.yaw_rate]]),
-                                        np.array([np.atleast_2d(self.yaw_rate_std**2)]))
+            observations.append((ObservationKind.ROAD_FRAME_YAW_RATE,
+                                 np.array([[-self.yaw_rate]]),
+                                 np.array([np.atleast_2d(self.yaw_rate_std**2)])))
 
-          self.kf.predict_and_observe(t,
-                                      ObservationKind.ROAD_ROLL,
-                                      np.array([[self.roll]]),
-                                      np.array([np.atleast_2d(roll_std**2)]))
-        self.kf.predict_and_observe(t, ObservationKind.ANGLE_OFFSET_FAST, np.array([[0]]))
+          observations.append((ObservationKind.ROAD_ROLL,
+                               np.array([[self.roll]]),
+                               np.array([np.atleast_2d(roll_std**2)])))
+        observations.append((ObservationKind.ANGLE_OFFSET_FAST, np.array([[0]])))
+        self.kf.predict_and_observe_multi(t, observations)
 
         # We observe the current stiffness and steer ratio (with a high observation noise) to bound
         # the respective estimate STD. Otherwise the STDs keep increasing, causing rapid changes in the
         # states in longer routes (especially straight stretches).
         stiffness = float(self.kf.x[States.STIFFNESS].item())
         steer_ratio = float(self.kf.x[States.STEER_RATIO].item())
-        self.kf.predict_and_observe(t, ObservationKind.STIFFNESS, np.array([[stiffness]]))
-        self.kf.predict_and_observe(t, ObservationKind.STEER_RATIO, np.array([[steer_ratio]]))
+        self.kf.predict_and_observe_multi(t, [
+          (ObservationKind.STIFFNESS, np.array([[stiffness]])),
+          (ObservationKind.STEER_RATIO, np.array([[steer_ratio]])),
+        ])
 
     elif which == 'carState':
       self.steering_angle = msg.steeringAngleDeg
@@ -102,8 +104,10 @@ class ParamsLearner:
       self.active = self.speed > MIN_ACTIVE_SPEED and in_linear_region and not complex_dynamics
 
       if self.active:
-        self.kf.predict_and_observe(t, ObservationKind.STEER_ANGLE, np.array([[math.radians(msg.steeringAngleDeg)]]))
-        self.kf.predict_and_observe(t, ObservationKind.ROAD_FRAME_X_SPEED, np.array([[self.speed]]))
+        self.kf.predict_and_observe_multi(t, [
+          (ObservationKind.STEER_ANGLE, np.array([[math.radians(msg.steeringAngleDeg)]])),
+          (ObservationKind.ROAD_FRAME_X_SPEED, np.array([[self.speed]])),
+        ])
 
     if not self.active:
       # Reset time when stopped so uncertainty doesn't grow
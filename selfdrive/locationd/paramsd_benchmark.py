@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import time
+
+import numpy as np
+
+import cereal.messaging as messaging
+from cereal import car
+from openpilot.common.git import load_module_at
+from openpilot.selfdrive.locationd.models.car_kf import CarKalman
+from openpilot.selfdrive.locationd.models.constants import GENERATED_DIR
+from openpilot.selfdrive.locationd.paramsd import ParamsLearner
+from rednose.helpers.ekf_sym import EKF_sym
+
+
+def make_CP():
+  CP = car.CarParams.new_message()
+  CP.mass = 1500.
+  CP.rotationalInertia = 2500.
+  CP.wheelbase = 2.7
+  CP.centerToFront = 1.2
+  CP.steerRatio = 15.
+  CP.tireStiffnessFront = 200000.
+  CP.tireStiffnessRear = 250000.
+  return CP
+
+
+def make_msgs(seconds: float) -> list[tuple[float, str, object]]:
+  # a gentle slalom at 20 m/s, carState at 100Hz and liveLocationKalman at 20Hz
+  msgs = []
+  for i in range(int(seconds * 100)):
+    t = i / 100
+    steer = 10 * math.sin(t / 2)
+    cs = messaging.new_message('carState')
+    cs.carState.vEgo = 20.
+    cs.carState.steeringAngleDeg = steer
+    cs.carState.steeringRateDeg = 5 * math.cos(t / 2)
+    msgs.append((t, 'carState', cs.carState.as_reader()))
+
+    if i % 5 == 0:
+      llk = messaging.new_message('liveLocationKalman')
+      llk.liveLocationKalman.angularVelocityCalibrated.value = [0., 0., -math.radians(steer) / 15 * 20 / 2.7]
+      llk.liveLocationKalman.angularVelocityCalibrated.std = [0.01, 0.01, 0.01]
+      llk.liveLocationKalman.angularVelocityCalibrated.valid = True
+      llk.liveLocationKalman.orientationNED.value = [math.radians(1), 0., 0.]
+      llk.liveLocationKalman.orientationNED.std = [math.radians(0.2), 0., 0.]
+      llk.liveLocationKalman.sensorsOK = True
+      llk.liveLocationKalman.posenetOK = True
+      msgs.append((t, 'liveLocationKalman', llk.liveLocationKalman.as_reader()))
+  return msgs
+
+
+def make_learner(learner_cls, ekf_cls) -> ParamsLearner:
+  CP = make_CP()
+  learner = learner_cls(CP, CP.steerRatio, 1., 0.)
+  if ekf_cls is not None:
+    # the Python filter on the same generated model, in place of the C++ one CarKalman uses
+    dim = CarKalman.P_initial.shape[0]
+    learner.kf.filter = ekf_cls(GENERATED_DIR, CarKalman.name, CarKalman.Q, learner.kf.x, learner.kf.P, dim, dim,
+                                global_vars=CarKalman.global_vars)
+    for name, value in (("mass", CP.mass), ("rotational_inertia", CP.rotationalInertia), ("center_to_front", CP.centerToFront),
+                        ("center_to_rear", CP.wheelbase - CP.centerToFront), ("stiffness_front", CP.tireStiffnessFront),
+                        ("stiffness_rear", CP.tireStiffnessRear)):
+      learner.kf.filter.set_global(name, value)
+  return learner
+
+
+def benchmark(learner: ParamsLearner, msgs) -> dict[str, float]:
+  elapsed = {'carState': 0., 'liveLocationKalman': 0.}
+  for t, which, msg in msgs:
+    start = time.perf_counter()
+    learner.handle_log(t, which, msg)
+    elapsed[which] += time.perf_counter() - start
+  return {which: total / sum(w == which for _, w, _ in msgs) for which, total in elapsed.items()}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Per-message cost of ParamsLearner.handle_log's filter updates, "
+                                               "with the C++ filter paramsd runs and with the Python EKF_sym")
+  parser.add_argument("--seconds", type=float, default=120.)
+  parser.add_argument("--baseline", help="commit to compare against, paramsd and EKF_sym are loaded as of that commit")
+  args = parser.parse_args()
+
+  runs = [("current", ParamsLearner, EKF_sym)]
+  if args.baseline:
+    runs.insert(0, (args.baseline, load_module_at("selfdrive/locationd/paramsd.py", args.baseline).ParamsLearner,
+                    load_module_at("rednose_repo/rednose/helpers/ekf_sym.py", args.baseline).EKF_sym))
+
+  msgs = make_msgs(args.seconds)
+  for python_filter in (False, True):
+    states = []
+    for name, learner_cls, ekf_cls in runs:
+      learner = make_learner(learner_cls, ekf_cls if python_filter else None)
+      times = benchmark(learner, msgs)
+      states.append(learner.kf.x)
+      print(f"{'EKF_sym' if python_filter else 'EKF_sym_pyx':>11} {name:>10}: " +
+            ", ".join(f"{which} {cost * 1e6:6.1f} us" for which, cost in times.items()))
+    if len(states) > 1:
+      print(f"{'':>11} max state difference {np.abs(states[0] - states[1]).max():.3g}")
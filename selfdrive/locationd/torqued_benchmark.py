@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+
+from openpilot.common.git import load_module_at
+from openpilot.selfdrive.locationd.helpers import PointBuckets
+from openpilot.selfdrive.locationd.torqued import FIT_POINTS_TOTAL, MIN_BUCKET_POINTS, MIN_POINTS_TOTAL, POINTS_PER_BUCKET, \
+                                                  STEER_BUCKET_BOUNDS, TorqueBuckets
+
+
+def load_torque_buckets_at(commit: str) -> type[PointBuckets]:
+  # TorqueBuckets on top of PointBuckets as of commit, torqued itself would import the current helpers
+  helpers = load_module_at("selfdrive/locationd/helpers.py", commit)
+  return type("TorqueBuckets", (helpers.PointBuckets,), {"add_point": TorqueBuckets.add_point})
+
+
+def make_buckets(cls: type[PointBuckets]) -> PointBuckets:
+  return cls(x_bounds=STEER_BUCKET_BOUNDS, min_points=MIN_BUCKET_POINTS, min_points_total=MIN_POINTS_TOTAL,
+             points_per_bucket=POINTS_PER_BUCKET, rowsize=3)
+
+
+def benchmark(cls: type[PointBuckets], updates: int, estimate_every: int) -> tuple[float, float]:
+  rng = np.random.default_rng(0)
+  steer = rng.uniform(-0.5, 0.5, updates)
+  lat_acc = 2 * steer + rng.normal(0, 0.1, updates)
+
+  buckets = make_buckets(cls)
+  update_time, estimate_time, estimates = 0., 0., 0
+  for i in range(updates):
+    t = time.perf_counter()
+    buckets.add_point(float(steer[i]), float(lat_acc[i]))
+    update_time += time.perf_counter() - t
+
+    if i % estimate_every == 0 and buckets.is_calculable():
+      t = time.perf_counter()
+      buckets.get_points(FIT_POINTS_TOTAL)
+      estimate_time += time.perf_counter() - t
+      estimates += 1
+  return update_time / updates, estimate_time / max(estimates, 1)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Per-update cost of the torqued point buckets")
+  parser.add_argument("--updates", type=int, default=50000)
+  parser.add_argument("--estimate-every", type=int, default=100)
+  parser.add_argument("--baseline", help="commit to compare against, the point buckets are loaded as of that commit")
+  args = parser.parse_args()
+
+  runs = [("current", TorqueBuckets)]
+  if args.baseline:
+    runs.insert(0, (args.baseline, load_torque_buckets_at(args.baseline)))
+
+  for name, cls in runs:
+    update, estimate = benchmark(cls, args.updates, args.estimate_every)
+    print(f"{name:>10}: add_point {update * 1e6:7.2f} us, get_points({FIT_POINTS_TOTAL}) {estimate * 1e6:8.1f} us")
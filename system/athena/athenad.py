@@ -2,8 +2,9 @@
 from __future__ import annotations
 
 import base64
-import bz2
+import bisect
 import hashlib
+import heapq
 import io
 import json
 import os
@@ -32,9 +33,11 @@ from cereal import log
 from cereal.services import SERVICE_LIST
 from openpilot.common.api import Api
 from openpilot.common.file_helpers import CallbackReader
+from openpilot.common.inotify import IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW, Inotify
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware import HARDWARE, PC
+from openpilot.system.loggerd.upload_cache import get_compressed, remove_compressed
 from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 from openpilot.common.swaglog import cloudlog
 from openpilot.system.version import get_build_metadata
@@ -266,6 +269,7 @@ def upload_handler(end_event: threading.Event) -> None:
           retry_upload(tid, end_event)
         else:
           cloudlog.event("athena.upload_handler.success", fn=fn, sz=sz, network_type=network_type, metered=metered)
+          remove_compressed(strip_bz2_extension(fn))
 
         UploadQueueCache.cache(upload_queue)
       except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError):
@@ -290,16 +294,15 @@ def _do_upload(upload_item: UploadItem, callback: Callable = None) -> requests.R
     path = strip_bz2_extension(path)
     compress = True
 
-  with open(path, "rb") as f:
-    content = f.read()
-    if compress:
-      cloudlog.event("athena.upload_handler.compress", fn=path, fn_orig=upload_item.path)
-      content = bz2.compress(content)
+  if compress:
+    cloudlog.event("athena.upload_handler.compress", fn=path, fn_orig=upload_item.path)
+    path = get_compressed(path)
 
-  with io.BytesIO(content) as data:
+  size = os.path.getsize(path)
+  with open(path, "rb") as data:
     return requests.put(upload_item.url,
-                        data=CallbackReader(data, callback, len(content)) if callback else data,
-                        headers={**upload_item.headers, 'Content-Length': str(len(content))},
+                        data=CallbackReader(data, callback, size) if callback else data,
+                        headers={**upload_item.headers, 'Content-Length': str(size)},
                         timeout=30)
 
 
@@ -551,43 +554,110 @@ def takeSnapshot() -> str | dict[str, str] | None:
     raise Exception("not available while camerad is started")
 
 
-def get_logs_to_send_sorted() -> list[str]:
-  # TODO: scan once then use inotify to detect file creation/deletion
-  curr_time = int(time.time())
-  logs = []
-  for log_entry in os.listdir(Paths.swaglog_root()):
-    log_path = os.path.join(Paths.swaglog_root(), log_entry)
-    time_sent = 0
+def get_log_time_sent(log_path: str) -> int | None:
+  time_sent = 0
+  try:
+    value = getxattr(log_path, LOG_ATTR_NAME)
+    if value is not None:
+      time_sent = int.from_bytes(value, sys.byteorder)
+  except (ValueError, TypeError):
+    pass
+  except OSError:
+    return None  # file could be deleted by log rotation
+  return time_sent
+
+
+class SwaglogIndex:
+  """Swaglogs waiting to be forwarded, newest last. The dir is listed once and then kept current with inotify,
+  falling back to listing it every 10s."""
+
+  def __init__(self, root: str):
+    self.root = root
+    self.pending: list[str] = []
+    # (time to send again if there was no response, log entry)
+    self.sent: list[tuple[int, str]] = []
+    self.last_scan = 0.
+
     try:
-      value = getxattr(log_path, LOG_ATTR_NAME)
-      if value is not None:
-        time_sent = int.from_bytes(value, sys.byteorder)
-    except (ValueError, TypeError):
-      pass
-    # assume send failed and we lost the response if sent more than one hour ago
-    if not time_sent or curr_time - time_sent > 3600:
-      logs.append(log_entry)
-  # excluding most recent (active) log file
-  return sorted(logs)[:-1]
+      self.inotify = Inotify()
+      self.inotify.add_watch(root, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+    except OSError:
+      cloudlog.exception("athena.log_handler.inotify_failed")
+      self.inotify = None
+
+    self.scan()
+
+  def scan(self) -> None:
+    curr_time = int(time.time())
+    self.pending = []
+    self.sent = []
+    for log_entry in os.listdir(self.root):
+      time_sent = get_log_time_sent(os.path.join(self.root, log_entry))
+      if time_sent is None:
+        continue
+      if self.send_due(time_sent, curr_time):
+        self.pending.append(log_entry)
+      else:
+        self.sent.append((time_sent + 3600, log_entry))
+    self.pending.sort()
+    heapq.heapify(self.sent)
+    self.last_scan = time.monotonic()
+
+  def update(self) -> None:
+    if self.inotify is None:
+      if time.monotonic() - self.last_scan > 10:
+        self.scan()
+      return
+
+    for event in self.inotify.read():
+      if event.mask & IN_Q_OVERFLOW:
+        self.scan()
+        return
+
+      i = bisect.bisect_left(self.pending, event.name)
+      present = i < len(self.pending) and self.pending[i] == event.name
+      if event.mask & (IN_CREATE | IN_MOVED_TO) and not present:
+        self.pending.insert(i, event.name)
+      elif event.mask & (IN_DELETE | IN_MOVED_FROM) and present:
+        del self.pending[i]
+
+    curr_time = int(time.time())
+    while self.sent and self.sent[0][0] < curr_time:
+      _, log_entry = heapq.heappop(self.sent)
+      time_sent = get_log_time_sent(os.path.join(self.root, log_entry))
+      if time_sent is not None and self.send_due(time_sent, curr_time):
+        bisect.insort(self.pending, log_entry)
+
+  @staticmethod
+  def send_due(time_sent: int, curr_time: int) -> bool:
+    # assume send failed and we lost the response if sent more than one hour ago. a send time in the future
+    # means the clock was off when it was recorded, so it can't be trusted either
+    return not time_sent or curr_time - time_sent > 3600 or time_sent > curr_time
+
+  def pop(self) -> str | None:
+    # newest log file, excluding the most recent (active) one
+    if len(self.pending) < 2:
+      return None
+    log_entry = self.pending.pop(-2)
+    heapq.heappush(self.sent, (int(time.time()) + 3600, log_entry))
+    return log_entry
 
 
 def log_handler(end_event: threading.Event) -> None:
   if PC:
     return
 
-  log_files = []
-  last_scan = 0.
+  log_index = None
   while not end_event.is_set():
     try:
-      curr_scan = time.monotonic()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
-        last_scan = curr_scan
+      if log_index is None:
+        log_index = SwaglogIndex(Paths.swaglog_root())
+      log_index.update()
 
       # send one log
       curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
+      log_entry = log_index.pop()
+      if log_entry is not None:
         cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
         try:
           curr_time = int(time.time())
@@ -40,6 +40,13 @@ class Paths:
       return os.environ['COMMA_CACHE'] + "/"
     return DEFAULT_DOWNLOAD_CACHE_ROOT + os.environ.get("OPENPILOT_PREFIX", "") + "/"
 
+  @staticmethod
+  def upload_cache_root() -> str:
+    if PC:
+      return os.path.join(Paths.comma_home(), "upload_cache")
+    else:
+      return "/data/upload_cache/"
+
   @staticmethod
   def persist_root() -> str:
     if PC:
@@ -0,0 +1,69 @@
+import bz2
+import hashlib
+import os
+
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.system.hardware.hw import Paths
+
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+UPLOAD_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+
+def cache_path(fn: str) -> str:
+  # a file that changed since it was compressed gets a new entry
+  st = os.stat(fn)
+  key = hashlib.sha1(f"{os.path.realpath(fn)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+  return os.path.join(Paths.upload_cache_root(), key + ".bz2")
+
+
+def get_compressed(fn: str) -> str:
+  """Path of a bz2 compressed copy of fn for uploading. The file is compressed a block at a time, so memory
+  stays flat regardless of its size, and the copy is kept until remove_compressed so retries don't compress again."""
+  path = cache_path(fn)
+  if os.path.isfile(path):
+    os.utime(path)
+    return path
+
+  os.makedirs(Paths.upload_cache_root(), exist_ok=True)
+  with open(fn, "rb") as f, atomic_write_in_dir(path, mode="wb", overwrite=True) as out:
+    compressor = bz2.BZ2Compressor()
+    while block := f.read(COMPRESS_BLOCK_SIZE):
+      out.write(compressor.compress(block))
+    out.write(compressor.flush())
+
+  prune(keep=path)
+  return path
+
+
+def remove_compressed(fn: str) -> None:
+  try:
+    os.unlink(cache_path(fn))
+  except OSError:
+    pass
+
+
+def prune(keep: str = None) -> None:
+  # drop the least recently used copies once the cache is over its size, like uploads that were given up on
+  root = Paths.upload_cache_root()
+  entries = []
+  for name in os.listdir(root):
+    if not name.endswith(".bz2"):
+      continue
+    path = os.path.join(root, name)
+    try:
+      st = os.stat(path)
+    except OSError:
+      continue
+    entries.append((st.st_mtime, st.st_size, path))
+
+  total = sum(size for _, size, _ in entries)
+  for _, size, path in sorted(entries):
+    if total <= UPLOAD_CACHE_MAX_BYTES:
+      break
+    if path == keep:
+      continue
+    try:
+      os.unlink(path)
+      total -= size
+    except OSError:
+      pass
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
-import bz2
-import io
+import bisect
+import heapq
 import json
 import os
 import random
@@ -8,16 +8,17 @@ import requests
 import threading
 import time
 import traceback
-import datetime
-from typing import BinaryIO
-from collections.abc import Iterator
 
 from cereal import log
 import cereal.messaging as messaging
 from openpilot.common.api import Api
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.common.inotify import (IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO,
+                                      IN_Q_OVERFLOW, Inotify)
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
+from openpilot.system.loggerd.upload_cache import get_compressed, remove_compressed
 from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 from openpilot.common.swaglog import cloudlog
 
@@ -33,6 +34,10 @@ MAX_UPLOAD_SIZES = {
   "qcam": 5*1e6,
 }
 
+UPLOAD_INDEX_CHECKPOINT_INTERVAL = 60
+# a directory modified this recently might change again within the same mtime tick, so it isn't checkpointed
+RACY_MTIME_NS = 2 * 10**9
+
 allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
@@ -77,71 +82,290 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
-class Uploader:
-  def __init__(self, dongle_id: str, root: str):
-    self.dongle_id = dongle_id
-    self.api = Api(dongle_id)
+class UploadIndex:
+  """The files next_file_to_upload can pick, in the order it picks them.
+
+  The log dirs are listed once, then kept current with inotify, with a checkpoint so a restart only lists the dirs
+  that changed. The upload xattr stays the source of truth, a file is checked again when it comes up next.
+  """
+
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int], checkpoint_path: str = None):
     self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
+    self.checkpoint_path = checkpoint_path or os.path.join(Paths.upload_cache_root(), "upload_index.json")
 
-    self.params = Params()
+    # logdir -> (mtime_ns when listed, locked, names waiting to be uploaded)
+    self.dirs: dict[str, tuple[int, bool, set[str]]] = {}
+    self.count = 0
+    self.heap: list[tuple[tuple, str, str]] = []
+    # qcameras are only uploaded for requested routes on metered connections, so they're kept apart
+    self.qcamera_heap: list[tuple[tuple, str, str]] = []
+    self.qcamera_dirs: list[str] = []
 
-    # stats for last successfully uploaded file
-    self.last_filename = ""
+    self.dirty = False
+    self.last_checkpoint = 0.
 
-    self.immediate_folders = ["crash/", "boot/"]
-    self.immediate_priority = {"qlog": 0, "qlog.bz2": 0, "qcamera.ts": 1}
+    try:
+      self.inotify = Inotify()
+    except OSError:
+      cloudlog.exception("upload_index_inotify_failed")
+      self.inotify = None
+    self.dir_watches: dict[str, int] = {}
 
-  def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
-    r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
-    requested_routes = [] if r is None else r.split(",")
+    self.scan(self.load_checkpoint())
+
+  def sort_key(self, logdir: str, name: str) -> tuple:
+    immediate_folder = any(f in os.path.join(self.root, logdir, name) for f in self.immediate_folders)
+    return (not immediate_folder, get_directory_sort(logdir), self.immediate_priority.get(name, 1000), name)
+
+  def eligible(self, logdir: str, name: str) -> bool:
+    return name in self.immediate_priority or any(f in os.path.join(self.root, logdir, name) for f in self.immediate_folders)
+
+  def is_uploaded(self, logdir: str, name: str) -> bool:
+    fn = os.path.join(self.root, logdir, name)
+    try:
+      # getxattr is cached, stat makes sure the file is still there
+      os.stat(fn)
+      return getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+    except OSError:
+      cloudlog.event("uploader_getxattr_failed", key=os.path.join(logdir, name), fn=fn)
+      # deleter could have deleted, so skip
+      return True
+
+  def is_locked(self, logdir: str) -> bool:
+    try:
+      return any(name.endswith(".lock") for name in os.listdir(os.path.join(self.root, logdir)))
+    except OSError:
+      return False
+
+  def load_checkpoint(self) -> dict:
+    try:
+      with open(self.checkpoint_path) as f:
+        checkpoint = json.load(f)
+      if checkpoint["root"] == self.root:
+        return checkpoint["dirs"]
+    except (OSError, ValueError, KeyError):
+      pass
+    return {}
+
+  def save_checkpoint(self) -> None:
+    dirs = {logdir: [mtime_ns, locked, sorted(names)] for logdir, (mtime_ns, locked, names) in self.dirs.items() if mtime_ns != -1}
+    try:
+      os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+      with atomic_write_in_dir(self.checkpoint_path, overwrite=True) as f:
+        json.dump({"root": self.root, "dirs": dirs}, f)
+    except OSError:
+      cloudlog.exception("upload_index_checkpoint_failed")
+    self.dirty = False
+    self.last_checkpoint = time.monotonic()
+
+  def scan(self, checkpoint: dict = None) -> None:
+    for logdir in list(self.dirs):
+      self.drop_dir(logdir)
+    self.heap.clear()
+    self.qcamera_heap.clear()
+
+    if self.inotify is not None and self.root not in self.inotify.watches.values() and os.path.isdir(self.root):
+      try:
+        self.inotify.add_watch(self.root, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+      except OSError:
+        cloudlog.exception("upload_index_watch_failed")
 
     for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
+      entry = (checkpoint or {}).get(logdir)
+      try:
+        mtime_ns = os.stat(os.path.join(self.root, logdir)).st_mtime_ns
+      except OSError:
+        continue
+
+      if entry is not None and entry[0] == mtime_ns:
+        self.add_dir(logdir, mtime_ns, entry[1], set(entry[2]))
+      else:
+        self.scan_dir(logdir)
+
+  def scan_dir(self, logdir: str) -> None:
+    self.drop_dir(logdir)
+    path = os.path.join(self.root, logdir)
+    try:
+      mtime_ns = os.stat(path).st_mtime_ns
+      names = os.listdir(path)
+    except OSError:
+      return
+
+    if time.time_ns() - mtime_ns < RACY_MTIME_NS:
+      mtime_ns = -1
+
+    locked = any(name.endswith(".lock") for name in names)
+    pending = set() if locked else {name for name in names if self.eligible(logdir, name) and not self.is_uploaded(logdir, name)}
+    self.add_dir(logdir, mtime_ns, locked, pending)
+
+  def add_dir(self, logdir: str, mtime_ns: int, locked: bool, names: set[str]) -> None:
+    self.dirs[logdir] = (mtime_ns, locked, set())
+    for name in names:
+      self.add_file(logdir, name)
+    self.dirty = True
+
+    # finished segments don't change anymore, only dirs that are still being written to or collect files need a watch
+    if locked or f"{logdir}/" in self.immediate_folders:
+      self.watch_dir(logdir)
+
+  def watch_dir(self, logdir: str) -> None:
+    if self.inotify is not None and logdir not in self.dir_watches:
       try:
-        names = os.listdir(path)
+        self.dir_watches[logdir] = self.inotify.add_watch(os.path.join(self.root, logdir),
+                                                          IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
       except OSError:
+        cloudlog.exception("upload_index_watch_failed")
+
+  def unwatch_dir(self, logdir: str) -> None:
+    if self.inotify is not None and logdir in self.dir_watches:
+      self.inotify.rm_watch(self.dir_watches.pop(logdir))
+
+  def drop_dir(self, logdir: str) -> None:
+    if logdir in self.dirs:
+      for name in list(self.dirs[logdir][2]):
+        self.drop_file(logdir, name)
+      del self.dirs[logdir]
+      self.dirty = True
+
+  def add_file(self, logdir: str, name: str) -> None:
+    names = self.dirs[logdir][2]
+    if name in names:
+      return
+
+    names.add(name)
+    self.count += 1
+    entry = (self.sort_key(logdir, name), logdir, name)
+    if name == "qcamera.ts":
+      heapq.heappush(self.qcamera_heap, entry)
+      bisect.insort(self.qcamera_dirs, logdir)
+    else:
+      heapq.heappush(self.heap, entry)
+    self.dirty = True
+
+  def drop_file(self, logdir: str, name: str) -> None:
+    # the heap entry is left behind and skipped when it comes up
+    names = self.dirs[logdir][2]
+    if name not in names:
+      return
+
+    names.discard(name)
+    self.count -= 1
+    if name == "qcamera.ts":
+      del self.qcamera_dirs[bisect.bisect_left(self.qcamera_dirs, logdir)]
+    self.dirty = True
+
+    if len(self.heap) + len(self.qcamera_heap) > 2 * self.count + 1000:
+      self.heap = [e for e in self.heap if e[2] in self.dirs.get(e[1], (0, False, ()))[2]]
+      self.qcamera_heap = [e for e in self.qcamera_heap if e[2] in self.dirs.get(e[1], (0, False, ()))[2]]
+      heapq.heapify(self.heap)
+      heapq.heapify(self.qcamera_heap)
+
+  def update(self) -> None:
+    if self.inotify is None:
+      self.scan()
+      return
+
+    if not self.dirs and self.root not in self.inotify.watches.values():
+      # the log root didn't exist yet
+      self.scan()
+
+    for event in self.inotify.read():
+      if event.mask & IN_Q_OVERFLOW:
+        self.scan()
         continue
 
-      if any(name.endswith(".lock") for name in names):
+      path = self.inotify.watches.get(event.wd)
+      if path is None:
         continue
 
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
+      if path == self.root:
+        if not event.mask & IN_ISDIR:
           continue
+        if event.mask & (IN_CREATE | IN_MOVED_TO):
+          # watch before listing, so nothing written in between is missed
+          self.watch_dir(event.name)
+          self.scan_dir(event.name)
+        elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+          self.drop_dir(event.name)
+          self.dir_watches.pop(event.name, None)
+        continue
 
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
-            continue
+      logdir = os.path.basename(path)
+      if logdir not in self.dirs:
+        continue
+      if event.name.endswith(".lock"):
+        self.scan_dir(logdir)
+        if logdir in self.dirs and not self.dirs[logdir][1] and f"{logdir}/" not in self.immediate_folders:
+          self.unwatch_dir(logdir)
+      elif event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        if not self.dirs[logdir][1] and self.eligible(logdir, event.name) and not self.is_uploaded(logdir, event.name):
+          self.add_file(logdir, event.name)
+      elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+        self.drop_file(logdir, event.name)
+
+    if self.dirty and time.monotonic() - self.last_checkpoint > UPLOAD_INDEX_CHECKPOINT_INTERVAL:
+      self.save_checkpoint()
+
+  def top(self, heap: list[tuple[tuple, str, str]]) -> tuple[tuple, str, str] | None:
+    while heap:
+      _, logdir, name = heap[0]
+      if name in self.dirs.get(logdir, (0, False, ()))[2]:
+        return heap[0]
+      heapq.heappop(heap)
+    return None
 
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
-            continue
+  def next(self, metered: bool, requested_routes: list[str]) -> tuple[str, str, str] | None:
+    while True:
+      candidates = [self.top(self.heap)]
+      if metered:
+        for r in requested_routes:
+          prefix = r.split('|')[-1]
+          i = bisect.bisect_left(self.qcamera_dirs, prefix)
+          while i < len(self.qcamera_dirs) and self.qcamera_dirs[i].startswith(prefix):
+            candidates.append((self.sort_key(self.qcamera_dirs[i], "qcamera.ts"), self.qcamera_dirs[i], "qcamera.ts"))
+            i += 1
+      else:
+        candidates.append(self.top(self.qcamera_heap))
 
-        yield name, key, fn
+      candidates = [c for c in candidates if c is not None]
+      if not candidates:
+        return None
 
-  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
+      _, logdir, name = min(candidates)
+      if self.is_uploaded(logdir, name):
+        self.drop_file(logdir, name)
+        continue
+      if self.is_locked(logdir):
+        # locked again without an event, the dir isn't watched anymore
+        self.scan_dir(logdir)
+        continue
+      return name, os.path.join(logdir, name), os.path.join(self.root, logdir, name)
 
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
 
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
+class Uploader:
+  def __init__(self, dongle_id: str, root: str):
+    self.dongle_id = dongle_id
+    self.api = Api(dongle_id)
+    self.root = root
 
-    return None
+    self.params = Params()
+
+    # stats for last successfully uploaded file
+    self.last_filename = ""
+
+    self.immediate_folders = ["crash/", "boot/"]
+    self.immediate_priority = {"qlog": 0, "qlog.bz2": 0, "qcamera.ts": 1}
+
+    self.index = UploadIndex(root, self.immediate_folders, self.immediate_priority)
+
+  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
+    r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
+    requested_routes = [] if r is None else r.split(",")
+
+    self.index.update()
+    return self.index.next(metered, requested_routes)
 
   def do_upload(self, key: str, fn: str):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
@@ -156,15 +380,11 @@ class Uploader:
     if fake_upload:
       return FakeResponse()
 
-    with open(fn, "rb") as f:
-      data: BinaryIO
-      if key.endswith('.bz2') and not fn.endswith('.bz2'):
-        compressed = bz2.compress(f.read())
-        data = io.BytesIO(compressed)
-      else:
-        data = f
+    if key.endswith('.bz2') and not fn.endswith('.bz2'):
+      fn = get_compressed(fn)
 
-      return requests.put(url, data=data, headers=headers, timeout=10)
+    with open(fn, "rb") as f:
+      return requests.put(url, data=f, headers=headers, timeout=10)
 
   def upload(self, name: str, key: str, fn: str, network_type: int, metered: bool) -> bool:
     try:
@@ -207,6 +427,8 @@ class Uploader:
         cloudlog.event("upload_failed", stat=stat, exc=last_exc, key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
 
     if success:
+      remove_compressed(fn)
+
       # tag file as uploaded
       try:
         setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
@@ -5,14 +5,17 @@ import os
 import pathlib
 import struct
 import sys
+import threading
 import time
 from abc import ABC, abstractmethod
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from typing import IO
 
 import requests
 from Crypto.Hash import SHA512
+from requests.adapters import HTTPAdapter
 from openpilot.system.updated.casync import tar
 from openpilot.system.updated.casync.common import create_casync_tar_package
 
@@ -31,6 +34,10 @@ CHUNK_DOWNLOAD_RETRIES = 3
 
 CAIBX_DOWNLOAD_TIMEOUT = 120
 
+# chunks are fetched, decompressed and verified by a pool of threads, all of which release the GIL while they work
+EXTRACT_WORKERS = 8
+EXTRACT_MAX_IN_FLIGHT = 64 * 1024 * 1024
+
 Chunk = namedtuple('Chunk', ['sha', 'offset', 'length'])
 ChunkDict = dict[bytes, Chunk]
 
@@ -46,10 +53,12 @@ class BinaryChunkReader(ChunkReader):
   def __init__(self, file_like: IO[bytes]) -> None:
     super().__init__()
     self.f = file_like
+    self.lock = threading.Lock()
 
   def read(self, chunk: Chunk) -> bytes:
-    self.f.seek(chunk.offset)
-    return self.f.read(chunk.length)
+    with self.lock:
+      self.f.seek(chunk.offset)
+      return self.f.read(chunk.length)
 
 
 class FileChunkReader(BinaryChunkReader):
@@ -67,6 +76,8 @@ class RemoteChunkReader(ChunkReader):
     super().__init__()
     self.url = url
     self.session = requests.Session()
+    self.session.mount("http://", HTTPAdapter(pool_maxsize=EXTRACT_WORKERS))
+    self.session.mount("https://", HTTPAdapter(pool_maxsize=EXTRACT_WORKERS))
 
   def read(self, chunk: Chunk) -> bytes:
     sha_hex = chunk.sha.hex()
@@ -165,41 +176,76 @@ def build_chunk_dict(chunks: list[Chunk]) -> ChunkDict:
   return r
 
 
-def extract(target: list[Chunk],
-            sources: list[tuple[str, ChunkReader, ChunkDict]],
-            out_path: str,
-            progress: Callable[[int], None] = None):
-  stats: dict[str, int] = defaultdict(int)
+def read_chunk(chunk: Chunk, sources: list[tuple[str, ChunkReader, ChunkDict]]) -> tuple[str, bytes]:
+  """Reads a chunk from the first source with a valid copy of it, returns the source name and the contents"""
+  for name, chunk_reader, store_chunks in sources:
+    if chunk.sha in store_chunks:
+      bts = chunk_reader.read(store_chunks[chunk.sha])
 
-  mode = 'rb+' if os.path.exists(out_path) else 'wb'
-  with open(out_path, mode) as out:
-    for cur_chunk in target:
+      # Check length
+      if len(bts) != chunk.length:
+        continue
 
-      # Find source for desired chunk
-      for name, chunk_reader, store_chunks in sources:
-        if cur_chunk.sha in store_chunks:
-          bts = chunk_reader.read(store_chunks[cur_chunk.sha])
+      # Check hash
+      if SHA512.new(bts, truncate="256").digest() != chunk.sha:
+        continue
 
-          # Check length
-          if len(bts) != cur_chunk.length:
-            continue
+      return name, bts
 
-          # Check hash
-          if SHA512.new(bts, truncate="256").digest() != cur_chunk.sha:
-            continue
+  raise RuntimeError("Desired chunk not found in provided stores")
 
-          # Write to output
-          out.seek(cur_chunk.offset)
-          out.write(bts)
 
-          stats[name] += cur_chunk.length
+def extract(target: list[Chunk],
+            sources: list[tuple[str, ChunkReader, ChunkDict]],
+            out_path: str,
+            progress: Callable[[int], None] = None,
+            workers: int = EXTRACT_WORKERS,
+            max_in_flight: int = EXTRACT_MAX_IN_FLIGHT):
+  """Reads the target chunks on a pool of workers and writes them out in order.
+  Identical chunks are read once, and at most max_in_flight bytes of chunks are held in memory."""
+  stats: dict[str, int] = defaultdict(int)
 
-          if progress is not None:
-            progress(sum(stats.values()))
+  offsets: dict[bytes, list[int]] = {}
+  unique_chunks = []
+  for chunk in target:
+    if chunk.sha not in offsets:
+      offsets[chunk.sha] = []
+      unique_chunks.append(chunk)
+    offsets[chunk.sha].append(chunk.offset)
 
-          break
-      else:
-        raise RuntimeError("Desired chunk not found in provided stores")
+  mode = 'rb+' if os.path.exists(out_path) else 'wb'
+  with open(out_path, mode) as out, ThreadPoolExecutor(max_workers=workers) as executor:
+    def write(chunk, future) -> int:
+      name, bts = future.result()
+
+      # Write to output
+      for offset in offsets[chunk.sha]:
+        out.seek(offset)
+        out.write(bts)
+
+      stats[name] += chunk.length * len(offsets[chunk.sha])
+
+      if progress is not None:
+        progress(sum(stats.values()))
+
+      return chunk.length
+
+    pending = deque()
+    in_flight = 0
+    try:
+      for chunk in unique_chunks:
+        while pending and in_flight + chunk.length > max_in_flight:
+          in_flight -= write(*pending.popleft())
+
+        pending.append((chunk, executor.submit(read_chunk, chunk, sources)))
+        in_flight += chunk.length
+
+      while pending:
+        write(*pending.popleft())
+    except BaseException:
+      for _, future in pending:
+        future.cancel()
+      raise
 
   return stats
 
@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+from collections.abc import Callable, Iterable
+
+import capnp
+import numpy as np
+
+from cereal import log as capnp_log
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.tools.lib.cache import DEFAULT_CACHE_DIR, column_cache_path_for_file_path
+
+DEFAULT_COLUMN_CACHE_SIZE = int(os.getenv("COLUMN_CACHE_SIZE", 10 * 1024 * 1024 * 1024))
+
+INDEX_COLUMN = "logMonoTime"
+MANIFEST = "columns.json"
+
+CAPNP_DTYPES = {
+  'bool': np.bool_,
+  'int8': np.int8, 'int16': np.int16, 'int32': np.int32, 'int64': np.int64,
+  'uint8': np.uint8, 'uint16': np.uint16, 'uint32': np.uint32, 'uint64': np.uint64,
+  'float32': np.float32, 'float64': np.float64,
+  'enum': np.uint16,
+}
+
+Columns = dict[str, tuple[np.ndarray, np.ndarray]]
+
+
+def scalar_fields(msg, prefix: str = "") -> dict[str, type]:
+  # every scalar leaf of a struct as a dotted path, skipping lists, blobs and union members
+  fields = {}
+  for name, field in msg.schema.fields.items():
+    if field.proto.discriminantValue != 0xffff:
+      continue
+    if field.proto.which() == 'group':
+      fields.update(scalar_fields(getattr(msg, name), f"{prefix}{name}."))
+      continue
+    kind = field.proto.slot.type.which()
+    if kind == 'struct':
+      fields.update(scalar_fields(getattr(msg, name), f"{prefix}{name}."))
+    elif kind in CAPNP_DTYPES:
+      fields[prefix + name] = CAPNP_DTYPES[kind]
+  return fields
+
+
+def _get_path(msg, path: list[str]):
+  for name in path:
+    msg = getattr(msg, name)
+  return msg.raw if isinstance(msg, capnp.lib.capnp._DynamicEnum) else msg
+
+
+def _column_path(segment_dir: str, service: str, column: str) -> str:
+  return os.path.join(segment_dir, service, column + ".npy")
+
+
+def _service_fields(service: str) -> dict[str, type]:
+  if capnp_log.Event.schema.fields[service].proto.slot.type.which() != 'struct':
+    return {}
+  return scalar_fields(capnp_log.Event.new_message().init(service))
+
+
+def _write_service_columns(segment_dir: str, service: str, columns: dict[str, np.ndarray]) -> None:
+  os.makedirs(os.path.join(segment_dir, service), exist_ok=True)
+  for column, arr in columns.items():
+    with atomic_write_in_dir(_column_path(segment_dir, service, column), mode="wb", overwrite=True) as f:
+      np.save(f, arr)
+
+
+def _read_manifest(segment_dir: str) -> dict[str, list[str]]:
+  try:
+    with open(os.path.join(segment_dir, MANIFEST)) as f:
+      return json.load(f)
+  except (FileNotFoundError, json.JSONDecodeError):
+    return {}
+
+
+def _dir_size(path: str) -> int:
+  return sum(os.path.getsize(os.path.join(root, fn)) for root, _, fns in os.walk(path) for fn in fns)
+
+
+def evict(cache_root: str, max_size: int = DEFAULT_COLUMN_CACHE_SIZE, keep: str | None = None) -> None:
+  # drop least recently used segments until the cache fits in max_size bytes
+  try:
+    segment_dirs = [os.path.join(cache_root, d) for d in os.listdir(cache_root)]
+  except FileNotFoundError:
+    return
+
+  usage = [(os.path.getmtime(d), d, _dir_size(d)) for d in segment_dirs if os.path.isdir(d)]
+  total = sum(size for _, _, size in usage)
+  for _, d, size in sorted(usage):
+    if total <= max_size:
+      break
+    if d != keep:
+      shutil.rmtree(d, ignore_errors=True)
+      total -= size
+
+
+def load_columns(fn: str, columns: Iterable[str], read_services: Callable[[frozenset[str]], Iterable],
+                 cache_dir: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_COLUMN_CACHE_SIZE) -> Columns:
+  """Returns {"service.field.path": (logMonoTime, values)} for one segment as memory-mapped arrays.
+  Services that aren't cached yet are parsed once with read_services, and all of their scalar fields are stored."""
+  segment_dir = column_cache_path_for_file_path(fn, cache_dir)
+  columns = list(columns)
+  services = {c.split(".", 1)[0] for c in columns}
+
+  manifest = _read_manifest(segment_dir)
+  missing = frozenset(services - manifest.keys())
+  if missing:
+    fields = {s: _service_fields(s) for s in missing}
+    values: dict[str, dict[str, list]] = {s: {c: [] for c in (INDEX_COLUMN, *fields[s])} for s in missing}
+    for msg in read_services(missing):
+      service = msg.which()
+      values[service][INDEX_COLUMN].append(msg.logMonoTime)
+      for path in fields[service]:
+        values[service][path].append(_get_path(getattr(msg, service), path.split(".")))
+
+    for service in missing:
+      dtypes = {INDEX_COLUMN: np.uint64, **fields[service]}
+      _write_service_columns(segment_dir, service, {c: np.array(v, dtype=dtypes[c]) for c, v in values[service].items()})
+      manifest[service] = list(fields[service])
+
+    # merge with anything another process built meanwhile, the manifest is what marks columns as valid
+    manifest = _read_manifest(segment_dir) | manifest
+    with atomic_write_in_dir(os.path.join(segment_dir, MANIFEST), mode="w", overwrite=True) as f:
+      json.dump(manifest, f)
+    evict(os.path.dirname(segment_dir), max_size, keep=segment_dir)
+
+  # mtime on the segment directory tracks recency for eviction
+  os.utime(segment_dir)
+
+  ret = {}
+  for column in columns:
+    service, path = column.split(".", 1)
+    if path not in manifest[service]:
+      raise KeyError(f"{column} is not a scalar field of {service}")
+    ret[column] = (np.load(_column_path(segment_dir, service, INDEX_COLUMN), mmap_mode='r'),
+                   np.load(_column_path(segment_dir, service, path), mmap_mode='r'))
+  return ret
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+
+from openpilot.system.hardware.hw import Paths
+
+GiB = 1024 * 1024 * 1024
+DEFAULT_DOWNLOAD_CACHE_SIZE = int(os.getenv("DOWNLOAD_CACHE_SIZE", 20 * GiB))
+INDEX_NAME = "index.db"
+CHUNK_NAME = re.compile(r"^[0-9a-f]{64}_\d+\.0$")
+LENGTH_NAME = re.compile(r"^([0-9a-f]{64})_length$")
+# bumped whenever the files an index has to pick up from the cache directory change
+INDEX_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (name TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS chunks_atime ON chunks (atime);
+CREATE TABLE IF NOT EXISTS lengths (url_hash TEXT PRIMARY KEY, length INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+
+class DownloadCache:
+  # Index over the URLFile chunk cache. The chunk files stay where they always were, an sqlite database next to them
+  # tracks their size and last access so lookups don't stat the filesystem and eviction can go least recently used
+  # first. sqlite's locking makes it safe to share between processes.
+
+  def __init__(self, root: str | None = None, max_size: int = DEFAULT_DOWNLOAD_CACHE_SIZE):
+    self.root = root if root is not None else Paths.download_cache_root()
+    self.max_size = max_size
+    self._local = threading.local()
+
+  @property
+  def _db(self) -> sqlite3.Connection:
+    # sqlite connections can't be shared between threads
+    db = getattr(self._local, "db", None)
+    if db is None:
+      os.makedirs(self.root, exist_ok=True)
+      db = sqlite3.connect(os.path.join(self.root, INDEX_NAME), timeout=60)
+      db.execute("PRAGMA journal_mode=WAL")
+      db.execute("PRAGMA synchronous=NORMAL")
+      db.executescript(SCHEMA)
+      with db:
+        # a new index starts out with whatever chunk files are already there, so they count towards max_size
+        db.execute("BEGIN IMMEDIATE")
+        if db.execute("PRAGMA user_version").fetchone()[0] < INDEX_VERSION:
+          self._index_files(db)
+          db.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+      self._local.db = db
+    return db
+
+  def path(self, name: str) -> str:
+    return os.path.join(self.root, name)
+
+  def lookup(self, names: Iterable[str], record: bool = True) -> set[str]:
+    # returns which of the chunks are cached, marking them as used
+    names = list(names)
+    if not names:
+      return set()
+
+    db = self._db
+    with db:
+      placeholders = ",".join("?" * len(names))
+      found = {name for name, in db.execute(f"SELECT name FROM chunks WHERE name IN ({placeholders})", names)}
+      if record:
+        db.execute(f"UPDATE chunks SET atime = ? WHERE name IN ({placeholders})", [time.time(), *names])
+        self._add_stats(db, hits=len(found), misses=len(names) - len(found))
+    return found
+
+  def add(self, name: str, size: int) -> None:
+    db = self._db
+    with db:
+      db.execute("INSERT OR REPLACE INTO chunks (name, size, atime) VALUES (?, ?, ?)", (name, size, time.time()))
+      self._add_stats(db, downloaded_bytes=size)
+    self.evict()
+
+  def discard(self, name: str) -> None:
+    # chunk file went missing, e.g. evicted by another process between lookup and read
+    with self._db as db:
+      db.execute("DELETE FROM chunks WHERE name = ?", (name,))
+
+  def get_length(self, url_hash: str) -> int | None:
+    row = self._db.execute("SELECT length FROM lengths WHERE url_hash = ?", (url_hash,)).fetchone()
+    return row[0] if row is not None else None
+
+  def set_length(self, url_hash: str, length: int) -> None:
+    with self._db as db:
+      db.execute("INSERT OR REPLACE INTO lengths (url_hash, length) VALUES (?, ?)", (url_hash, length))
+
+  def usage(self) -> tuple[int, int]:
+    count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chunks").fetchone()
+    return count, size
+
+  def stats(self) -> dict[str, int]:
+    return dict(self._db.execute("SELECT key, value FROM stats"))
+
+  def evict(self, max_size: int | None = None) -> int:
+    # drops least recently used chunks until the cache fits in max_size, returns the number of bytes freed
+    max_size = self.max_size if max_size is None else max_size
+    db = self._db
+    with db:
+      # IMMEDIATE takes the write lock up front, so concurrent evictions don't both delete the same chunks
+      db.execute("BEGIN IMMEDIATE")
+      _, total = self.usage()
+      excess = total - max_size
+      if excess <= 0:
+        return 0
+
+      evicted = []
+      freed = 0
+      for name, size in db.execute("SELECT name, size FROM chunks ORDER BY atime"):
+        if freed >= excess:
+          break
+        evicted.append((name,))
+        freed += size
+      db.executemany("DELETE FROM chunks WHERE name = ?", evicted)
+      self._add_stats(db, evicted_bytes=freed)
+
+    for name, in evicted:
+      try:
+        os.unlink(self.path(name))
+      except FileNotFoundError:
+        pass
+    return freed
+
+  def rebuild(self) -> None:
+    # index anything the index lost track of, chunk files from older versions are picked up when the index is created
+    with self._db as db:
+      self._index_files(db)
+
+  def clear(self) -> None:
+    self.evict(0)
+    with self._db as db:
+      db.execute("DELETE FROM lengths")
+      db.execute("DELETE FROM stats")
+
+  def _index_files(self, db: sqlite3.Connection) -> None:
+    for name in os.listdir(self.root):
+      if CHUNK_NAME.match(name):
+        try:
+          st = os.stat(self.path(name))
+        except FileNotFoundError:
+          continue
+        db.execute("INSERT OR IGNORE INTO chunks (name, size, atime) VALUES (?, ?, ?)", (name, st.st_size, st.st_atime))
+      elif (m := LENGTH_NAME.match(name)):
+        # older versions kept each file's length in a <url hash>_length file next to the chunks
+        try:
+          with open(self.path(name)) as f:
+            content = f.read()
+          os.unlink(self.path(name))
+        except OSError:
+          continue
+        if not content.strip().isdigit():
+          continue
+        db.execute("INSERT OR IGNORE INTO lengths (url_hash, length) VALUES (?, ?)", (m.group(1), int(content)))
+
+  @staticmethod
+  def _add_stats(db: sqlite3.Connection, **counts: int) -> None:
+    db.executemany("INSERT INTO stats (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                   [(k, v) for k, v in counts.items() if v])
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Inspect and manage the URLFile download cache")
+  parser.add_argument("command", choices=["stats", "evict", "rebuild", "clear"], nargs="?", default="stats")
+  parser.add_argument("--max-size", type=float, help="cache budget in GiB, defaults to DOWNLOAD_CACHE_SIZE")
+  args = parser.parse_args()
+
+  cache = DownloadCache()
+  if args.command == "evict":
+    freed = cache.evict(int(args.max_size * GiB) if args.max_size is not None else None)
+    print(f"evicted {freed / GiB:.2f} GiB")
+  elif args.command == "rebuild":
+    cache.rebuild()
+  elif args.command == "clear":
+    cache.clear()
+
+  count, size = cache.usage()
+  stats = cache.stats()
+  hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+  print(f"cache: {cache.root}")
+  print(f"usage: {size / GiB:.2f} / {cache.max_size / GiB:.2f} GiB in {count} chunks")
+  print(f"hit rate: {hits / max(hits + misses, 1):.1%} ({hits} hits, {misses} misses)")
+  print(f"downloaded: {stats.get('downloaded_bytes', 0) / GiB:.2f} GiB, evicted: {stats.get('evicted_bytes', 0) / GiB:.2f} GiB")
+
+
+if __name__ == "__main__":
+  main()
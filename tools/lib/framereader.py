@@ -4,24 +4,33 @@ import pickle
 import struct
 import subprocess
 import threading
+import time
+from collections import OrderedDict
 from enum import IntEnum
 from functools import wraps
 
+import av
 import numpy as np
 from lru import LRU
 
 import _io
 from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
 from openpilot.tools.lib.exceptions import DataUnreadableError
-from openpilot.tools.lib.vidindex import hevc_index
+from openpilot.tools.lib.vidindex import fast_hevc_index
 from openpilot.common.file_helpers import atomic_write_in_dir
 
 from openpilot.tools.lib.filereader import FileReader, resolve_name
+from openpilot.tools.lib.url_file import URLFile
 
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+FRAME_CACHE_BYTES = int(os.getenv("FRAMEREADER_CACHE_BYTES", 1024 * 1024 * 1024))
+# readahead depth in frames, grows while the access pattern is predictable
+READAHEAD_MIN = 4
+READAHEAD_MAX = 128
+
 
 class GOPReader:
   def get_gop(self, num):
@@ -102,9 +111,10 @@ def index_stream(fn, ft):
   if ft != FrameType.h265_stream:
     raise NotImplementedError("Only h265 supported")
 
-  frame_types, dat_len, prefix = hevc_index(fn)
+  frame_types, dat_len, prefix, w, h = fast_hevc_index(fn)
   index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
-  probe = ffprobe(fn, "hevc")
+  # the frame size comes from the SPS, no need to run ffprobe
+  probe = {'streams': [{'width': w, 'height': h}]}
 
   return {
     'index': index,
@@ -197,6 +207,143 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   return ret
 
 
+class DecoderSession:
+  # in-process hevc decoder kept alive between requests for one (file, pix_fmt), so random access
+  # doesn't spawn ffmpeg per GOP and sequential access only decodes each frame once
+
+  def __init__(self, gop_reader, pix_fmt):
+    self.gop_reader = gop_reader
+    self.pix_fmt = pix_fmt
+    self.lock = threading.RLock()
+    self.codec = None
+    self.next_frame = None  # next frame the decoder can continue from without a reset
+
+  def _reset(self):
+    self.codec = av.CodecContext.create(self.gop_reader.vid_fmt, "r")
+    # frame threading holds back output by a frame per thread
+    self.codec.thread_type = "SLICE"
+    # like -flags2 showall, so a GOP starting on a non-IRAP I slice still outputs its leading frames
+    self.codec.options = {"flags2": "+showall"}
+
+  def _convert(self, frame):
+    ret = frame.to_ndarray(format=self.pix_fmt)
+    if self.pix_fmt in ("nv12", "yuv420p"):
+      ret = ret.reshape(-1)
+    return ret
+
+  def decode(self, num):
+    # decodes up to and including frame num and returns [(frame_num, frame)] for every frame produced on the way
+    with self.lock:
+      frame_b, _, _, _ = self.gop_reader._lookup_gop(num)
+      if self.next_frame is not None and frame_b <= self.next_frame <= num:
+        start = self.next_frame
+      else:
+        self._reset()
+        start = frame_b
+
+      packets = self.gop_reader.get_frames_data(start, num + 1)
+      if start == frame_b:
+        packets[0] = self.gop_reader.prefix + packets[0]
+
+      ret = []
+      out_frame = start
+      for dat in packets:
+        for frame in self.codec.decode(av.Packet(dat)):
+          ret.append((out_frame, self._convert(frame)))
+          out_frame += 1
+
+      self.next_frame = num + 1
+      if out_frame <= num:
+        # decoder is holding frames back, drain it and start over next time
+        for frame in self.codec.decode(None):
+          ret.append((out_frame, self._convert(frame)))
+          out_frame += 1
+        self.next_frame = None
+
+      assert out_frame == num + 1, (out_frame, num)
+      return ret
+
+
+_decoder_sessions = LRU(int(os.getenv("FRAMEREADER_DECODER_SESSIONS", "16")))
+_decoder_sessions_lock = threading.Lock()
+
+def get_decoder_session(gop_reader, pix_fmt):
+  key = (gop_reader.fn, pix_fmt)
+  with _decoder_sessions_lock:
+    if key not in _decoder_sessions:
+      _decoder_sessions[key] = DecoderSession(gop_reader, pix_fmt)
+    return _decoder_sessions[key]
+
+
+class FrameCache:
+  # process-wide cache of decoded frames, bounded in bytes and shared by all readers of the same file
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.frames = OrderedDict()
+    self.nbytes = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.decodes = 0
+    self.decode_time = 0.
+
+  def get(self, key, record=True):
+    with self.lock:
+      frame = self.frames.get(key)
+      if frame is not None:
+        self.frames.move_to_end(key)
+      if record:
+        if frame is None:
+          self.misses += 1
+        else:
+          self.hits += 1
+      return frame
+
+  def put(self, key, frame):
+    # frames are handed out to every reader of the file, so they must not be modified
+    frame.flags.writeable = False
+    with self.lock:
+      old = self.frames.pop(key, None)
+      if old is not None:
+        self.nbytes -= old.nbytes
+      self.frames[key] = frame
+      self.nbytes += frame.nbytes
+
+      while self.nbytes > self.max_bytes and len(self.frames) > 1:
+        _, evicted = self.frames.popitem(last=False)
+        self.nbytes -= evicted.nbytes
+        self.evictions += 1
+
+  def record_decode(self, dt):
+    with self.lock:
+      self.decodes += 1
+      self.decode_time += dt
+
+  def clear(self):
+    with self.lock:
+      self.frames.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    with self.lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / max(self.hits + self.misses, 1),
+        'evictions': self.evictions,
+        'frames': len(self.frames),
+        'bytes': self.nbytes,
+        'decodes': self.decodes,
+        'decode_latency': self.decode_time / max(self.decodes, 1),
+      }
+
+
+shared_frame_cache = FrameCache(FRAME_CACHE_BYTES)
+
+
 class BaseFrameReader:
   # properties: frame_type, frame_count, w, h
 
@@ -209,7 +356,7 @@ class BaseFrameReader:
   def close(self):
     pass
 
-  def get(self, num, count=1, pix_fmt="yuv420p"):
+  def get(self, num, count=1, pix_fmt="yuv420p", copy=True):
     raise NotImplementedError
 
 
@@ -250,7 +397,8 @@ class RawFrameReader(BaseFrameReader):
     cimg = np.dstack([img[0::2, 1::2], ((img[0::2, 0::2].astype("uint16") + img[1::2, 1::2].astype("uint16")) >> 1).astype("uint8"), img[1::2, 0::2]])
     return cimg
 
-  def get(self, num, count=1, pix_fmt="yuv420p"):
+  def get(self, num, count=1, pix_fmt="yuv420p", copy=True):
+    # frames are decoded on every call, so they are never shared
     assert self.frame_count is not None
     assert num+count <= self.frame_count
 
@@ -400,6 +548,19 @@ class StreamGOPReader(GOPReader):
 
     return (frame_b, frame_e, offset_b, offset_e)
 
+  def get_frames_data(self, frame_b, frame_e):
+    # raw data of frames [frame_b, frame_e), one entry per frame
+    offsets = [int(o) - int(self.index[frame_b, 1]) for o in self.index[frame_b:frame_e + 1, 1]]
+    with FileReader(self.fn) as f:
+      if isinstance(f, URLFile) and frame_e < self.frame_count:
+        # warm the download cache with the following GOP
+        _, _, next_b, next_e = self._lookup_gop(frame_e)
+        f.prefetch(int(next_b), int(next_e - next_b))
+
+      f.seek(int(self.index[frame_b, 1]))
+      rawdat = f.read(offsets[-1])
+    return [rawdat[b:e] for b, e in zip(offsets[:-1], offsets[1:], strict=True)]
+
   def get_gop(self, num):
     frame_b, frame_e, offset_b, offset_e = self._lookup_gop(num)
     assert frame_b <= num < frame_e
@@ -407,6 +568,11 @@ class StreamGOPReader(GOPReader):
     num_frames = frame_e - frame_b
 
     with FileReader(self.fn) as f:
+      if isinstance(f, URLFile) and frame_e < self.frame_count:
+        # warm the download cache with the next GOP while this one is decoded
+        _, _, next_b, next_e = self._lookup_gop(frame_e)
+        f.prefetch(int(next_b), int(next_e - next_b))
+
       f.seek(offset_b)
       rawdat = f.read(offset_e - offset_b)
 
@@ -431,18 +597,19 @@ class GOPFrameReader(BaseFrameReader):
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    self.frame_cache = shared_frame_cache
+    self.cache_lock = threading.RLock()
 
     if self.readahead:
-      self.cache_lock = threading.RLock()
       self.readahead_last = None
-      self.readahead_len = 30
+      self.readahead_prev = None
+      self.readahead_len = READAHEAD_MIN
+      self.readahead_stride = -1 if readbehind else 1
+      self.readahead_gen = 0
       self.readahead_c = threading.Condition()
       self.readahead_thread = threading.Thread(target=self._readahead_thread)
       self.readahead_thread.daemon = True
       self.readahead_thread.start()
-    else:
-      self.cache_lock = DoNothingContextManager()
 
   def close(self):
     if not self.open_:
@@ -467,37 +634,75 @@ class GOPFrameReader(BaseFrameReader):
       if not self.open_:
         break
       assert self.readahead_last
-      num, pix_fmt = self.readahead_last
+      num, stride, depth, pix_fmt = self.readahead_last
+      gen = self.readahead_gen
 
-      if self.readbehind:
-        for k in range(num - 1, max(0, num - self.readahead_len), -1):
-          self._get_one(k, pix_fmt)
+      for k in range(depth):
+        n = num + k * stride
+        # stop once out of bounds, or when a newer request has changed the prediction
+        if not (0 <= n < self.frame_count) or gen != self.readahead_gen or not self.open_:
+          break
+        self._get_one(n, pix_fmt)
+
+  def _update_readahead(self, num, count, pix_fmt):
+    # predict the next frames from the stride between requests, reading further ahead the longer it holds
+    if self.readahead_prev is not None:
+      last_num, last_count = self.readahead_prev
+      stride = num - last_num
+      if stride == last_count:
+        stride = 1  # contiguous reads
+      if stride != 0 and stride == self.readahead_stride:
+        self.readahead_len = min(self.readahead_len * 2, READAHEAD_MAX)
       else:
-        for k in range(num, min(self.frame_count, num + self.readahead_len)):
-          self._get_one(k, pix_fmt)
-
-  def _get_one(self, num, pix_fmt):
-    assert num < self.frame_count
-
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
-
-    with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
-
+        self.readahead_len = READAHEAD_MIN
+      if stride != 0:
+        self.readahead_stride = stride
+    self.readahead_prev = (num, count)
+
+    stride = self.readahead_stride
+    start = num + count - 1 + stride if stride > 0 else num + stride
+    self.readahead_gen += 1
+    self.readahead_last = (start, stride, self.readahead_len, pix_fmt)
+
+  def _decode(self, num, pix_fmt):
+    # returns [(frame_num, frame)] for at least frame num, along with any other frames decoded on the way
+    if os.getenv("FFMPEG_CUDA", "0") == "1":
       frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
 
       ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
       ret = ret[skip_frames:]
       assert ret.shape[0] == num_frames
+      return [(frame_b + i, ret[i]) for i in range(ret.shape[0])]
+    return get_decoder_session(self, pix_fmt).decode(num)
 
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
-
-      return self.frame_cache[(num, pix_fmt)]
+  def _get_one(self, num, pix_fmt):
+    assert num < self.frame_count
 
-  def get(self, num, count=1, pix_fmt="yuv420p"):
+    key = (self.fn, num, pix_fmt)
+    frame = self.frame_cache.get(key)
+    if frame is not None:
+      return frame
+
+    # decoding is serialized per file and pix_fmt, whoever waited on the lock usually finds the frame cached
+    lock = self.cache_lock if os.getenv("FFMPEG_CUDA", "0") == "1" else get_decoder_session(self, pix_fmt).lock
+    with lock:
+      frame = self.frame_cache.get(key, record=False)
+      if frame is not None:
+        return frame
+
+      t = time.monotonic()
+      frames = self._decode(num, pix_fmt)
+      self.frame_cache.record_decode(time.monotonic() - t)
+
+      for i, f in frames:
+        self.frame_cache.put((self.fn, i, pix_fmt), f)
+        if i == num:
+          frame = f
+      return frame
+
+  def get(self, num, count=1, pix_fmt="yuv420p", copy=True):
+    # copy=False returns the read-only arrays held by the shared frame cache, which saves a copy per frame
+    # but fails on in-place modification
     assert self.frame_count is not None
 
     if num + count > self.frame_count:
@@ -507,9 +712,11 @@ class GOPFrameReader(BaseFrameReader):
       raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
 
     ret = [self._get_one(num + i, pix_fmt) for i in range(count)]
+    if copy:
+      ret = [f.copy() for f in ret]
 
     if self.readahead:
-      self.readahead_last = (num+count, pix_fmt)
+      self._update_readahead(num, count, pix_fmt)
       self.readahead_c.acquire()
       self.readahead_c.notify()
       self.readahead_c.release()
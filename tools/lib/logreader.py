@@ -1,35 +1,161 @@
 #!/usr/bin/env python3
 import bz2
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from functools import partial
+import heapq
+import itertools
 import multiprocessing
 import capnp
 import enum
+import numpy as np
 import os
 import pathlib
+import struct
 import sys
+import time
 import tqdm
 import urllib.parse
 import warnings
 
+from collections import Counter
 from collections.abc import Callable, Iterable, Iterator
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
 from openpilot.common.swaglog import cloudlog
+from openpilot.tools.lib.column_cache import load_columns
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
 from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
 from openpilot.tools.lib.route import Route, SegmentRange
+from openpilot.tools.lib.url_file import URLFile
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
 
 
+# streaming mode reads and decompresses this many bytes at a time
+STREAM_CHUNK_SIZE = 1024 * 1024
+# with sort_by_time in streaming mode, events are reordered within a window of this many events
+SORT_WINDOW_SIZE = 4096
+# streaming mode downloads this far ahead of the read position for remote logs
+STREAM_READAHEAD = 8 * STREAM_CHUNK_SIZE
+# default cap on decompressed segments held by LogReader.iter_prefetch
+PREFETCH_MEMORY_BUDGET = 1024 * 1024 * 1024
+
+
+def _capnp_message_size(dat, offset: int) -> int | None:
+  # capnp stream framing: (segment count - 1), segment sizes in words, padding to a word boundary, then the segments
+  avail = len(dat) - offset
+  if avail < 4:
+    return None
+  num_segments = struct.unpack_from("<I", dat, offset)[0] + 1
+  header_size = (4 + 4 * num_segments + 7) & ~7
+  if avail < header_size:
+    return None
+  return header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", dat, offset + 4))
+
+
+def _decompress_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+  chunks = iter(chunks)
+  first = next(chunks, b"")
+  if not first.startswith(b'BZh'):
+    # old rlogs weren't bz2 compressed
+    yield first
+    yield from chunks
+    return
+
+  decompressor = bz2.BZ2Decompressor()
+  for dat in itertools.chain((first,), chunks):
+    while dat:
+      if decompressor.eof:
+        # concatenated bz2 streams
+        decompressor = bz2.BZ2Decompressor()
+      out = decompressor.decompress(dat)
+      dat = decompressor.unused_data if decompressor.eof else b""
+      if out:
+        yield out
+
+
+def _frame_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+  # regroup arbitrary chunks of a capnp stream into buffers that only hold whole messages
+  buf = bytearray()
+  for chunk in chunks:
+    buf += chunk
+    end = 0
+    while (size := _capnp_message_size(buf, end)) is not None and end + size <= len(buf):
+      end += size
+    if end:
+      yield bytes(buf[:end])
+      del buf[:end]
+
+  if len(buf):
+    warnings.warn("Truncated event detected at end of log", RuntimeWarning, stacklevel=1)
+
+
+def _sort_window(events: Iterable[LogMessage], window: int) -> Iterator[LogMessage]:
+  # bounded-window merge, exact as long as no event is logged more than `window` events out of order
+  heap: list = []
+  for i, ev in enumerate(events):
+    heapq.heappush(heap, (ev.logMonoTime, i, ev))
+    if len(heap) > window:
+      yield heapq.heappop(heap)[2]
+  while heap:
+    yield heapq.heappop(heap)[2]
+
+
+_EVENT_STRUCT = capnp_log.Event.schema.node.struct
+_EVENT_DISCRIMINANT_OFFSET = 2 * _EVENT_STRUCT.discriminantOffset
+_EVENT_UNION_NAMES = {f.discriminantValue: f.name for f in _EVENT_STRUCT.fields if f.discriminantValue != 0xffff}
+
+
+def _peek_which(dat, offset: int, size: int) -> str:
+  # read the Event union discriminant straight from the root struct's data section
+  header_size = (4 + 4 * (struct.unpack_from("<I", dat, offset)[0] + 1) + 7) & ~7
+  segment = offset + header_size
+  root = struct.unpack_from("<Q", dat, segment)[0]
+  if root & 3 != 0:
+    # root isn't a plain struct pointer (e.g. a far pointer), let capnp resolve it
+    return next(iter(capnp_log.Event.read_multiple_bytes(bytes(dat[offset:offset + size])))).which()
+
+  data_offset = segment + 8 * (1 + (((root & 0xffffffff) >> 2) ^ 0x20000000) - 0x20000000)
+  data_size = 8 * ((root >> 32) & 0xffff)
+  discriminant = 0
+  if _EVENT_DISCRIMINANT_OFFSET + 2 <= data_size:
+    discriminant = struct.unpack_from("<H", dat, data_offset + _EVENT_DISCRIMINANT_OFFSET)[0]
+  return _EVENT_UNION_NAMES.get(discriminant, f"unknown{discriminant}")
+
+
+def _filter_services(dat, services: frozenset[str], skipped: Counter) -> bytes:
+  # keep only the framed messages of the requested services, without building readers for the rest
+  out = bytearray()
+  offset = 0
+  while (size := _capnp_message_size(dat, offset)) is not None and offset + size <= len(dat):
+    which = _peek_which(dat, offset, size)
+    if which in services:
+      out += dat[offset:offset + size]
+    else:
+      skipped[which] += 1
+    offset += size
+
+  # leave anything that doesn't frame for capnp to report as corrupted
+  out += dat[offset:]
+  return bytes(out)
+
+
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None, streaming=False,
+               services: frozenset[str] | None = None):
     self.data_version = None
     self._only_union_types = only_union_types
+    self._sort_by_time = sort_by_time
+    self._streaming = streaming
+    self._services = services
+    # events dropped by the services filter, by type
+    self.skipped: Counter[str] = Counter()
 
     ext = None
     if not dat:
@@ -38,12 +164,22 @@ class _LogFileReader:
         # old rlogs weren't bz2 compressed
         raise Exception(f"unknown extension {ext}")
 
+    if streaming:
+      # nothing is read until iteration, and every pass over the file reads it again
+      self._fn = fn
+      self._dat = dat
+      return
+
+    if not dat:
       with FileReader(fn) as f:
         dat = f.read()
 
     if ext == ".bz2" or dat.startswith(b'BZh9'):
       dat = bz2.decompress(dat)
 
+    if services is not None:
+      dat = _filter_services(dat, services, self.skipped)
+
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
     _ents = []
@@ -56,8 +192,44 @@ class _LogFileReader:
     self._ents = list(sorted(_ents, key=lambda x: x.logMonoTime) if sort_by_time else _ents)
     self._ts = [x.logMonoTime for x in self._ents]
 
+  def _raw_chunks(self) -> Iterator[bytes]:
+    if self._dat:
+      for i in range(0, len(self._dat), STREAM_CHUNK_SIZE):
+        yield self._dat[i:i + STREAM_CHUNK_SIZE]
+      return
+
+    with FileReader(self._fn) as f:
+      pos = 0
+      while True:
+        if isinstance(f, URLFile):
+          f.prefetch(pos + STREAM_CHUNK_SIZE, STREAM_READAHEAD)
+        chunk = f.read(STREAM_CHUNK_SIZE)
+        pos += len(chunk)
+        if chunk:
+          yield chunk
+        if len(chunk) < STREAM_CHUNK_SIZE:
+          break
+
+  def _stream_events(self) -> Iterator[capnp._DynamicStructReader]:
+    # at most one decompressed chunk, plus whatever events the consumer still holds, is alive at a time
+    try:
+      self.skipped.clear()
+      for dat in _frame_stream(_decompress_stream(self._raw_chunks())):
+        if self._services is not None:
+          dat = _filter_services(dat, self._services, self.skipped)
+        yield from capnp_log.Event.read_multiple_bytes(dat)
+    except capnp.KjException:
+      warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    if self._streaming:
+      ents = self._stream_events()
+      if self._sort_by_time:
+        ents = _sort_window(ents, SORT_WINDOW_SIZE)
+    else:
+      ents = iter(self._ents)
+
+    for ent in ents:
       if self._only_union_types:
         try:
           ent.which()
@@ -68,6 +240,28 @@ class _LogFileReader:
         yield ent
 
 
+@dataclass
+class SegmentTiming:
+  fetch: float = 0.
+  decompress: float = 0.
+  parse: float = 0.
+
+
+def _fetch_segment(fn: str) -> tuple[bytes, SegmentTiming]:
+  timing = SegmentTiming()
+  t = time.monotonic()
+  with FileReader(fn) as f:
+    dat = f.read()
+  timing.fetch = time.monotonic() - t
+
+  t = time.monotonic()
+  if dat.startswith(b'BZh'):
+    # bz2 releases the GIL, so this overlaps with parsing in the consumer thread
+    dat = bz2.decompress(dat)
+  timing.decompress = time.monotonic() - t
+  return dat, timing
+
+
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
   QLOG = "q"  # only read qlogs
@@ -244,26 +438,68 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               default_source=auto_source, sort_by_time=False, only_union_types=False):
+               default_source=auto_source, sort_by_time=False, only_union_types=False, streaming=False,
+               services: Iterable[str] | None = None):
     self.default_mode = default_mode
     self.default_source = default_source
     self.identifier = identifier
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    # decode segments incrementally instead of holding each one fully in memory
+    self.streaming = streaming
+    # only parse events of these types, everything else is dropped while framing
+    self.services = frozenset(services) if services is not None else None
+    if self.services is not None:
+      unknown = self.services - set(_EVENT_UNION_NAMES.values())
+      assert not unknown, f"unknown services: {sorted(unknown)}"
 
     self.__lrs: dict[int, _LogFileReader] = {}
+    # services filter counters of every segment read, iter_prefetch doesn't keep its readers around
+    self.__skipped: dict[int, Counter[str]] = {}
     self.reset()
 
   def _get_lr(self, i):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                                     streaming=self.streaming, services=self.services)
+      self.__skipped[i] = self.__lrs[i].skipped
     return self.__lrs[i]
 
   def __iter__(self):
     for i in range(len(self.logreader_identifiers)):
       yield from self._get_lr(i)
 
+  def iter_prefetch(self, num_workers: int = 4, memory_budget: int = PREFETCH_MEMORY_BUDGET) -> Iterator[LogMessage]:
+    # same events in the same order as __iter__, while workers fetch and decompress the following segments
+    assert not self.streaming, "prefetching decompresses whole segments, use plain iteration in streaming mode"
+    self.segment_timings: dict[int, SegmentTiming] = {}
+
+    num_segs = len(self.logreader_identifiers)
+    pool = ThreadPoolExecutor(num_workers)
+    pending: deque[Future] = deque()
+    next_seg = 0
+    seg_size = 0  # largest decompressed segment so far, used to estimate in-flight memory
+    try:
+      for i in range(num_segs):
+        while next_seg < num_segs and len(pending) < num_workers and (len(pending) + 1) * seg_size <= max(memory_budget, seg_size):
+          pending.append(pool.submit(_fetch_segment, self.logreader_identifiers[next_seg]))
+          next_seg += 1
+
+        dat, timing = pending.popleft().result()
+        seg_size = max(seg_size, len(dat))
+
+        t = time.monotonic()
+        lr = _LogFileReader(self.logreader_identifiers[i], dat=dat, sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                            services=self.services)
+        del dat
+        timing.parse = time.monotonic() - t
+        self.segment_timings[i] = timing
+        self.__skipped[i] = lr.skipped
+        yield from lr
+    finally:
+      pool.shutdown(wait=False, cancel_futures=True)
+
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
 
@@ -275,6 +511,10 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
         ret.extend(p)
       return ret
 
+  def skipped(self) -> dict[int, Counter[str]]:
+    # events dropped by the services filter so far, per segment index, whether read by __iter__ or iter_prefetch
+    return dict(self.__skipped)
+
   def reset(self):
     self.logreader_identifiers = self._parse_identifiers(self.identifier)
 
@@ -288,6 +528,13 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def to_columns(self, columns: list[str]) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    # {"carState.vEgo": (logMonoTime, values)}, served from the on-disk column cache and built on first read
+    segments = []
+    for fn in self.logreader_identifiers:
+      segments.append(load_columns(fn, columns, lambda services, fn=fn: _LogFileReader(fn, streaming=True, services=services)))
+    return {c: (np.concatenate([s[c][0] for s in segments]), np.concatenate([s[c][1] for s in segments])) for c in columns}
+
 
 if __name__ == "__main__":
   import codecs
@@ -1,7 +1,9 @@
 import logging
 import os
 import socket
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
@@ -9,9 +11,12 @@ from urllib3.util import Timeout
 
 from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.download_cache import DownloadCache
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+# concurrent ranged GETs for missing chunks, shared by all URLFiles in the process
+DOWNLOAD_THREADS = int(os.getenv("URLFILE_DOWNLOAD_THREADS", "8"))
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -26,10 +31,19 @@ class URLFileException(Exception):
 
 class URLFile:
   _pool_manager: PoolManager|None = None
+  _download_pool: ThreadPoolExecutor|None = None
+  _cache: DownloadCache|None = None
+  # chunk downloads in progress by cache path, so reads and prefetches never fetch the same chunk twice
+  _inflight: dict[str, Future] = {}
+  _inflight_lock = threading.Lock()
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    URLFile._download_pool = None
+    URLFile._cache = None
+    URLFile._inflight = {}
+    URLFile._inflight_lock = threading.Lock()
 
   @staticmethod
   def pool_manager() -> PoolManager:
@@ -39,6 +53,18 @@ class URLFile:
       URLFile._pool_manager = PoolManager(num_pools=10, maxsize=100, socket_options=socket_options, retries=retries)
     return URLFile._pool_manager
 
+  @staticmethod
+  def download_pool() -> ThreadPoolExecutor:
+    if URLFile._download_pool is None:
+      URLFile._download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS, thread_name_prefix="urlfile")
+    return URLFile._download_pool
+
+  @staticmethod
+  def cache() -> DownloadCache:
+    if URLFile._cache is None or URLFile._cache.root != Paths.download_cache_root():
+      URLFile._cache = DownloadCache()
+    return URLFile._cache
+
   def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None):
     self._url = url
     self._timeout = Timeout(connect=timeout, read=timeout)
@@ -73,50 +99,110 @@ class URLFile:
     if self._length is not None:
       return self._length
 
-    file_length_path = os.path.join(Paths.download_cache_root(), hash_256(self._url) + "_length")
-    if not self._force_download and os.path.exists(file_length_path):
-      with open(file_length_path) as file_length:
-        content = file_length.read()
-        self._length = int(content)
+    if not self._force_download:
+      self._length = URLFile.cache().get_length(hash_256(self._url))
+      if self._length is not None:
         return self._length
 
     self._length = self.get_length_online()
     if not self._force_download and self._length != -1:
-      with atomic_write_in_dir(file_length_path, mode="w") as file_length:
-        file_length.write(str(self._length))
+      URLFile.cache().set_length(hash_256(self._url), self._length)
     return self._length
 
-  def read(self, ll: int|None=None) -> bytes:
+  def _chunk_name(self, chunk: int) -> str:
+    # chunks are named by float chunk number, as they always have been
+    return f"{hash_256(self._url)}_{float(chunk)}"
+
+  def _download_chunk(self, chunk: int, name: str) -> bytes:
+    start = chunk * CHUNK_SIZE
+    data = self._read_range(start, min(start + CHUNK_SIZE, self.get_length()))
+    with atomic_write_in_dir(URLFile.cache().path(name), mode="wb", overwrite=True) as new_cached_file:
+      new_cached_file.write(data)
+    URLFile.cache().add(name, len(data))
+    return data
+
+  def _fetch_chunk(self, chunk: int) -> Future:
+    name = self._chunk_name(chunk)
+    with URLFile._inflight_lock:
+      future = URLFile._inflight.get(name)
+      if future is None:
+        future = URLFile.download_pool().submit(self._download_chunk, chunk, name)
+        URLFile._inflight[name] = future
+        future.add_done_callback(lambda _: URLFile._inflight.pop(name, None))
+    return future
+
+  def _load_chunk(self, chunk: int, cached: bool) -> bytes|Future:
+    if cached:
+      name = self._chunk_name(chunk)
+      try:
+        with open(URLFile.cache().path(name), "rb") as cached_file:
+          return cached_file.read()
+      except FileNotFoundError:
+        URLFile.cache().discard(name)
+    return self._fetch_chunk(chunk)
+
+  def _cached_chunks(self, chunks: range, record: bool = True) -> set[int]:
+    names = {self._chunk_name(c): c for c in chunks}
+    pending = [name for name in names if name not in URLFile._inflight]
+    return {names[name] for name in URLFile.cache().lookup(pending, record=record)}
+
+  def prefetch(self, offset: int, ll: int) -> None:
+    # start downloading the chunks covering [offset, offset + ll) into the cache in the background. without the
+    # download cache (FILEREADER_CACHE=1 or cache=True) there is nowhere to keep them, so this does nothing
     if self._force_download:
-      return self.read_aux(ll=ll)
+      return
+
+    chunks = range(offset // CHUNK_SIZE, (min(offset + ll, self.get_length()) + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    cached = self._cached_chunks(chunks, record=False)
+    for chunk in chunks:
+      if chunk not in cached:
+        self._fetch_chunk(chunk)
+
+  def readinto(self, buf) -> int:
+    view = memoryview(buf).cast('B')
+    if self._force_download:
+      data = self.read_aux(ll=len(view))
+      view[:len(data)] = data
+      return len(data)
 
+    length = self.get_length()
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
     file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
+    file_end = min(self._pos + len(view), length)
+    if file_end <= file_begin:
+      return 0
+
+    # cached chunks are read right away, missing ones are all downloaded concurrently
+    chunk_range = range(file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE + 1)
+    cached = self._cached_chunks(chunk_range)
+    chunks = {c: self._load_chunk(c, c in cached) for c in chunk_range}
+    for chunk in list(chunks):
+      data = chunks.pop(chunk)
+      if isinstance(data, Future):
+        data = data.result()
+
+      position = chunk * CHUNK_SIZE
+      src_begin = max(0, file_begin - position)
+      src_end = min(CHUNK_SIZE, file_end - position)
+      view[position + src_begin - file_begin:position + src_end - file_begin] = data[src_begin:src_end]
+
+    self._pos = file_end
+    return file_end - file_begin
+
+  def read(self, ll: int|None=None) -> bytes:
+    if self._force_download:
+      return self.read_aux(ll=ll)
 
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+    length = self.get_length()
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
+    buf = bytearray(max(0, (length if ll is None else min(self._pos + ll, length)) - self._pos))
+    self.readinto(buf)
+    return bytes(buf)
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+  def _read_range(self, start: int, end: int) -> bytes:
+    if start >= end:
+      return b""
+    return self._get({'Range': f"bytes={start}-{end - 1}"}, True)
 
   def read_aux(self, ll: int|None=None) -> bytes:
     download_range = False
@@ -131,6 +217,11 @@ class URLFile:
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True
 
+    ret = self._get(headers, download_range)
+    self._pos += len(ret)
+    return ret
+
+  def _get(self, headers: dict[str, str], download_range: bool) -> bytes:
     if self._debug:
       t1 = time.time()
 
@@ -150,7 +241,6 @@ class URLFile:
     if (not download_range) and response_code != 200:  # OK
       raise URLFileException(f"Error {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
 
-    self._pos += len(ret)
     return ret
 
   def seek(self, pos:int) -> None:
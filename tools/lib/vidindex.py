@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import mmap
 import os
 import struct
 from enum import IntEnum
 
-from openpilot.tools.lib.filereader import FileReader
+import numpy as np
+
+from openpilot.tools.lib.filereader import FileReader, resolve_name
 
 DEBUG = int(os.getenv("DEBUG", "0"))
 
@@ -291,6 +294,115 @@ def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, in
 
   return frame_types, len(dat), prefix_dat
 
+def remove_emulation_prevention(dat: bytes) -> bytes:
+  # 7.4.2 NAL unit semantics: emulation_prevention_three_byte is discarded by the decoding process
+  return dat.replace(b"\x00\x00\x03", b"\x00\x00")
+
+def get_hevc_dimensions(dat: bytes, nal_unit_start: int, nal_unit_len: int) -> tuple[int, int]:
+  # 7.3.2.2.1 General sequence parameter set RBSP syntax, up to pic_height_in_luma_samples and the conformance window
+  rbsp_start = nal_unit_start + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE
+  rbsp = remove_emulation_prevention(bytes(dat[rbsp_start:nal_unit_start + nal_unit_len]))
+  pos = 0
+
+  def u(n: int) -> int:
+    nonlocal pos
+    val = 0
+    for _ in range(n):
+      val = (val << 1) | ((rbsp[pos // 8] >> (7 - pos % 8)) & 1)
+      pos += 1
+    return val
+
+  def ue() -> int:
+    nonlocal pos
+    val, size = get_ue(rbsp, pos // 8, pos % 8)
+    pos += size
+    return val
+
+  u(4)  # sps_video_parameter_set_id
+  max_sub_layers_minus1 = u(3)
+  u(1)  # sps_temporal_id_nesting_flag
+
+  # 7.3.3 profile_tier_level( 1, sps_max_sub_layers_minus1 ): general profile (88 bits) and general_level_idc
+  u(88)
+  u(8)
+  sub_layer_flags = [(u(1), u(1)) for _ in range(max_sub_layers_minus1)]
+  if max_sub_layers_minus1 > 0:
+    u(2 * (8 - max_sub_layers_minus1))  # reserved_zero_2bits
+  for profile_present, level_present in sub_layer_flags:
+    u(88 * profile_present + 8 * level_present)
+
+  ue()  # sps_seq_parameter_set_id
+  chroma_format_idc = ue()
+  if chroma_format_idc == 3:
+    u(1)  # separate_colour_plane_flag
+  width = ue()
+  height = ue()
+
+  # 7.4.3.2.1 the conformance window is what ffprobe reports as the frame size
+  if u(1):
+    # Table 6-1 SubWidthC and SubHeightC
+    sub_width, sub_height = {1: (2, 2), 2: (2, 1)}.get(chroma_format_idc, (1, 1))
+    left, right, top, bottom = ue(), ue(), ue(), ue()
+    width -= sub_width * (left + right)
+    height -= sub_height * (top + bottom)
+  return width, height
+
+def fast_hevc_index(hevc_file_name: str) -> tuple[list, int, bytes, int, int]:
+  # same results as hevc_index, plus the frame size. start codes are found for the whole file at once with numpy,
+  # and only the first few bits of each slice header are parsed
+  fn = resolve_name(hevc_file_name)
+  if fn.startswith(("http://", "https://")):
+    with FileReader(fn) as f:
+      dat = f.read()
+    return _fast_hevc_index(dat)
+
+  with open(fn, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      raise VideoFileInvalid("data is too short")
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dat:
+      return _fast_hevc_index(dat)
+
+def _fast_hevc_index(dat) -> tuple[list, int, bytes, int, int]:
+  if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
+    raise VideoFileInvalid("data is too short")
+
+  if dat[0] != 0x00:
+    raise VideoFileInvalid("first byte must be 0x00")
+
+  arr = np.frombuffer(dat, dtype=np.uint8)
+  # B.2 every NAL unit starts with 0x000001, and that pattern can't overlap itself
+  starts = np.flatnonzero(arr[2:] == 0x01)
+  starts = starts[(arr[starts] == 0x00) & (arr[starts + 1] == 0x00)]
+  if len(starts) == 0 or starts[0] != 1:
+    raise VideoFileInvalid("data must begin with start code")
+  if starts[-1] + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE > len(dat):
+    raise VideoFileInvalid("data to short to contain nal unit header")
+  ends = np.append(starts[1:], len(dat))
+
+  nal_unit_types = (arr[starts + NAL_UNIT_START_CODE_SIZE] >> 1) & 0x3F
+
+  prefix_dat = b""
+  width, height = 0, 0
+  is_parameter_set = np.isin(nal_unit_types, HEVC_PARAMETER_SET_NAL_UNITS)
+  for start, end, nal_unit_type in zip(starts[is_parameter_set], ends[is_parameter_set], nal_unit_types[is_parameter_set], strict=True):
+    prefix_dat += dat[start:end]
+    if nal_unit_type == HevcNalUnitType.SPS_NUT and width == 0:
+      width, height = get_hevc_dimensions(dat, int(start), int(end - start))
+
+  # only the first slice segment of each picture starts a frame
+  rbsp_starts = starts + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE
+  is_slice = np.isin(nal_unit_types, HEVC_CODED_SLICE_SEGMENT_NAL_UNITS)
+  is_slice[is_slice] &= rbsp_starts[is_slice] < len(dat)
+  is_first_slice = is_slice.copy()
+  is_first_slice[is_slice] = (arr[rbsp_starts[is_slice]] >> 7) & 1 == 1
+
+  frame_types = []
+  for start, nal_unit_type in zip(starts[is_first_slice], nal_unit_types[is_first_slice], strict=True):
+    slice_type, _ = get_hevc_slice_type(dat, int(start), HevcNalUnitType(nal_unit_type))
+    frame_types.append((slice_type, int(start)))
+
+  return frame_types, len(dat), prefix_dat, width, height
+
 def main() -> None:
   parser = argparse.ArgumentParser()
   parser.add_argument("input_file", type=str)